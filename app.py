@@ -1,7 +1,7 @@
 """
 Aplicación web de carrito de compras mayorista - RM KITS
 """
-from flask import Flask, render_template, request, jsonify, redirect, session, flash, url_for, send_file, send_from_directory
+from flask import Flask, render_template, request, jsonify, redirect, session, flash, url_for, send_file, send_from_directory, make_response, abort
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
 import sqlite3
@@ -9,20 +9,62 @@ import urllib.parse
 import logging
 import os
 import json
+import re
+import hashlib
+import gzip
+import csv
+import codecs
+import random
+import threading
+import time
+import unicodedata
+from collections import namedtuple
 from contextlib import contextmanager
 from functools import wraps
-from datetime import datetime
+from itertools import islice
+from datetime import datetime, timedelta
 from config import Config
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, PatternFill
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
 from openpyxl import load_workbook
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 import zipfile
+import tempfile
+import uuid
 import shutil
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
+# Pillow es opcional: sin él las imágenes se sirven en su tamaño original
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# Brotli es opcional: sin él la tienda se comprime solo con gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# pandas es opcional: solo lo usa la vista previa de la importación de productos
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# pyarrow es opcional: solo hace falta para importar y exportar en Parquet
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -112,21 +154,187 @@ def init_persistent_storage():
 init_persistent_storage()
 
 
+# Conexión SQLite reutilizable por hilo: se abre una vez por hilo/worker y se
+# reutiliza en cada get_db_connection(), con la caché de páginas ya caliente.
+_db_local = threading.local()
+
+# Valores permitidos para los PRAGMA que se arman como texto
+VALORES_TEMP_STORE = ('DEFAULT', 'FILE', 'MEMORY')
+VALORES_SYNCHRONOUS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+def valor_pragma(valor, permitidos, por_defecto):
+    """Valida el valor de un PRAGMA de texto; si no es válido usa el por defecto"""
+    valor = str(valor or '').strip().upper()
+    if valor not in permitidos:
+        logger.warning(f"⚠️  Valor de PRAGMA inválido: {valor!r}, se usa {por_defecto}")
+        return por_defecto
+    return valor
+
+
+def abrir_conexion():
+    """Abre una conexión nueva con row_factory y los PRAGMA de Config"""
+    # timeout = busy_timeout: si otra conexión está escribiendo se espera en vez de fallar
+    conn = sqlite3.connect(Config.DATABASE_PATH, timeout=Config.SQLITE_BUSY_TIMEOUT / 1000)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA cache_size = {int(Config.SQLITE_CACHE_SIZE)}")
+    conn.execute(f"PRAGMA mmap_size = {int(Config.SQLITE_MMAP_SIZE)}")
+    conn.execute(f"PRAGMA temp_store = {valor_pragma(Config.SQLITE_TEMP_STORE, VALORES_TEMP_STORE, 'MEMORY')}")
+    conn.execute(f"PRAGMA synchronous = {valor_pragma(Config.SQLITE_SYNCHRONOUS, VALORES_SYNCHRONOUS, 'FULL')}")
+    conn.execute(f"PRAGMA wal_autocheckpoint = {int(Config.SQLITE_WAL_AUTOCHECKPOINT)}")
+    return conn
+
+
+def _identidad_archivo_db():
+    """Identifica el archivo de la base (cambia si se reemplaza o se borra)"""
+    try:
+        st = os.stat(Config.DATABASE_PATH)
+        return (st.st_dev, st.st_ino)
+    except OSError:
+        return None
+
+
+def _conexion_del_hilo():
+    """
+    Devuelve la conexión del hilo actual, abriéndola si hace falta.
+    Se reabre si el proceso es otro (fork de gunicorn) o si el archivo de la
+    base fue reemplazado desde que se abrió.
+    """
+    conn = getattr(_db_local, 'conn', None)
+    identidad = _identidad_archivo_db()
+    if conn is not None and (_db_local.pid != os.getpid() or _db_local.identidad != identidad):
+        # Una conexión heredada de otro proceso no se cierra: solo se descarta
+        if _db_local.pid == os.getpid():
+            conn.close()
+        conn = None
+
+    if conn is None:
+        conn = abrir_conexion()
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+        _db_local.identidad = _identidad_archivo_db()
+    return conn
+
+
+def cerrar_conexion_del_hilo():
+    """Cierra la conexión reutilizable del hilo actual (si tiene una)"""
+    conn = getattr(_db_local, 'conn', None)
+    _db_local.conn = None
+    if conn is not None and _db_local.pid == os.getpid():
+        conn.close()
+
+
 # Context manager para manejo seguro de base de datos
 @contextmanager
 def get_db_connection():
-    """Context manager para conexiones a la base de datos"""
+    """
+    Context manager para conexiones a la base de datos.
+    Reutiliza la conexión del hilo; al salir se descarta lo que no se haya
+    confirmado con commit(), igual que cuando se cerraba la conexión. Si el
+    hilo ya está usando su conexión (llamadas anidadas), se abre una aparte.
+    """
     conn = None
+    propia = False
     try:
-        conn = sqlite3.connect(Config.DATABASE_PATH)
-        conn.row_factory = sqlite3.Row
+        if getattr(_db_local, 'en_uso', False):
+            conn = abrir_conexion()
+        else:
+            conn = _conexion_del_hilo()
+            _db_local.en_uso = True
+            propia = True
         yield conn
     except sqlite3.Error as e:
         logger.error(f"Error de base de datos: {e}")
         raise
     finally:
-        if conn:
+        if conn and not propia:
             conn.close()
+        elif conn:
+            _db_local.en_uso = False
+            try:
+                if conn.in_transaction:
+                    conn.rollback()
+            except sqlite3.Error as e:
+                logger.error(f"Error al liberar la conexión: {e}")
+                cerrar_conexion_del_hilo()
+
+
+def es_error_de_bloqueo(error):
+    """Indica si el error es por la base ocupada por otra escritura"""
+    mensaje = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in mensaje or 'busy' in mensaje)
+
+
+def con_reintentos(f):
+    """
+    Decorador para escrituras: si la base sigue bloqueada después del
+    busy_timeout, reintenta con espera exponencial (con algo de azar para
+    que los workers no reintenten todos juntos). La función decorada debe
+    abrir su propia conexión y hacer commit, así cada intento es completo.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        for intento in range(Config.SQLITE_REINTENTOS + 1):
+            try:
+                return f(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if not es_error_de_bloqueo(e) or intento == Config.SQLITE_REINTENTOS:
+                    raise
+                espera = Config.SQLITE_REINTENTO_ESPERA * (2 ** intento)
+                espera += random.uniform(0, espera)
+                logger.warning(f"⚠️  Base bloqueada en {f.__name__}, reintento {intento + 1} en {espera:.2f}s")
+                time.sleep(espera)
+    return decorated_function
+
+
+def configurar_wal():
+    """
+    Activa el modo WAL (lecturas y escrituras no se bloquean entre sí) y
+    verifica que haya quedado activo. El modo queda guardado en el archivo.
+    """
+    if not Config.SQLITE_WAL:
+        return
+    if not os.path.exists(Config.DATABASE_PATH) or os.path.getsize(Config.DATABASE_PATH) == 0:
+        logger.warning("⚠️  Saltando configuración WAL: base de datos no disponible")
+        return
+    try:
+        with get_db_connection() as conn:
+            modo = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        if str(modo).lower() == 'wal':
+            logger.info("✓ Base de datos en modo WAL")
+        else:
+            logger.error(f"❌ No se pudo activar el modo WAL (journal_mode = {modo})")
+    except Exception as e:
+        logger.error(f"Error al activar modo WAL: {e}")
+
+
+def checkpoint_wal(modo='PASSIVE'):
+    """
+    Pasa las páginas del WAL a la base. PASSIVE no espera a nadie; TRUNCATE
+    además deja el archivo -wal en cero (útil después de escrituras masivas).
+    Retorna (ocupado, páginas en el WAL, páginas copiadas) o None si falla.
+    """
+    if modo not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+        raise ValueError(f"Modo de checkpoint inválido: {modo}")
+    try:
+        with get_db_connection() as conn:
+            resultado = tuple(conn.execute(f"PRAGMA wal_checkpoint({modo})").fetchone())
+        if resultado[0]:
+            logger.warning(f"⚠️  Checkpoint {modo} incompleto: hay lectores usando el WAL")
+        return resultado
+    except Exception as e:
+        logger.error(f"Error en checkpoint del WAL: {e}")
+        return None
+
+
+@app.cli.command("checkpoint-db")
+def checkpoint_db_command():
+    """Pasa el WAL a la base de datos y lo trunca (por ejemplo, antes de copiar el .db)"""
+    resultado = checkpoint_wal('TRUNCATE')
+    if resultado is None:
+        print("❌ No se pudo hacer el checkpoint")
+    else:
+        print(f"✓ Checkpoint: {resultado[2]} de {resultado[1]} páginas copiadas" + (" (incompleto, hay lectores activos)" if resultado[0] else ""))
 
 
 @app.before_request
@@ -137,90 +345,559 @@ def before_request():
         return redirect(url, code=301)
 
 
+# =============================================================================
+# CACHÉ DEL CATÁLOGO
+# =============================================================================
+
+# Foto inmutable del catálogo activo. Cada worker guarda la suya y la reutiliza
+# mientras la versión del catálogo en la base no cambie.
+CatalogoSnapshot = namedtuple('CatalogoSnapshot', ['version', 'productos', 'categorias'])
+
+_catalogo_snapshot = None
+_catalogo_lock = threading.Lock()
+
+
+def obtener_version_catalogo(cursor):
+    """
+    Devuelve la versión actual del catálogo.
+    La incrementan los triggers de producto y categoria en cada escritura, así
+    que cualquier worker detecta los cambios con una consulta de una sola fila.
+    Retorna None si la base todavía no tiene la tabla de versión.
+    """
+    try:
+        cursor.execute("SELECT version FROM catalogo_version WHERE id = 1")
+    except sqlite3.OperationalError:
+        return None
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def _cargar_catalogo(cursor, version):
+    """Lee el catálogo activo completo y arma una foto inmutable"""
+    cursor.execute("SELECT * FROM vista_producto WHERE stock > 0 AND activo = 1 ORDER BY codigo ASC")
+    productos = tuple(dict(fila) for fila in cursor.fetchall())
+
+    cursor.execute("SELECT * FROM categoria ORDER BY nombre")
+    categorias = tuple(dict(row) for row in cursor.fetchall())
+
+    return CatalogoSnapshot(version=version, productos=productos, categorias=categorias)
+
+
+def get_catalogo():
+    """
+    Devuelve la foto del catálogo, recargándola solo si cambió la versión.
+    Los datos se leen después de la versión, así que en el peor caso la foto
+    queda más nueva que su versión y se recarga una vez de más.
+    """
+    global _catalogo_snapshot
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        version = obtener_version_catalogo(cursor)
+
+        snapshot = _catalogo_snapshot
+        if version is not None and snapshot is not None and snapshot.version == version:
+            return snapshot
+
+        with _catalogo_lock:
+            snapshot = _catalogo_snapshot
+            if version is not None and snapshot is not None and snapshot.version == version:
+                return snapshot
+
+            snapshot = _cargar_catalogo(cursor, version)
+            if version is not None:
+                _catalogo_snapshot = snapshot
+            return snapshot
+
+
 def get_productos():
-    """Obtiene todos los productos activos de la base de datos"""
+    """Obtiene todos los productos activos con stock (desde la caché del catálogo)"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM producto WHERE stock > 0 AND activo = 1 ORDER BY codigo ASC")
-            filas = cursor.fetchall()
-            productos = [dict(fila) for fila in filas]
-            return productos
+        return get_catalogo().productos
     except Exception as e:
         logger.error(f"Error al obtener productos: {e}")
-        return []
+        return ()
+
+
+# =============================================================================
+# RESPUESTAS CONDICIONALES (ETag)
+# =============================================================================
+
+# Archivos de los que depende el HTML de cada página de la tienda, además del catálogo
+ARCHIVOS_INDEX = ('templates/index.html', 'static/js/index.js', 'static/css/style.css', 'config.py')
+ARCHIVOS_CARRITO = ('templates/carrito.html', 'static/js/carrito.js', 'static/css/style.css', 'config.py')
+
+
+def etag_archivos(archivos=(), extra=''):
+    """
+    Arma un ETag fuerte a partir de la fecha de modificación de los
+    templates/assets de la página. Es el mismo en todos los workers, así que
+    un 304 no depende de qué worker atiende.
+    """
+    partes = [extra]
+    for archivo in archivos:
+        try:
+            partes.append(str(os.path.getmtime(os.path.join(app.root_path, archivo))))
+        except OSError:
+            partes.append('0')
+    return hashlib.sha1('|'.join(partes).encode('utf-8')).hexdigest()
+
+
+def etag_catalogo(version, archivos=(), extra=''):
+    """
+    Como etag_archivos, pero además depende de la versión del catálogo.
+    Retorna None si no se conoce la versión (no se puede validar la caché).
+    """
+    if version is None:
+        return None
+    return etag_archivos(archivos, f"{version}|{extra}")
+
+
+def respuesta_condicional(etag, generar):
+    """
+    Responde 304 sin generar nada si el navegador ya tiene la versión del ETag.
+    Si no, llama a generar() y agrega el ETag a la respuesta. Con no-cache el
+    navegador guarda la página pero la revalida en cada visita.
+    """
+    if etag and request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(generar())
+        if response.status_code != 200:
+            return response
+    if etag:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+
+# =============================================================================
+# PÁGINAS PRE-RENDERIZADAS
+# =============================================================================
+
+# HTML de la tienda ya renderizado y comprimido, listo para servir como bytes
+PaginaRenderizada = namedtuple('PaginaRenderizada', ['cuerpo', 'gzip', 'br'])
+
+# Se guarda una página por ETag (versión del catálogo + categoría + assets).
+# _paginas_lock solo protege los diccionarios; cada ETag tiene su propio lock
+# para que los requests que esperan la misma página no la rendericen dos veces
+_paginas_cache = {}
+_paginas_en_curso = {}
+_paginas_lock = threading.Lock()
+PAGINAS_CACHE_MAX = 64
+
+
+def comprimir_pagina(html):
+    """Codifica el HTML y guarda también sus versiones gzip y brotli (si está instalado)"""
+    cuerpo = html.encode('utf-8')
+    return PaginaRenderizada(
+        cuerpo=cuerpo,
+        gzip=gzip.compress(cuerpo, compresslevel=Config.PAGINAS_GZIP_NIVEL, mtime=0),
+        br=brotli.compress(cuerpo, quality=Config.PAGINAS_BROTLI_CALIDAD) if brotli else None
+    )
+
+
+def get_pagina_renderizada(etag, version, generar):
+    """
+    Devuelve la página del ETag, renderizándola y comprimiéndola solo la
+    primera vez. El render se hace fuera del lock global: solo esperan los
+    requests del mismo ETag. Cuando cambia la versión del catálogo se
+    descartan las páginas de versiones anteriores.
+    """
+    pagina = _paginas_cache.get(etag)
+    if pagina is not None:
+        return pagina[1]
+
+    with _paginas_lock:
+        lock_pagina = _paginas_en_curso.setdefault(etag, threading.Lock())
+
+    try:
+        with lock_pagina:
+            pagina = _paginas_cache.get(etag)
+            if pagina is not None:
+                return pagina[1]
+
+            renderizada = comprimir_pagina(generar())
+            with _paginas_lock:
+                for clave in [c for c, (v, _) in _paginas_cache.items() if v != version]:
+                    del _paginas_cache[clave]
+                if len(_paginas_cache) >= PAGINAS_CACHE_MAX:
+                    _paginas_cache.clear()
+                _paginas_cache[etag] = (version, renderizada)
+            return renderizada
+    finally:
+        with _paginas_lock:
+            if _paginas_en_curso.get(etag) is lock_pagina and not lock_pagina.locked():
+                del _paginas_en_curso[etag]
+
+
+def codificacion_pagina(pagina):
+    """Elige la mejor codificación que acepta el navegador: br, gzip o ninguna"""
+    if pagina.br is not None and request.accept_encodings['br']:
+        return 'br'
+    if request.accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def respuesta_pagina(pagina, codificacion):
+    """Arma la respuesta HTML con el cuerpo ya comprimido"""
+    if codificacion == 'br':
+        response = make_response(pagina.br)
+    elif codificacion == 'gzip':
+        response = make_response(pagina.gzip)
+    else:
+        response = make_response(pagina.cuerpo)
+    response.content_type = 'text/html; charset=utf-8'
+    if codificacion:
+        response.headers['Content-Encoding'] = codificacion
+    return response
 
 
 @app.route("/")
 def index():
     """Página principal con lista de productos"""
     try:
-        productos = get_productos()
-        
-        # Obtener categorías de la base de datos
-        categorias = []
+        catalogo = None
         try:
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT * FROM categoria ORDER BY nombre")
-                categorias = [dict(row) for row in cursor.fetchall()]
+            catalogo = get_catalogo()
         except Exception as e:
-            logger.error(f"Error al obtener categorías: {e}")
-        
-        return render_template(
-            "index.html",
-            productos=productos,
-            categorias=categorias,
-            config={
-                'pedido_minimo': Config.PEDIDO_MINIMO,
-                'whatsapp': Config.WHATSAPP_NUMBER
-            }
+            logger.error(f"Error al obtener catálogo: {e}")
+
+        # Solo se aceptan categorías existentes, así la caché no crece con cualquier ?cat=
+        categoria_activa = ''
+        cat = normalizar_categoria(request.args.get('cat', ''))
+        if catalogo and cat:
+            for categoria in catalogo.categorias:
+                if normalizar_categoria(categoria['nombre']) == cat:
+                    categoria_activa = categoria['nombre']
+                    break
+
+        def generar():
+            productos = ()
+            categorias = ()
+            if catalogo:
+                # En modo API la página no embebe el catálogo: index.js lo pide por páginas
+                if not Config.CATALOGO_API:
+                    productos = catalogo.productos
+                categorias = catalogo.categorias
+
+            return render_template(
+                "index.html",
+                productos=productos,
+                categorias=categorias,
+                categoria_activa=categoria_activa,
+                catalogo_api=Config.CATALOGO_API,
+                miniaturas_anchos=Config.MINIATURAS_ANCHOS,
+                config={
+                    'pedido_minimo': Config.PEDIDO_MINIMO,
+                    'whatsapp': Config.WHATSAPP_NUMBER
+                }
+            )
+
+        etag = etag_catalogo(
+            catalogo.version if catalogo else None,
+            ARCHIVOS_INDEX,
+            extra=f"api={Config.CATALOGO_API}|cat={categoria_activa}"
         )
+        if not etag:
+            # Sin versión del catálogo no se puede saber cuándo invalidar: se renderiza siempre
+            return respuesta_condicional(None, generar)
+
+        pagina = get_pagina_renderizada(etag, catalogo.version, generar)
+        codificacion = codificacion_pagina(pagina)
+
+        # Cada codificación es una representación distinta y lleva su propio ETag
+        if codificacion:
+            etag = f"{etag}-{codificacion}"
+        response = respuesta_condicional(etag, lambda: respuesta_pagina(pagina, codificacion))
+        response.vary.add('Accept-Encoding')
+        return response
     except Exception as e:
         logger.error(f"Error en página principal: {e}")
         return render_template("error.html", mensaje="Error al cargar productos"), 500
 
 
+def normalizar_texto(valor):
+    """Pasa a minúsculas y quita acentos (igual que normalizarTexto en index.js)"""
+    texto = unicodedata.normalize('NFD', str(valor or '').strip().lower())
+    return ''.join(c for c in texto if not unicodedata.combining(c))
+
+
+def patron_like(texto):
+    """Patrón '%texto%' para LIKE ... ESCAPE '\\' (el % y el _ del texto se buscan literales)"""
+    escapado = (texto or '').replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escapado}%"
+
+
+def normalizar_categoria(valor):
+    """
+    Normaliza una categoría con el mismo criterio que normalizarCategoriaValor
+    en index.js: juguetería y cotillón se muestran juntas.
+    """
+    texto = normalizar_texto(valor)
+    if 'jugueteria' in texto or 'cotillon' in texto:
+        return 'jugueteria/cotillon'
+    if 'libreria' in texto:
+        return 'libreria'
+    return texto
+
+
+# Ordenamientos permitidos para la API del catálogo
+ORDENES_CATALOGO = {
+    '': 'codigo ASC',
+    'precio-asc': 'precio ASC, codigo ASC',
+    'precio-desc': 'precio DESC, codigo ASC'
+}
+
+
+def buscar_pagina_catalogo(cursor, pagina, por_pagina, categoria='', texto='', orden=''):
+    """
+    Busca una página del catálogo activo con stock, filtrada y ordenada en SQL.
+    Retorna un dict con los productos de la página y los totales.
+    """
+    condiciones = ["activo = 1", "stock > 0"]
+    parametros = []
+
+    if categoria:
+        # Resolver las categorías reales que caen en la categoría pedida
+        cursor.execute("SELECT id, nombre FROM categoria")
+        ids = [
+            row['id'] for row in cursor.fetchall()
+            if normalizar_categoria(row['nombre']) == categoria
+        ]
+        if not ids:
+            return {'productos': [], 'pagina': 1, 'por_pagina': por_pagina, 'total': 0, 'total_paginas': 1}
+        condiciones.append(f"categoria_id IN ({', '.join('?' for _ in ids)})")
+        parametros.extend(ids)
+
+    consulta_fts = armar_consulta_fts(texto)
+    if consulta_fts and hay_indice_busqueda(cursor):
+        condiciones.append("id IN (SELECT rowid FROM producto_fts WHERE producto_fts MATCH ?)")
+        parametros.append(consulta_fts)
+    elif texto:
+        condiciones.append("titulo LIKE ? ESCAPE '\\'")
+        parametros.append(patron_like(texto))
+
+    where = " AND ".join(condiciones)
+    cursor.execute(f"SELECT COUNT(*) FROM producto WHERE {where}", parametros)
+    total = cursor.fetchone()[0]
+    total_paginas = max(1, -(-total // por_pagina))
+    pagina = min(pagina, total_paginas)
+
+    cursor.execute(f"""
+        SELECT id, codigo, titulo, precio, minimo, multiplo, stock, imagen, imagen_version, categoria
+        FROM vista_producto
+        WHERE {where}
+        ORDER BY {ORDENES_CATALOGO.get(orden, ORDENES_CATALOGO[''])}
+        LIMIT ? OFFSET ?
+    """, parametros + [por_pagina, (pagina - 1) * por_pagina])
+
+    return {
+        'productos': [dict(row) for row in cursor.fetchall()],
+        'pagina': pagina,
+        'por_pagina': por_pagina,
+        'total': total,
+        'total_paginas': total_paginas
+    }
+
+
+@app.route("/api/productos")
+def api_productos():
+    """
+    API paginada del catálogo para la tienda.
+    Parámetros: pagina, por_pagina, cat, q (búsqueda de texto) y orden.
+    Devuelve solo los productos de la página pedida más los totales.
+    """
+    try:
+        pagina = max(1, request.args.get('pagina', 1, type=int) or 1)
+        por_pagina = request.args.get('por_pagina', Config.PRODUCTOS_POR_PAGINA, type=int) or Config.PRODUCTOS_POR_PAGINA
+        por_pagina = min(max(1, por_pagina), Config.PRODUCTOS_POR_PAGINA_MAX)
+        categoria = normalizar_categoria(request.args.get('cat', ''))
+        texto = (request.args.get('q') or '').strip()
+        orden = request.args.get('orden', '')
+        if orden not in ORDENES_CATALOGO:
+            orden = ''
+
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+
+            # La página solo cambia si cambia el catálogo o los parámetros
+            etag = etag_catalogo(
+                obtener_version_catalogo(cursor),
+                extra=f"{pagina}|{por_pagina}|{categoria}|{texto}|{orden}"
+            )
+            return respuesta_condicional(etag, lambda: jsonify(
+                buscar_pagina_catalogo(cursor, pagina, por_pagina, categoria, texto, orden)
+            ))
+    except Exception as e:
+        logger.error(f"Error en API de catálogo: {e}")
+        return jsonify({'error': 'Error al obtener productos'}), 500
+
+
+# =============================================================================
+# BÚSQUEDA DE PRODUCTOS
+# =============================================================================
+
+# Peso de cada columna del índice en el ranking: código, título, descripción, categoría
+PESOS_BUSQUEDA = (10.0, 5.0, 1.0, 2.0)
+
+_fts_disponible = False
+
+
+def hay_indice_busqueda(cursor):
+    """Indica si la base tiene el índice FTS5 de productos"""
+    global _fts_disponible
+    if not _fts_disponible:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='producto_fts'")
+        _fts_disponible = cursor.fetchone() is not None
+    return _fts_disponible
+
+
+def armar_consulta_fts(texto):
+    """
+    Convierte lo que escribe el usuario en una consulta FTS5 segura:
+    cada palabra se busca por prefijo y todas tienen que estar.
+    Ej: 'muñe rosa' -> '"muñe"* "rosa"*'
+    """
+    palabras = re.findall(r'\w+', texto or '')
+    return ' '.join(f'"{palabra}"*' for palabra in palabras)
+
+
+def buscar_productos(cursor, texto, limite, solo_tienda=True):
+    """
+    Busca productos por código, título, descripción o categoría, ordenados
+    por relevancia. Con solo_tienda=True devuelve solo los activos con stock.
+    """
+    consulta = armar_consulta_fts(texto)
+    if not consulta:
+        return []
+
+    filtro_tienda = "AND p.activo = 1 AND p.stock > 0" if solo_tienda else ""
+
+    if hay_indice_busqueda(cursor):
+        cursor.execute(f"""
+            SELECT p.id, p.codigo, p.titulo, p.precio, p.minimo, p.multiplo,
+                   p.stock, p.imagen, p.imagen_version, p.categoria, p.activo
+            FROM producto_fts
+            JOIN vista_producto p ON p.id = producto_fts.rowid
+            WHERE producto_fts MATCH ? {filtro_tienda}
+            ORDER BY bm25(producto_fts, ?, ?, ?, ?)
+            LIMIT ?
+        """, (consulta, *PESOS_BUSQUEDA, limite))
+    else:
+        patron = patron_like(texto.strip())
+        cursor.execute(f"""
+            SELECT p.id, p.codigo, p.titulo, p.precio, p.minimo, p.multiplo,
+                   p.stock, p.imagen, p.imagen_version, p.categoria, p.activo
+            FROM vista_producto p
+            WHERE (p.codigo LIKE ? ESCAPE '\\' OR p.titulo LIKE ? ESCAPE '\\'
+                   OR p.descripcion LIKE ? ESCAPE '\\' OR p.categoria LIKE ? ESCAPE '\\')
+                  {filtro_tienda}
+            ORDER BY p.codigo
+            LIMIT ?
+        """, (patron, patron, patron, patron, limite))
+
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def limite_busqueda():
+    """Lee el parámetro 'limite' de la búsqueda respetando el máximo configurado"""
+    limite = request.args.get('limite', Config.BUSQUEDA_LIMITE, type=int) or Config.BUSQUEDA_LIMITE
+    return min(max(1, limite), Config.BUSQUEDA_LIMITE_MAX)
+
+
+@app.route("/api/buscar")
+def api_buscar():
+    """Búsqueda rápida de productos de la tienda, ordenada por relevancia"""
+    try:
+        texto = (request.args.get('q') or '').strip()
+        limite = limite_busqueda()
+
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            etag = etag_catalogo(obtener_version_catalogo(cursor), extra=f"buscar|{texto}|{limite}")
+            return respuesta_condicional(etag, lambda: jsonify(buscar_productos(cursor, texto, limite)))
+    except Exception as e:
+        logger.error(f"Error en búsqueda de productos: {e}")
+        return jsonify([]), 500
+
+
 @app.route("/carrito")
 def carrito_view():
     """Página del carrito de compras"""
     try:
-        # Obtener productos actualizados de la BD para sincronizar precios, stock e imágenes
-        # Usar código como clave porque los IDs cambian al reimportar Excel
-        productos_actualizados = {}
-        try:
-            with get_db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT id, codigo, precio, stock, minimo, multiplo, imagen FROM producto WHERE activo = 1 ORDER BY codigo DESC")
-                for row in cursor.fetchall():
-                    productos_actualizados[row['codigo']] = {
-                        'id': row['id'],
-                        'precio': row['precio'],
-                        'stock': row['stock'],
-                        'minimo': row['minimo'],
-                        'multiplo': row['multiplo'],
-                        'imagen': row['imagen']
-                    }
-        except Exception as db_error:
-            logger.warning(f"Error al obtener precios actualizados: {db_error}")
-        
-        return render_template(
-            "carrito.html",
-            productos_actualizados=productos_actualizados,
-            config={
-                'pedido_minimo': Config.PEDIDO_MINIMO,
-                'whatsapp': Config.WHATSAPP_NUMBER,
-                'local_direccion': Config.LOCAL_DIRECCION,
-                'local_horarios': Config.LOCAL_HORARIOS,
-                'envio_caba': Config.ENVIO_CABA,
-                'envio_gba': Config.ENVIO_GBA
-            }
-        )
+        # La página no depende del catálogo: carrito.js pide los precios
+        # de sus productos a /api/carrito/precios
+        def generar():
+            return render_template(
+                "carrito.html",
+                config={
+                    'pedido_minimo': Config.PEDIDO_MINIMO,
+                    'whatsapp': Config.WHATSAPP_NUMBER,
+                    'local_direccion': Config.LOCAL_DIRECCION,
+                    'local_horarios': Config.LOCAL_HORARIOS,
+                    'envio_caba': Config.ENVIO_CABA,
+                    'envio_gba': Config.ENVIO_GBA
+                }
+            )
+
+        return respuesta_condicional(etag_archivos(ARCHIVOS_CARRITO), generar)
     except Exception as e:
         logger.error(f"Error en página de carrito: {e}")
         return render_template("error.html", mensaje="Error al cargar carrito"), 500
 
 
+# Máximo de productos distintos que se aceptan en una sincronización del carrito
+MAX_CODIGOS_CARRITO = 500
+
+
+@app.route("/api/carrito/precios", methods=["POST"])
+def api_carrito_precios():
+    """
+    Devuelve precio, stock, mínimo, múltiplo e imagen actuales de los productos
+    del carrito, indexados por código (los IDs cambian al reimportar Excel).
+    Los códigos que no vienen en la respuesta ya no están disponibles.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        codigos = data.get('codigos')
+        if not isinstance(codigos, list):
+            return jsonify({'error': 'Se esperaba una lista de códigos'}), 400
+
+        codigos = list(dict.fromkeys(str(c) for c in codigos if c not in (None, '')))
+        if len(codigos) > MAX_CODIGOS_CARRITO:
+            return jsonify({'error': 'Demasiados productos en el carrito'}), 400
+        if not codigos:
+            return jsonify({})
+
+        placeholders = ', '.join('?' for _ in codigos)
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT id, codigo, precio, stock, minimo, multiplo, imagen, imagen_version
+                FROM producto
+                WHERE activo = 1 AND codigo IN ({placeholders})
+            """, codigos)
+            productos = {
+                row['codigo']: {
+                    'id': row['id'],
+                    'precio': row['precio'],
+                    'stock': row['stock'],
+                    'minimo': row['minimo'],
+                    'multiplo': row['multiplo'],
+                    'imagen': row['imagen'],
+                    'imagen_version': row['imagen_version']
+                }
+                for row in cursor.fetchall()
+            }
+
+        return jsonify(productos)
+    except Exception as e:
+        logger.error(f"Error al sincronizar precios del carrito: {e}")
+        return jsonify({'error': 'Error al obtener precios'}), 500
+
+
 @app.route("/enviar_pedido", methods=["POST"])
 def enviar_pedido():
     """
@@ -396,15 +1073,44 @@ def internal_error(e):
 # FUNCIONES AUXILIARES
 # =============================================================================
 
-def buscar_imagen_para_codigo(codigo):
+# Extensiones de imagen de producto, en orden de preferencia
+EXTENSIONES_IMAGEN = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+
+def indice_imagenes():
+    """
+    Lee la carpeta de imágenes una sola vez y devuelve {código: archivo},
+    con la misma preferencia de extensiones que buscar_imagen_para_codigo.
+    Para procesos que buscan la imagen de muchos productos (imports).
+    """
+    prioridad = {ext: i for i, ext in enumerate(EXTENSIONES_IMAGEN)}
+    indice = {}
+    try:
+        with os.scandir(Config.UPLOAD_FOLDER) as entradas:
+            for entrada in entradas:
+                codigo, ext = os.path.splitext(entrada.name)
+                if ext not in prioridad or not entrada.is_file():
+                    continue
+                actual = indice.get(codigo)
+                if actual is None or prioridad[ext] < prioridad[os.path.splitext(actual)[1]]:
+                    indice[codigo] = entrada.name
+    except OSError as e:
+        logger.error(f"Error al leer la carpeta de imágenes: {e}")
+    return indice
+
+
+def buscar_imagen_para_codigo(codigo, indice=None):
     """
     Busca si existe una imagen para el código dado en el almacenamiento persistente.
     Retorna el nombre del archivo si existe, o string vacío si no.
+    Con indice (de indice_imagenes) no accede al disco.
     """
-    extensiones = ['.jpg', '.jpeg', '.png', '.webp', '.gif']
+    if indice is not None:
+        return indice.get(codigo, '')
+    
     img_folder = Config.UPLOAD_FOLDER
     
-    for ext in extensiones:
+    for ext in EXTENSIONES_IMAGEN:
         img_filename = f"{codigo}{ext}"
         img_path = os.path.join(img_folder, img_filename)
         if os.path.exists(img_path):
@@ -413,39 +1119,228 @@ def buscar_imagen_para_codigo(codigo):
     return ""
 
 
+# =============================================================================
+# VERSIONES Y MINIATURAS DE IMÁGENES
+# =============================================================================
+
+# Las URLs con ?v=<hash> no cambian nunca de contenido: el navegador no revalida
+CACHE_CONTROL_INMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def hash_imagen(imagen):
+    """
+    Devuelve un hash corto del contenido de la imagen, que se guarda en
+    producto.imagen_version y va en la URL (?v=). Si la imagen se reemplaza,
+    cambia la URL y el navegador la vuelve a pedir.
+    Retorna None si la imagen no existe.
+    """
+    if not imagen:
+        return None
+    ruta = os.path.join(Config.UPLOAD_FOLDER, imagen)
+    try:
+        digest = hashlib.sha1()
+        with open(ruta, 'rb') as f:
+            for bloque in iter(lambda: f.read(65536), b''):
+                digest.update(bloque)
+        return digest.hexdigest()[:12]
+    except OSError:
+        return None
+
+
+# Formatos de las miniaturas: WebP y JPEG como alternativa para navegadores viejos
+FORMATOS_MINIATURA = {
+    'webp': {'formato': 'WEBP', 'opciones': {'quality': 80, 'method': 6}},
+    'jpg': {'formato': 'JPEG', 'opciones': {'quality': 82, 'optimize': True, 'progressive': True}},
+}
+
+
+def carpeta_miniaturas(ancho):
+    """Carpeta donde se guardan las miniaturas de un ancho dado"""
+    return os.path.join(Config.UPLOAD_FOLDER, 'miniaturas', str(ancho))
+
+
+def generar_miniaturas(imagen, forzar=False):
+    """
+    Genera las miniaturas de una imagen subida (cada ancho de
+    Config.MINIATURAS_ANCHOS, en WebP y JPEG) sin metadatos EXIF.
+    Se guardan como miniaturas/<ancho>/<codigo>.<formato>.
+    Retorna la cantidad de archivos generados.
+    """
+    if Image is None or not imagen:
+        return 0
+
+    origen = os.path.join(Config.UPLOAD_FOLDER, imagen)
+    base = os.path.splitext(os.path.basename(imagen))[0]
+    generadas = 0
+
+    try:
+        with Image.open(origen) as original:
+            # Respetar la orientación de la cámara antes de descartar el EXIF
+            original = ImageOps.exif_transpose(original)
+
+            # JPEG no tiene transparencia: usar fondo blanco
+            if original.mode in ('RGBA', 'LA', 'P'):
+                original = original.convert('RGBA')
+                fondo = Image.new('RGB', original.size, (255, 255, 255))
+                fondo.paste(original, mask=original.getchannel('A'))
+                original = fondo
+            elif original.mode != 'RGB':
+                original = original.convert('RGB')
+
+            for ancho in Config.MINIATURAS_ANCHOS:
+                carpeta = carpeta_miniaturas(ancho)
+                os.makedirs(carpeta, exist_ok=True)
+
+                variante = original
+                if original.width > ancho:
+                    alto = max(1, round(original.height * ancho / original.width))
+                    variante = original.resize((ancho, alto), Image.LANCZOS)
+
+                for extension, formato in FORMATOS_MINIATURA.items():
+                    destino = os.path.join(carpeta, f"{base}.{extension}")
+                    if not forzar and os.path.exists(destino) and os.path.getmtime(destino) >= os.path.getmtime(origen):
+                        continue
+                    variante.save(destino, formato['formato'], **formato['opciones'])
+                    generadas += 1
+    except Exception as e:
+        logger.warning(f"No se pudieron generar miniaturas de {imagen}: {e}")
+
+    return generadas
+
+
+def imagen_de_miniatura(base):
+    """
+    Busca la imagen original de una miniatura (que se llama como la original
+    sin extensión) entre las imágenes de los productos, así sirve con
+    cualquier nombre de archivo o extensión (.JPG, espacios, acentos). Si
+    ningún producto la usa, la busca como imagen de un código.
+    Retorna el nombre del archivo, o '' si no hay ninguno en el disco.
+    """
+    with get_db_connection() as conn:
+        # Los nombres que empiezan con '<base>.' ('/' es el carácter que sigue al '.')
+        filas = conn.execute(
+            "SELECT DISTINCT imagen FROM producto WHERE imagen >= ? AND imagen < ?",
+            (f"{base}.", f"{base}/")
+        ).fetchall()
+    for row in filas:
+        imagen = row['imagen']
+        if os.path.splitext(imagen)[0] == base and os.path.isfile(os.path.join(Config.UPLOAD_FOLDER, imagen)):
+            return imagen
+    return buscar_imagen_para_codigo(secure_filename(base))
+
+
+def eliminar_miniaturas(imagen):
+    """Borra las miniaturas de una imagen que ya no se usa"""
+    if not imagen:
+        return
+    base = os.path.splitext(os.path.basename(imagen))[0]
+    for ancho in Config.MINIATURAS_ANCHOS:
+        for extension in FORMATOS_MINIATURA:
+            ruta = os.path.join(carpeta_miniaturas(ancho), f"{base}.{extension}")
+            if os.path.exists(ruta):
+                try:
+                    os.remove(ruta)
+                except OSError as e:
+                    logger.warning(f"No se pudo eliminar la miniatura {ruta}: {e}")
+
+
+@app.cli.command("generar-miniaturas")
+def cli_generar_miniaturas():
+    """Genera las miniaturas faltantes de todas las imágenes de UPLOAD_FOLDER"""
+    if Image is None:
+        print("❌ Pillow no está instalado: pip install Pillow")
+        return
+
+    extensiones = tuple(f".{ext}" for ext in Config.ALLOWED_EXTENSIONS)
+    imagenes = 0
+    archivos = 0
+    for nombre in sorted(os.listdir(Config.UPLOAD_FOLDER)):
+        ruta = os.path.join(Config.UPLOAD_FOLDER, nombre)
+        if os.path.isfile(ruta) and nombre.lower().endswith(extensiones):
+            imagenes += 1
+            archivos += generar_miniaturas(nombre)
+
+    print(f"✓ {imagenes} imágenes revisadas, {archivos} miniaturas generadas")
+
+
+@app.cli.command("versionar-imagenes")
+def cli_versionar_imagenes():
+    """
+    Recalcula imagen_version de todos los productos con imagen y actualiza
+    las que cambiaron (por ejemplo, imágenes reemplazadas por SFTP). Si una
+    imagen cambió se regeneran sus miniaturas.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT imagen, GROUP_CONCAT(DISTINCT COALESCE(imagen_version, '')) AS versiones
+            FROM producto
+            WHERE imagen IS NOT NULL AND imagen != ''
+            GROUP BY imagen
+        """)
+        imagenes = cursor.fetchall()
+
+        actualizadas = 0
+        reemplazadas = []
+        for row in imagenes:
+            version = hash_imagen(row['imagen'])
+            if not version or row['versiones'] == version:
+                continue
+            cursor.execute(
+                "UPDATE producto SET imagen_version = ? WHERE imagen = ? AND imagen_version IS NOT ?",
+                (version, row['imagen'], version)
+            )
+            actualizadas += 1
+            if row['versiones']:
+                reemplazadas.append(row['imagen'])
+        conn.commit()
+
+    # Las miniaturas viejas se sirven como inmutables: rehacerlas aunque la
+    # copia haya conservado la fecha del archivo
+    for imagen in reemplazadas:
+        generar_miniaturas(imagen, forzar=True)
+
+    print(f"✓ {len(imagenes)} imágenes revisadas, {actualizadas} versionadas ({len(reemplazadas)} reemplazadas)")
+
+
+def formatear_codigo_producto(numero):
+    """Formatea el número de un código automático (222 -> A0222)"""
+    return f"A{numero:04d}"
+
+
+def reservar_codigos_producto(cursor, cantidad=1):
+    """
+    Reserva códigos de producto consecutivos avanzando producto_secuencia.
+    El UPDATE toma el lock de escritura, así que llamarla dentro de la
+    transacción que inserta los productos evita códigos repetidos entre
+    workers. Un código reservado no se reutiliza aunque se haga rollback.
+    """
+    if cantidad < 1:
+        return []
+    cursor.execute("UPDATE producto_secuencia SET ultimo = ultimo + ? WHERE id = 1", (cantidad,))
+    cursor.execute("SELECT ultimo FROM producto_secuencia WHERE id = 1")
+    ultimo = cursor.fetchone()[0]
+    return [formatear_codigo_producto(numero) for numero in range(ultimo - cantidad + 1, ultimo + 1)]
+
+
 def generar_codigo_producto():
-    """Genera el siguiente código de producto automáticamente (formato A0XXX)"""
+    """
+    Próximo código de producto (formato A0XXX) para mostrar en el formulario.
+    No lo reserva: el código definitivo se asigna al guardar.
+    """
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            # Obtener el último código que empiece con 'A0'
-            cursor.execute("""
-                SELECT codigo FROM producto 
-                WHERE codigo LIKE 'A0%' 
-                ORDER BY CAST(SUBSTR(codigo, 2) AS INTEGER) DESC 
-                LIMIT 1
-            """)
+            cursor.execute("SELECT ultimo FROM producto_secuencia WHERE id = 1")
             result = cursor.fetchone()
-            
-            if result:
-                ultimo_codigo = result['codigo']
-                # Extraer el número del código (A0222 -> 222)
-                numero = int(ultimo_codigo[1:])
-                nuevo_numero = numero + 1
-            else:
-                # Si no hay códigos, empezar desde 1
-                nuevo_numero = 1
-            
-            # Formatear el nuevo código (A0001, A0222, etc)
-            nuevo_codigo = f"A{nuevo_numero:04d}"
-            return nuevo_codigo
+            return formatear_codigo_producto((result[0] if result else 0) + 1)
     except Exception as e:
         logger.error(f"Error al generar código: {e}")
         return "A0001"
 
 
 def init_database():
-    """Inicializa las tablas necesarias en la base de datos"""
+    """Verifica la base de datos al arrancar y aplica las migraciones pendientes"""
     try:
         # Verificar que la DB ya existe antes de conectar
         # (sqlite3.connect crea una DB nueva si no existe, lo cual queremos evitar)
@@ -471,110 +1366,1147 @@ def init_database():
                 return
             
             logger.info("✓ Tabla 'producto' encontrada en la base de datos")
+
+        # Esquema: solo se aplican las migraciones pendientes (normalmente ninguna).
+        # Si una falla la app no arranca: el código cuenta con el esquema nuevo
+        if Config.MIGRAR_AL_INICIAR:
+            try:
+                aplicar_migraciones()
+            except Exception as e:
+                raise RuntimeError(f"No se pudo migrar la base de datos: {e}") from e
+
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
             
-            # Crear tabla categorías si no existe
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS categoria (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    nombre TEXT NOT NULL UNIQUE,
-                    fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+            # Verificar si hay pedidos existentes
+            cursor.execute("SELECT COUNT(*) as count FROM pedido")
+            count = cursor.fetchone()[0]
             
-            # Crear tabla productos_nuevos si no existe
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS producto_nuevo (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    producto_id INTEGER NOT NULL,
-                    fecha_agregado TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (producto_id) REFERENCES producto(id)
-                )
-            """)
+            # Si no hay pedidos, configurar el AUTOINCREMENT para empezar en 1200
+            if count == 0:
+                cursor.execute("INSERT OR REPLACE INTO sqlite_sequence (name, seq) VALUES ('pedido', 1199)")
+            else:
+                # Si ya hay pedidos, verificar que el próximo ID sea al menos 1200
+                cursor.execute("SELECT MAX(id) as max_id FROM pedido")
+                max_id = cursor.fetchone()[0]
+                if max_id is None or max_id < 1199:
+                    cursor.execute("INSERT OR REPLACE INTO sqlite_sequence (name, seq) VALUES ('pedido', 1199)")
             
-            # Crear tabla pedidos si no existe
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS pedido (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    cliente_nombre TEXT NOT NULL,
-                    cliente_cuit TEXT,
-                    cliente_telefono TEXT,
-                    cliente_email TEXT,
-                    cliente_direccion TEXT,
-                    metodo_entrega TEXT,
-                    envio_direccion TEXT,
-                    envio_localidad TEXT,
-                    envio_provincia TEXT,
-                    envio_cp TEXT,
-                    envio_nombre_destinatario TEXT,
-                    envio_dni_destinatario TEXT,
-                    envio_referencias TEXT,
-                    productos TEXT NOT NULL,
-                    total REAL NOT NULL,
-                    estado TEXT DEFAULT 'pendiente'
+            conn.commit()
+            logger.info("✓ Base de datos inicializada correctamente")
+    except RuntimeError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error al inicializar base de datos: {e}")
+        logger.warning("⚠️  La app arrancará de todos modos sin base de datos.")
+
+
+# =============================================================================
+# MIGRACIONES DEL ESQUEMA
+# =============================================================================
+
+def agregar_columna(cursor, tabla, columna, definicion):
+    """Agrega la columna a la tabla si todavía no existe"""
+    cursor.execute(f"PRAGMA table_info({tabla})")
+    if columna not in [row['name'] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {definicion}")
+
+
+def _migracion_tablas_base(cursor):
+    """Tablas de categorías, productos nuevos y pedidos, con sus columnas agregadas después"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS categoria (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nombre TEXT NOT NULL UNIQUE,
+            fecha_creacion TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS producto_nuevo (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            producto_id INTEGER NOT NULL,
+            fecha_agregado TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (producto_id) REFERENCES producto(id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pedido (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            cliente_nombre TEXT NOT NULL,
+            cliente_cuit TEXT,
+            cliente_telefono TEXT,
+            cliente_email TEXT,
+            cliente_direccion TEXT,
+            metodo_entrega TEXT,
+            envio_direccion TEXT,
+            envio_localidad TEXT,
+            envio_provincia TEXT,
+            envio_cp TEXT,
+            envio_nombre_destinatario TEXT,
+            envio_dni_destinatario TEXT,
+            envio_referencias TEXT,
+            productos TEXT NOT NULL,
+            total REAL NOT NULL,
+            estado TEXT DEFAULT 'pendiente'
+        )
+    """)
+
+    agregar_columna(cursor, 'producto', 'activo', 'INTEGER NOT NULL DEFAULT 1')
+    # Hash del contenido de la imagen para URLs cacheables para siempre
+    agregar_columna(cursor, 'producto', 'imagen_version', 'TEXT')
+    for columna in ('envio_direccion', 'envio_localidad', 'envio_provincia', 'envio_cp',
+                    'envio_nombre_destinatario', 'envio_dni_destinatario', 'envio_referencias'):
+        agregar_columna(cursor, 'pedido', columna, 'TEXT')
+
+
+def _migracion_indices_catalogo(cursor):
+    """Índices de la API paginada del catálogo"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_producto_activo_categoria ON producto(activo, categoria)")
+
+
+def _migracion_version_catalogo(cursor):
+    """
+    Versión del catálogo: la incrementan los triggers de producto y
+    categoria, así cada worker sabe cuándo recargar su caché
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS catalogo_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO catalogo_version (id, version) VALUES (1, 0)")
+    for tabla in ('producto', 'categoria'):
+        for evento in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{tabla}_{evento.lower()}_version
+                AFTER {evento} ON {tabla}
+                BEGIN
+                    UPDATE catalogo_version SET version = version + 1 WHERE id = 1;
+                END
+            """)
+
+
+def codigos_repetidos(cursor, limite=10):
+    """Códigos de producto que aparecen más de una vez (hasta limite)"""
+    cursor.execute("""
+        SELECT codigo FROM producto
+        WHERE codigo IS NOT NULL
+        GROUP BY codigo HAVING COUNT(*) > 1
+        LIMIT ?
+    """, (limite,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def hay_codigo_unico(cursor):
+    """True si ya existe el índice único por código de producto"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_producto_codigo_unico'")
+    return cursor.fetchone() is not None
+
+
+def asegurar_codigo_unico(cursor):
+    """
+    Crea el índice único por código si todavía no existe. Con códigos
+    repetidos no se puede crear: se deja el índice simple, se avisa en el
+    log y se vuelve a intentar en el próximo arranque. Retorna True si el
+    índice único existe.
+    """
+    if hay_codigo_unico(cursor):
+        return True
+    duplicados = codigos_repetidos(cursor)
+    if duplicados:
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_producto_codigo ON producto(codigo)")
+        logger.warning(
+            "⚠️  Hay códigos de producto repetidos, el índice único queda pendiente "
+            f"hasta corregirlos: {', '.join(map(str, duplicados))}"
+        )
+        return False
+    cursor.execute("CREATE UNIQUE INDEX idx_producto_codigo_unico ON producto(codigo)")
+    # El índice único reemplaza al índice simple por código
+    cursor.execute("DROP INDEX IF EXISTS idx_producto_codigo")
+    return True
+
+
+def _migracion_indices_consultas(cursor):
+    """
+    Índices de las consultas frecuentes: catálogo activo con stock ordenado
+    por código, código único de producto y pedidos por fecha y por estado.
+    Los códigos repetidos no frenan la migración (ver asegurar_codigo_unico).
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_producto_activo_stock_codigo ON producto(activo, stock, codigo)")
+    asegurar_codigo_unico(cursor)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedido_fecha ON pedido(fecha)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedido_estado ON pedido(estado)")
+
+
+def _migracion_clave_telefono(cursor):
+    """Clave del cliente (últimos dígitos del teléfono) guardada e indexada en cada pedido"""
+    agregar_columna(cursor, 'pedido', 'cliente_telefono_clave', 'TEXT')
+    cursor.execute("SELECT id, cliente_telefono FROM pedido")
+    cursor.executemany(
+        "UPDATE pedido SET cliente_telefono_clave = ? WHERE id = ?",
+        [(normalizar_telefono(row['cliente_telefono']), row['id']) for row in cursor.fetchall()]
+    )
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedido_cliente_telefono_clave ON pedido(cliente_telefono_clave)")
+
+
+def _migracion_estado_canonico(cursor):
+    """
+    Estados de pedido en forma canónica, validados por triggers (SQLite no
+    permite agregar un CHECK a una tabla existente) e indexados con la fecha.
+    Los estados desconocidos pasan a 'pendiente'.
+    """
+    cursor.execute("SELECT estado, COUNT(*) AS cantidad FROM pedido GROUP BY estado")
+    for row in cursor.fetchall():
+        canonico = normalizar_estado(row['estado'], por_defecto='pendiente')
+        if canonico == row['estado']:
+            continue
+        if normalizar_texto(row['estado']) and normalizar_estado(row['estado']) is None:
+            logger.warning(f"⚠️  Estado desconocido {row['estado']!r} en {row['cantidad']} pedidos: pasa a 'pendiente'")
+        cursor.execute("UPDATE pedido SET estado = ? WHERE estado IS ?", (canonico, row['estado']))
+
+    # La lista queda fija en los triggers: si cambian los estados hace falta una migración nueva
+    estados = ', '.join(f"'{estado}'" for estado in ESTADOS_PEDIDO)
+    for evento in ('INSERT', 'UPDATE OF estado'):
+        nombre = evento.split()[0].lower()
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_pedido_{nombre}_estado
+            BEFORE {evento} ON pedido
+            WHEN NEW.estado IS NULL OR NEW.estado NOT IN ({estados})
+            BEGIN
+                SELECT RAISE(ABORT, 'Estado de pedido inválido');
+            END
+        """)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedido_estado_fecha ON pedido(estado, fecha)")
+    # El índice compuesto cubre las búsquedas que hacía el índice solo por estado
+    cursor.execute("DROP INDEX IF EXISTS idx_pedido_estado")
+
+
+def _migracion_categoria_id(cursor):
+    """
+    Los productos referencian a su categoría por id. producto.categoria queda
+    como copia del nombre (la usan el índice de búsqueda, la tienda y los
+    Excel) y la mantienen los triggers: al guardar un producto se resuelve
+    (o crea) su categoría, y al renombrar una categoría se actualiza el nombre
+    en sus productos. (Los triggers no usan INSERT OR IGNORE porque cada
+    inserción ignorada igual avanza el AUTOINCREMENT.)
+    """
+    cursor.execute("""
+        INSERT OR IGNORE INTO categoria (nombre)
+        SELECT DISTINCT categoria FROM producto
+        WHERE categoria IS NOT NULL AND categoria != ''
+    """)
+    agregar_columna(cursor, 'producto', 'categoria_id', 'INTEGER REFERENCES categoria(id)')
+    cursor.execute("""
+        UPDATE producto
+        SET categoria_id = (SELECT id FROM categoria WHERE nombre = producto.categoria)
+    """)
+
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_producto_insert_categoria
+        AFTER INSERT ON producto
+        BEGIN
+            INSERT INTO categoria (nombre)
+            SELECT NEW.categoria
+            WHERE NEW.categoria IS NOT NULL AND NEW.categoria != ''
+              AND NOT EXISTS (SELECT 1 FROM categoria WHERE nombre = NEW.categoria);
+            UPDATE producto
+            SET categoria_id = (SELECT id FROM categoria WHERE nombre = NEW.categoria)
+            WHERE id = NEW.id
+              AND categoria_id IS NOT (SELECT id FROM categoria WHERE nombre = NEW.categoria);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_producto_update_categoria
+        AFTER UPDATE OF categoria ON producto
+        WHEN NEW.categoria IS NOT OLD.categoria
+        BEGIN
+            INSERT INTO categoria (nombre)
+            SELECT NEW.categoria
+            WHERE NEW.categoria IS NOT NULL AND NEW.categoria != ''
+              AND NOT EXISTS (SELECT 1 FROM categoria WHERE nombre = NEW.categoria);
+            UPDATE producto
+            SET categoria_id = (SELECT id FROM categoria WHERE nombre = NEW.categoria)
+            WHERE id = NEW.id
+              AND categoria_id IS NOT (SELECT id FROM categoria WHERE nombre = NEW.categoria);
+        END
+    """)
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_categoria_update_nombre
+        AFTER UPDATE OF nombre ON categoria
+        WHEN NEW.nombre IS NOT OLD.nombre
+        BEGIN
+            UPDATE producto SET categoria = NEW.nombre WHERE categoria_id = NEW.id;
+        END
+    """)
+
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_producto_activo_categoria_id ON producto(activo, categoria_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_producto_categoria_id ON producto(categoria_id)")
+    # Los filtros por categoría ahora usan categoria_id
+    cursor.execute("DROP INDEX IF EXISTS idx_producto_activo_categoria")
+
+
+# Nombre de la categoría de un producto ('' si no tiene), a partir de su categoria_id
+NOMBRE_CATEGORIA = "COALESCE((SELECT nombre FROM categoria WHERE id = {id}), '')"
+
+
+def crear_vista_producto(cursor):
+    """
+    (Re)crea vista_producto: las columnas de producto más el nombre de su
+    categoría como 'categoria'. Las lecturas que muestran la categoría usan
+    la vista, así que renombrar una categoría no escribe en producto.
+    Se arma con las columnas actuales: una migración que agregue columnas a
+    producto tiene que volver a llamarla.
+    """
+    cursor.execute("DROP VIEW IF EXISTS vista_producto")
+    cursor.execute("PRAGMA table_info(producto)")
+    columnas = [f"p.{row['name']}" for row in cursor.fetchall() if row['name'] != 'categoria']
+    cursor.execute(f"""
+        CREATE VIEW vista_producto AS
+        SELECT {', '.join(columnas)}, {NOMBRE_CATEGORIA.format(id='p.categoria_id')} AS categoria
+        FROM producto p
+    """)
+
+
+def _migracion_ventas_diarias(cursor):
+    """Resumen de ventas por día que mantienen los triggers de pedido"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ventas_diarias (
+            dia TEXT PRIMARY KEY,
+            cantidad INTEGER NOT NULL DEFAULT 0,
+            monto REAL NOT NULL DEFAULT 0,
+            facturado REAL NOT NULL DEFAULT 0,
+            por_facturar REAL NOT NULL DEFAULT 0
+        )
+    """)
+    crear_triggers_ventas_diarias(cursor)
+    reconstruir_ventas_diarias(cursor)
+
+
+def _migracion_version_pedidos(cursor):
+    """Versión de los pedidos (como catalogo_version) para invalidar cachés del admin"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pedidos_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """)
+    cursor.execute("INSERT OR IGNORE INTO pedidos_version (id, version) VALUES (1, 0)")
+    for evento in ('INSERT', 'UPDATE', 'DELETE'):
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_pedido_{evento.lower()}_version
+            AFTER {evento} ON pedido
+            BEGIN
+                UPDATE pedidos_version SET version = version + 1 WHERE id = 1;
+            END
+        """)
+
+
+def _migracion_secuencia_codigos(cursor):
+    """
+    Último número de código automático (A0XXX) asignado. Los triggers la
+    adelantan si se inserta un código mayor a mano o desde un import.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS producto_secuencia (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            ultimo INTEGER NOT NULL
+        )
+    """)
+    es_automatico = "{codigo} GLOB 'A[0-9]*' AND NOT SUBSTR({codigo}, 2) GLOB '*[^0-9]*'"
+    cursor.execute(f"""
+        INSERT OR IGNORE INTO producto_secuencia (id, ultimo)
+        SELECT 1, COALESCE(MAX(CAST(SUBSTR(codigo, 2) AS INTEGER)), 0)
+        FROM producto
+        WHERE {es_automatico.format(codigo='codigo')}
+    """)
+    for evento in ('INSERT', 'UPDATE OF codigo'):
+        nombre = evento.split()[0].lower()
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_producto_{nombre}_secuencia
+            AFTER {evento} ON producto
+            WHEN {es_automatico.format(codigo='NEW.codigo')}
+            BEGIN
+                UPDATE producto_secuencia SET ultimo = CAST(SUBSTR(NEW.codigo, 2) AS INTEGER)
+                WHERE id = 1 AND ultimo < CAST(SUBSTR(NEW.codigo, 2) AS INTEGER);
+            END
+        """)
+
+
+def _migracion_fts_solo_cambios(cursor):
+    """Recrea el trigger de actualización del índice de búsqueda con su condición"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='producto_fts'")
+    if cursor.fetchone():
+        cursor.execute("DROP TRIGGER IF EXISTS trg_producto_fts_update")
+        crear_indice_busqueda(cursor, categoria_por_id=False)
+
+
+def _migracion_clientes(cursor):
+    """Clientes agrupados por la clave del teléfono, con sus pedidos concretados"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS cliente (
+            clave TEXT PRIMARY KEY,
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            total_gastado REAL NOT NULL DEFAULT 0,
+            primer_pedido TEXT,
+            ultimo_pedido TEXT,
+            nombre TEXT,
+            telefono TEXT,
+            nombres TEXT NOT NULL DEFAULT '[]',
+            telefonos TEXT NOT NULL DEFAULT '[]',
+            emails TEXT NOT NULL DEFAULT '[]'
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cliente_pedidos_total ON cliente(pedidos, total_gastado)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_cliente_ultimo_pedido ON cliente(ultimo_pedido)")
+    crear_triggers_cliente(cursor)
+    reconstruir_clientes(cursor)
+
+
+def _migracion_orden_datos_cliente(cursor):
+    """Recrea los triggers de cliente con los datos conocidos en orden de aparición"""
+    for trigger in ('trg_pedido_insert_cliente', 'trg_pedido_delete_cliente', 'trg_pedido_update_cliente'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    crear_triggers_cliente(cursor)
+    reconstruir_clientes(cursor)
+
+
+def _migracion_ventas_producto(cursor):
+    """Totales por producto (y por producto y día) para los más vendidos"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ventas_producto (
+            codigo TEXT PRIMARY KEY,
+            titulo TEXT,
+            titulo_item INTEGER,
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            unidades INTEGER NOT NULL DEFAULT 0,
+            monto REAL NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ventas_producto_unidades ON ventas_producto(unidades)")
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ventas_producto_diarias (
+            codigo TEXT NOT NULL,
+            dia TEXT NOT NULL,
+            titulo TEXT,
+            titulo_item INTEGER,
+            pedidos INTEGER NOT NULL DEFAULT 0,
+            unidades INTEGER NOT NULL DEFAULT 0,
+            monto REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (codigo, dia)
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_ventas_producto_diarias_dia ON ventas_producto_diarias(dia)")
+    crear_triggers_ventas_producto(cursor)
+    reconstruir_ventas_producto(cursor)
+
+
+def _migracion_titulo_ventas_producto(cursor):
+    """
+    Título de las ventas por producto tomado del último ítem contado, con la
+    misma regla en los triggers y en la reconstrucción
+    """
+    for tabla in ('ventas_producto', 'ventas_producto_diarias'):
+        agregar_columna(cursor, tabla, 'titulo_item', 'INTEGER')
+    # Para buscar el ítem anterior cuando se resta el que daba el título
+    cursor.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_pedido_item_clave_ventas
+        ON pedido_item({CLAVE_ITEM_VENTAS.replace('i.', '')})
+    """)
+    for trigger in ('trg_pedido_item_insert_ventas', 'trg_pedido_item_delete_ventas',
+                    'trg_pedido_delete_ventas_producto', 'trg_pedido_update_ventas_producto'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    crear_triggers_ventas_producto(cursor)
+    reconstruir_ventas_producto(cursor)
+
+
+def _migracion_categoria_por_id(cursor):
+    """
+    La categoría de cada producto queda solo en categoria_id: se borra la
+    copia del nombre en producto.categoria (y los triggers que la mantenían)
+    y las lecturas pasan a vista_producto. El índice de búsqueda se recrea
+    sobre la vista.
+    """
+    for trigger in ('trg_producto_insert_categoria', 'trg_producto_update_categoria', 'trg_categoria_update_nombre',
+                    'trg_producto_fts_insert', 'trg_producto_fts_delete', 'trg_producto_fts_update'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='producto_fts'")
+    habia_indice = cursor.fetchone() is not None
+    cursor.execute("DROP TABLE IF EXISTS producto_fts")
+
+    cursor.execute("PRAGMA table_info(producto)")
+    if 'categoria' in [row['name'] for row in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE producto DROP COLUMN categoria")
+    crear_vista_producto(cursor)
+    if habia_indice:
+        crear_indice_busqueda(cursor)
+
+
+def _migracion_indice_imagen(cursor):
+    """Índice por imagen: las miniaturas buscan su original por nombre de archivo"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_producto_imagen ON producto(imagen)")
+
+
+def _migracion_ventas_sin_fecha(cursor):
+    """Recrea los triggers de ventas diarias para contar también los pedidos sin fecha válida"""
+    for trigger in ('trg_pedido_insert_ventas', 'trg_pedido_delete_ventas', 'trg_pedido_update_ventas'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    crear_triggers_ventas_diarias(cursor)
+    reconstruir_ventas_diarias(cursor)
+
+
+def _migracion_clientes_sin_datos_conocidos(cursor):
+    """
+    Los nombres, teléfonos y emails conocidos de cada cliente se arman al
+    mostrarlos: se sacan de la tabla cliente y de sus triggers
+    """
+    for trigger in ('trg_pedido_insert_cliente', 'trg_pedido_delete_cliente', 'trg_pedido_update_cliente'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+    cursor.execute("PRAGMA table_info(cliente)")
+    columnas = [row['name'] for row in cursor.fetchall()]
+    for columna in ('nombres', 'telefonos', 'emails'):
+        if columna in columnas:
+            cursor.execute(f"ALTER TABLE cliente DROP COLUMN {columna}")
+    crear_triggers_cliente(cursor)
+    reconstruir_clientes(cursor)
+
+
+# Migraciones en orden: (versión, descripción, función). Nunca modificar una
+# ya publicada; los cambios nuevos van en una migración nueva al final.
+MIGRACIONES = [
+    (1, 'Tablas base y columnas agregadas', _migracion_tablas_base),
+    (2, 'Índices del catálogo', _migracion_indices_catalogo),
+    (3, 'Índice de búsqueda FTS5', lambda cursor: crear_indice_busqueda(cursor, categoria_por_id=False)),
+    (4, 'Versión del catálogo', _migracion_version_catalogo),
+    (5, 'Ítems de pedidos', lambda cursor: crear_tabla_pedido_item(cursor)),
+    (6, 'Índices de consultas frecuentes', _migracion_indices_consultas),
+    (7, 'Clave de teléfono del cliente en pedidos', _migracion_clave_telefono),
+    (8, 'Estado de pedido canónico', _migracion_estado_canonico),
+    (9, 'Categoría de producto por id', _migracion_categoria_id),
+    (10, 'Resumen de ventas diarias', _migracion_ventas_diarias),
+    (11, 'Versión de los pedidos', _migracion_version_pedidos),
+    (12, 'Ventas por producto', _migracion_ventas_producto),
+    (13, 'Secuencia de códigos de producto', _migracion_secuencia_codigos),
+    (14, 'Tabla de clientes', _migracion_clientes),
+    (15, 'Reindexar la búsqueda solo si cambia el texto', _migracion_fts_solo_cambios),
+    (16, 'Título de ventas por producto del último ítem', _migracion_titulo_ventas_producto),
+    (17, 'Datos de cliente en orden de aparición', _migracion_orden_datos_cliente),
+    (18, 'Nombre de categoría leído por id', _migracion_categoria_por_id),
+    (19, 'Índice por imagen de producto', _migracion_indice_imagen),
+    (20, 'Pedidos sin fecha válida en las ventas diarias', _migracion_ventas_sin_fecha),
+    (21, 'Datos conocidos de clientes armados al mostrarlos', _migracion_clientes_sin_datos_conocidos),
+]
+
+
+def obtener_version_esquema(cursor):
+    """Última migración aplicada (0 si no hay ninguna)"""
+    cursor.execute("SELECT MAX(version) FROM schema_version")
+    return cursor.fetchone()[0] or 0
+
+
+def aplicar_migraciones():
+    """
+    Aplica en orden las migraciones pendientes, cada una en su transacción.
+    BEGIN IMMEDIATE toma el lock de escritura antes de volver a leer la
+    versión, así si varios workers arrancan juntos cada migración corre una
+    sola vez. Si una falla se detiene, las siguientes quedan pendientes y se
+    relanza el error. Retorna la cantidad de migraciones aplicadas.
+    """
+    aplicadas = 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                descripcion TEXT,
+                aplicada_en TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+
+        if obtener_version_esquema(cursor) >= MIGRACIONES[-1][0]:
+            # El índice único por código puede haber quedado pendiente
+            if not hay_codigo_unico(cursor):
+                cursor.execute("BEGIN IMMEDIATE")
+                asegurar_codigo_unico(cursor)
+                conn.commit()
+            return 0
+
+        for version, descripcion, migracion in MIGRACIONES:
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                if obtener_version_esquema(cursor) >= version:
+                    conn.rollback()
+                    continue
+                migracion(cursor)
+                cursor.execute(
+                    "INSERT INTO schema_version (version, descripcion) VALUES (?, ?)",
+                    (version, descripcion)
                 )
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.error(f"❌ Error en la migración {version} ({descripcion}): {e}")
+                raise
+            aplicadas += 1
+            logger.info(f"✓ Migración {version} aplicada: {descripcion}")
+    return aplicadas
+
+
+@app.cli.command("migrar-db")
+def migrar_db_command():
+    """Aplica las migraciones pendientes del esquema de la base de datos"""
+    try:
+        aplicadas = aplicar_migraciones()
+    except Exception as e:
+        print(f"❌ Error al migrar: {e}")
+        return
+    with get_db_connection() as conn:
+        version = obtener_version_esquema(conn.cursor())
+    print(f"✓ {aplicadas} migraciones aplicadas, esquema en versión {version}")
+
+
+def crear_indice_busqueda(cursor, categoria_por_id=True):
+    """
+    Crea el índice FTS5 de productos (código, título, descripción y categoría)
+    y los triggers que lo mantienen sincronizado con la tabla producto.
+    remove_diacritics hace que 'jugueteria' encuentre 'juguetería'.
+    El contenido es vista_producto (la categoría se lee por categoria_id) y
+    al renombrar una categoría se reindexan solo sus productos en el índice.
+    Con categoria_por_id=False indexa la columna de texto producto.categoria,
+    como las migraciones anteriores a la vista.
+    Si el SQLite del servidor no tiene FTS5, la búsqueda usa LIKE.
+    """
+    if categoria_por_id:
+        contenido, columna_categoria = 'vista_producto', 'categoria_id'
+        categoria = {fila: NOMBRE_CATEGORIA.format(id=f'{fila}.categoria_id') for fila in ('new', 'old')}
+    else:
+        contenido, columna_categoria = 'producto', 'categoria'
+        categoria = {fila: f'{fila}.categoria' for fila in ('new', 'old')}
+
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='producto_fts'")
+    existia = cursor.fetchone() is not None
+
+    try:
+        cursor.execute(f"""
+            CREATE VIRTUAL TABLE IF NOT EXISTS producto_fts USING fts5(
+                codigo, titulo, descripcion, categoria,
+                content='{contenido}', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logger.warning(f"⚠️  FTS5 no disponible, la búsqueda usará LIKE: {e}")
+        return
+
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_producto_fts_insert AFTER INSERT ON producto
+        BEGIN
+            INSERT INTO producto_fts (rowid, codigo, titulo, descripcion, categoria)
+            VALUES (new.id, new.codigo, new.titulo, new.descripcion, {categoria['new']});
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_producto_fts_delete AFTER DELETE ON producto
+        BEGIN
+            INSERT INTO producto_fts (producto_fts, rowid, codigo, titulo, descripcion, categoria)
+            VALUES ('delete', old.id, old.codigo, old.titulo, old.descripcion, {categoria['old']});
+        END
+    """)
+    # Solo reindexar cuando cambian columnas buscables (no en cambios de precio o stock),
+    # aunque el UPDATE las incluya con el mismo valor (como el import de Excel)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_producto_fts_update
+        AFTER UPDATE OF id, codigo, titulo, descripcion, {columna_categoria} ON producto
+        WHEN old.id IS NOT new.id OR old.codigo IS NOT new.codigo OR old.titulo IS NOT new.titulo
+             OR old.descripcion IS NOT new.descripcion OR old.{columna_categoria} IS NOT new.{columna_categoria}
+        BEGIN
+            INSERT INTO producto_fts (producto_fts, rowid, codigo, titulo, descripcion, categoria)
+            VALUES ('delete', old.id, old.codigo, old.titulo, old.descripcion, {categoria['old']});
+            INSERT INTO producto_fts (rowid, codigo, titulo, descripcion, categoria)
+            VALUES (new.id, new.codigo, new.titulo, new.descripcion, {categoria['new']});
+        END
+    """)
+
+    if categoria_por_id:
+        # Renombrar o borrar una categoría no escribe en producto: solo se
+        # reindexan sus productos con el nombre nuevo
+        for evento, nombre_nuevo in (('UPDATE OF nombre', 'NEW.nombre'), ('DELETE', "''")):
+            nombre = evento.split()[0].lower()
+            condicion = "WHEN NEW.nombre IS NOT OLD.nombre" if nombre == 'update' else ""
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_categoria_{nombre}_fts
+                AFTER {evento} ON categoria
+                {condicion}
+                BEGIN
+                    INSERT INTO producto_fts (producto_fts, rowid, codigo, titulo, descripcion, categoria)
+                    SELECT 'delete', id, codigo, titulo, descripcion, OLD.nombre
+                    FROM producto WHERE categoria_id = OLD.id;
+                    INSERT INTO producto_fts (rowid, codigo, titulo, descripcion, categoria)
+                    SELECT id, codigo, titulo, descripcion, {nombre_nuevo}
+                    FROM producto WHERE categoria_id = OLD.id;
+                END
             """)
 
-            try:
-                cursor.execute("SELECT envio_dni_destinatario FROM pedido LIMIT 1")
-            except sqlite3.OperationalError:
-                cursor.execute("ALTER TABLE pedido ADD COLUMN envio_dni_destinatario TEXT")
-            
-            # Verificar si hay pedidos existentes
-            cursor.execute("SELECT COUNT(*) as count FROM pedido")
-            count = cursor.fetchone()[0]
-            
-            # Si no hay pedidos, configurar el AUTOINCREMENT para empezar en 1200
-            if count == 0:
-                cursor.execute("INSERT OR REPLACE INTO sqlite_sequence (name, seq) VALUES ('pedido', 1199)")
-            else:
-                # Si ya hay pedidos, verificar que el próximo ID sea al menos 1200
-                cursor.execute("SELECT MAX(id) as max_id FROM pedido")
-                max_id = cursor.fetchone()[0]
-                if max_id is None or max_id < 1199:
-                    cursor.execute("INSERT OR REPLACE INTO sqlite_sequence (name, seq) VALUES ('pedido', 1199)")
-            
-            conn.commit()
-            logger.info("✓ Tablas de base de datos inicializadas correctamente")
-    except Exception as e:
-        logger.error(f"❌ Error al inicializar base de datos: {e}")
-        logger.warning("⚠️  La app arrancará de todos modos sin base de datos.")
+    if not existia:
+        cursor.execute("INSERT INTO producto_fts (producto_fts) VALUES ('rebuild')")
+        logger.info("✓ Índice de búsqueda de productos creado")
+
+
+# =============================================================================
+# ÍTEMS DE PEDIDOS
+# =============================================================================
+
+def items_de_productos(productos):
+    """
+    Convierte los productos de un pedido (lista o JSON, como los manda el
+    carrito) en tuplas (codigo, titulo, precio, cantidad) para pedido_item.
+    """
+    if isinstance(productos, (str, bytes)):
+        try:
+            productos = json.loads(productos or '[]')
+        except (TypeError, ValueError):
+            return []
+    if not isinstance(productos, list):
+        return []
+
+    items = []
+    for prod in productos:
+        if not isinstance(prod, dict):
+            continue
+        try:
+            precio = float(prod.get('precio') or 0)
+        except (TypeError, ValueError):
+            precio = 0
+        try:
+            cantidad = int(prod.get('cantidad') or 0)
+        except (TypeError, ValueError):
+            cantidad = 0
+        items.append((str(prod.get('codigo') or '').strip(), prod.get('titulo') or '', precio, cantidad))
+    return items
+
+
+def guardar_items_pedido(cursor, pedido_id, productos):
+    """
+    Guarda los ítems del pedido en pedido_item, reemplazando los anteriores.
+    Usa el cursor del que guarda el pedido: quedan en la misma transacción.
+    """
+    cursor.execute("DELETE FROM pedido_item WHERE pedido_id = ?", (pedido_id,))
+    cursor.executemany(
+        "INSERT INTO pedido_item (pedido_id, codigo, titulo, precio, cantidad) VALUES (?, ?, ?, ?, ?)",
+        [(pedido_id,) + item for item in items_de_productos(productos)]
+    )
+
+
+def crear_tabla_pedido_item(cursor):
+    """
+    Crea la tabla de ítems de pedidos y, la primera vez, la completa con los
+    productos (JSON) de los pedidos existentes. La columna pedido.productos se
+    sigue guardando tal cual para el detalle del pedido y los backups.
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='pedido_item'")
+    existia = cursor.fetchone() is not None
+
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pedido_item (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            pedido_id INTEGER NOT NULL REFERENCES pedido(id) ON DELETE CASCADE,
+            codigo TEXT,
+            titulo TEXT,
+            precio REAL NOT NULL DEFAULT 0,
+            cantidad INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedido_item_pedido ON pedido_item(pedido_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pedido_item_codigo ON pedido_item(codigo)")
+
+    # Las claves foráneas no están activadas en SQLite: el borrado en cascada lo hace el trigger
+    cursor.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_pedido_delete_items
+        AFTER DELETE ON pedido
+        BEGIN
+            DELETE FROM pedido_item WHERE pedido_id = OLD.id;
+        END
+    """)
+
+    if not existia:
+        cursor.execute("SELECT id, productos FROM pedido")
+        pedidos = cursor.fetchall()
+        for pedido in pedidos:
+            guardar_items_pedido(cursor, pedido['id'], pedido['productos'])
+        logger.info(f"✓ Ítems de {len(pedidos)} pedidos migrados a pedido_item")
+
+
+# =============================================================================
+# VENTAS DIARIAS
+# =============================================================================
+
+def _columnas_ventas(fila):
+    """
+    Expresiones SQL (cantidad, monto, facturado, por_facturar) con las que
+    aporta un pedido al resumen diario. fila es 'NEW', 'OLD' o 'pedido'.
+    """
+    facturados = ', '.join(f"'{estado}'" for estado in ESTADOS_PEDIDO_FACTURADO)
+    return (
+        "1",
+        f"{fila}.total",
+        f"CASE WHEN {fila}.estado IN ({facturados}) THEN {fila}.total ELSE 0 END",
+        f"CASE WHEN {fila}.estado NOT IN ({facturados}, 'cancelado') THEN {fila}.total ELSE 0 END",
+    )
+
+
+# Día de un pedido en el resumen. Los pedidos con una fecha que DATE() no
+# entiende (por ejemplo, importados con otro formato) van al día '': no
+# aparecen en el gráfico pero sí en los totales
+DIA_VENTAS = "COALESCE(DATE({fecha}), '')"
+
+
+def _sql_sumar_ventas(fila, signo):
+    """Sentencia que suma (signo '+') o resta (signo '-') un pedido en su día"""
+    cantidad, monto, facturado, por_facturar = _columnas_ventas(fila)
+    dia = DIA_VENTAS.format(fecha=f'{fila}.fecha')
+    return f"""
+        INSERT INTO ventas_diarias (dia, cantidad, monto, facturado, por_facturar)
+        SELECT {dia}, {signo}{cantidad}, {signo}({monto}), {signo}({facturado}), {signo}({por_facturar})
+        ON CONFLICT(dia) DO UPDATE SET
+            cantidad = cantidad + excluded.cantidad,
+            monto = monto + excluded.monto,
+            facturado = facturado + excluded.facturado,
+            por_facturar = por_facturar + excluded.por_facturar;
+        DELETE FROM ventas_diarias WHERE dia = {dia} AND cantidad <= 0;
+    """
+
+
+def crear_triggers_ventas_diarias(cursor):
+    """
+    Triggers que mantienen ventas_diarias al crear, borrar o modificar un
+    pedido. Los estados facturados quedan fijos en los triggers: si cambia
+    ESTADOS_PEDIDO_FACTURADO hace falta una migración que los recree.
+    """
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pedido_insert_ventas
+        AFTER INSERT ON pedido
+        BEGIN
+            {_sql_sumar_ventas('NEW', '+')}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pedido_delete_ventas
+        AFTER DELETE ON pedido
+        BEGIN
+            {_sql_sumar_ventas('OLD', '-')}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pedido_update_ventas
+        AFTER UPDATE OF fecha, total, estado ON pedido
+        BEGIN
+            {_sql_sumar_ventas('OLD', '-')}
+            {_sql_sumar_ventas('NEW', '+')}
+        END
+    """)
+
+
+def reconstruir_ventas_diarias(cursor):
+    """Recalcula ventas_diarias desde cero a partir de todos los pedidos"""
+    cantidad, monto, facturado, por_facturar = _columnas_ventas('pedido')
+    cursor.execute("DELETE FROM ventas_diarias")
+    dia = DIA_VENTAS.format(fecha='fecha')
+    cursor.execute(f"""
+        INSERT INTO ventas_diarias (dia, cantidad, monto, facturado, por_facturar)
+        SELECT {dia}, COUNT(*), SUM({monto}), SUM({facturado}), SUM({por_facturar})
+        FROM pedido
+        GROUP BY {dia}
+    """)
+
+
+@app.cli.command("reconstruir-ventas")
+def reconstruir_ventas_command():
+    """Recalcula el resumen de ventas diarias (por ejemplo, tras editar pedidos a mano)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        reconstruir_ventas_diarias(cursor)
+        conn.commit()
+        cursor.execute("SELECT COUNT(*) FROM ventas_diarias")
+        print(f"✓ Ventas diarias reconstruidas: {cursor.fetchone()[0]} días")
+        reconstruir_ventas_producto(cursor)
+        conn.commit()
+        cursor.execute("SELECT COUNT(*) FROM ventas_producto")
+        print(f"✓ Ventas por producto reconstruidas: {cursor.fetchone()[0]} productos")
+        reconstruir_clientes(cursor)
+        conn.commit()
+        cursor.execute("SELECT COUNT(*) FROM cliente")
+        print(f"✓ Clientes reconstruidos: {cursor.fetchone()[0]} clientes")
+
+
+# =============================================================================
+# VENTAS POR PRODUCTO
+# =============================================================================
+
+# Clave de un ítem en los resúmenes: su código, o el título si se vendió sin código
+CLAVE_ITEM_VENTAS = "COALESCE(NULLIF(i.codigo, ''), i.titulo, '')"
+
+
+def _sql_sumar_ventas_producto(signo, fecha, desde):
+    """
+    Sentencias que suman (signo '+') o restan (signo '-') ítems en
+    ventas_producto y ventas_producto_diarias. desde es el FROM/WHERE que
+    selecciona los ítems (alias i) y fecha la fecha del pedido.
+
+    El título guardado es el del último ítem contado (mayor pedido_item.id,
+    en titulo_item), igual que en reconstruir_ventas_producto: al sumar solo
+    se reemplaza por uno más nuevo y al restar el ítem del título se busca
+    el anterior que siga contando.
+    """
+    if signo == '+':
+        titulo = """
+            titulo = CASE WHEN titulo_item IS NULL OR excluded.titulo_item > titulo_item
+                          THEN excluded.titulo ELSE titulo END,
+            titulo_item = MAX(COALESCE(titulo_item, 0), excluded.titulo_item),"""
+        recalcular_titulo = ""
+    else:
+        titulo = ""
+        ultimo_item = f"""
+                SELECT i.titulo, i.id FROM pedido_item i JOIN pedido p ON p.id = i.pedido_id
+                WHERE {CLAVE_ITEM_VENTAS} = {{tabla}}.codigo AND p.estado IS NOT 'cancelado'{{dia}}
+                  AND i.id NOT IN (SELECT i.id {desde})
+                ORDER BY i.id DESC LIMIT 1"""
+        recalcular_titulo = f"""
+        UPDATE ventas_producto SET (titulo, titulo_item) = ({ultimo_item.format(tabla='ventas_producto', dia='')})
+        WHERE titulo_item IN (SELECT i.id {desde});
+        UPDATE ventas_producto_diarias SET (titulo, titulo_item) = ({ultimo_item.format(
+            tabla='ventas_producto_diarias', dia=' AND DATE(p.fecha) = ventas_producto_diarias.dia')})
+        WHERE titulo_item IN (SELECT i.id {desde});"""
+    sumas = f"""
+            pedidos = pedidos + excluded.pedidos,
+            unidades = unidades + excluded.unidades,
+            monto = monto + excluded.monto"""
+    # i.titulo sin agregar junto a MAX(i.id): SQLite lo toma de esa misma fila
+    valores = f"i.titulo, MAX(i.id), {signo}COUNT(*), {signo}SUM(i.cantidad), {signo}SUM(i.precio * i.cantidad)"
+    return f"""
+        INSERT INTO ventas_producto (codigo, titulo, titulo_item, pedidos, unidades, monto)
+        SELECT {CLAVE_ITEM_VENTAS}, {valores}
+        {desde}
+        GROUP BY {CLAVE_ITEM_VENTAS}
+        ON CONFLICT(codigo) DO UPDATE SET {titulo}{sumas};
+        INSERT INTO ventas_producto_diarias (codigo, dia, titulo, titulo_item, pedidos, unidades, monto)
+        SELECT {CLAVE_ITEM_VENTAS}, DATE({fecha}), {valores}
+        {desde} AND DATE({fecha}) IS NOT NULL
+        GROUP BY {CLAVE_ITEM_VENTAS}
+        ON CONFLICT(codigo, dia) DO UPDATE SET {titulo}{sumas};{recalcular_titulo}
+        DELETE FROM ventas_producto
+        WHERE pedidos <= 0 AND codigo IN (SELECT {CLAVE_ITEM_VENTAS} {desde});
+        DELETE FROM ventas_producto_diarias
+        WHERE pedidos <= 0 AND (codigo, dia) IN (SELECT {CLAVE_ITEM_VENTAS}, DATE({fecha}) {desde});
+    """
+
+
+def crear_triggers_ventas_producto(cursor):
+    """
+    Triggers que mantienen las ventas por producto. Cuentan los ítems de los
+    pedidos no cancelados: se actualizan al guardar o borrar ítems y al
+    cambiar la fecha o el estado del pedido.
+    """
+    item_pedido = "FROM pedido_item i JOIN pedido p ON p.id = i.pedido_id WHERE i.id = {fila}.id AND p.estado IS NOT 'cancelado'"
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pedido_item_insert_ventas
+        AFTER INSERT ON pedido_item
+        BEGIN
+            {_sql_sumar_ventas_producto('+', 'p.fecha', item_pedido.format(fila='NEW'))}
+        END
+    """)
+    # BEFORE: el ítem todavía está en la tabla. Si se borra el pedido, sus
+    # ítems se restan en trg_pedido_delete_ventas_producto y acá ya no hay join
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pedido_item_delete_ventas
+        BEFORE DELETE ON pedido_item
+        BEGIN
+            {_sql_sumar_ventas_producto('-', 'p.fecha', item_pedido.format(fila='OLD'))}
+        END
+    """)
+
+    items = "FROM pedido_item i WHERE i.pedido_id = {fila}.id AND {fila}.estado IS NOT 'cancelado'"
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pedido_delete_ventas_producto
+        BEFORE DELETE ON pedido
+        BEGIN
+            {_sql_sumar_ventas_producto('-', 'OLD.fecha', items.format(fila='OLD'))}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pedido_update_ventas_producto
+        AFTER UPDATE OF fecha, estado ON pedido
+        WHEN OLD.fecha IS NOT NEW.fecha OR OLD.estado IS NOT NEW.estado
+        BEGIN
+            {_sql_sumar_ventas_producto('-', 'OLD.fecha', items.format(fila='OLD'))}
+            {_sql_sumar_ventas_producto('+', 'NEW.fecha', items.format(fila='NEW'))}
+        END
+    """)
+
+
+def reconstruir_ventas_producto(cursor):
+    """
+    Recalcula las ventas por producto desde cero a partir de pedido_item.
+    El título es el del último ítem contado, como en los triggers.
+    """
+    desde = """
+        FROM pedido_item i JOIN pedido p ON p.id = i.pedido_id
+        WHERE p.estado IS NOT 'cancelado'
+    """
+    valores = "i.titulo, MAX(i.id), COUNT(*), SUM(i.cantidad), SUM(i.precio * i.cantidad)"
+    cursor.execute("DELETE FROM ventas_producto")
+    cursor.execute("DELETE FROM ventas_producto_diarias")
+    cursor.execute(f"""
+        INSERT INTO ventas_producto (codigo, titulo, titulo_item, pedidos, unidades, monto)
+        SELECT {CLAVE_ITEM_VENTAS}, {valores}
+        {desde}
+        GROUP BY {CLAVE_ITEM_VENTAS}
+    """)
+    cursor.execute(f"""
+        INSERT INTO ventas_producto_diarias (codigo, dia, titulo, titulo_item, pedidos, unidades, monto)
+        SELECT {CLAVE_ITEM_VENTAS}, DATE(p.fecha), {valores}
+        {desde} AND DATE(p.fecha) IS NOT NULL
+        GROUP BY {CLAVE_ITEM_VENTAS}, DATE(p.fecha)
+    """)
+
+
+def productos_mas_vendidos(cursor, filtro='', limite=10, desde=None, hasta=None):
+    """
+    Productos más vendidos (título, unidades) de pedidos no cancelados.
+    Se muestra el título actual del producto (o el último vendido si ya no
+    existe). desde/hasta ('YYYY-MM-DD', inclusive) limitan las fechas.
+    """
+    condiciones = []
+    params = []
+
+    if desde or hasta:
+        tabla = "ventas_producto_diarias"
+        if desde:
+            condiciones.append("v.dia >= ?")
+            params.append(desde)
+        if hasta:
+            condiciones.append("v.dia <= ?")
+            params.append(hasta)
+    else:
+        tabla = "ventas_producto"
+
+    consulta_fts = armar_consulta_fts(filtro)
+    patron = patron_like((filtro or '').lower())
+    if consulta_fts and hay_indice_busqueda(cursor):
+        # Productos existentes por el índice de búsqueda (código y título);
+        # los que ya no existen, por el último título vendido
+        condiciones.append("""(pr.id IN (SELECT rowid FROM producto_fts WHERE producto_fts MATCH ?)
+                               OR (pr.id IS NULL AND LOWER(v.titulo) LIKE ? ESCAPE '\\'))""")
+        params.extend([f"{{codigo titulo}} : ({consulta_fts})", patron])
+    elif filtro:
+        condiciones.append("LOWER(COALESCE(pr.titulo, v.titulo)) LIKE ? ESCAPE '\\'")
+        params.append(patron)
+
+    where = f"WHERE {' AND '.join(condiciones)}" if condiciones else ""
+    params.append(limite)
+    cursor.execute(f"""
+        SELECT COALESCE(pr.titulo, MAX(v.titulo)) AS titulo, SUM(v.unidades) AS unidades
+        FROM {tabla} v
+        LEFT JOIN producto pr ON pr.codigo = v.codigo
+        {where}
+        GROUP BY v.codigo
+        ORDER BY unidades DESC
+        LIMIT ?
+    """, params)
+    return [(row['titulo'] or 'Sin nombre', row['unidades'] or 0) for row in cursor.fetchall()]
+
+
+# =============================================================================
+# CLIENTES
+# =============================================================================
+
+def _sql_insertar_clientes(claves):
+    """
+    INSERT que calcula las filas de cliente de las claves de teléfono que
+    devuelve la consulta claves (columna clave), a partir de sus pedidos
+    concretados. Usa idx_pedido_cliente_telefono_clave.
+    """
+    estados = ', '.join(f"'{estado}'" for estado in ESTADOS_PEDIDO_REALIZADO)
+    pedidos = f"FROM pedido WHERE cliente_telefono_clave = k.clave AND estado IN ({estados})"
+    # El nombre y el teléfono principales son los del último pedido. Los demás
+    # datos conocidos los arma la página de clientes desde sus pedidos
+    return f"""
+        INSERT INTO cliente (clave, pedidos, total_gastado, primer_pedido, ultimo_pedido, nombre, telefono)
+        SELECT k.clave, COUNT(*), COALESCE(SUM(p.total), 0), MIN(p.fecha), MAX(p.fecha),
+               (SELECT TRIM(cliente_nombre) {pedidos} ORDER BY fecha DESC, id DESC LIMIT 1),
+               (SELECT TRIM(cliente_telefono) {pedidos} ORDER BY fecha DESC, id DESC LIMIT 1)
+        FROM ({claves}) k
+        JOIN pedido p ON p.cliente_telefono_clave = k.clave AND p.estado IN ({estados})
+        WHERE k.clave IS NOT NULL
+        GROUP BY k.clave;
+    """
 
 
-def migrar_categorias_existentes():
-    """Migra las categorías existentes de los productos a la tabla de categorías"""
-    try:
-        # No intentar migrar si la DB no existe o está vacía
-        if not os.path.exists(Config.DATABASE_PATH) or os.path.getsize(Config.DATABASE_PATH) == 0:
-            logger.warning("⚠️  Saltando migración de categorías: base de datos no disponible")
-            return
-        
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Verificar que la tabla producto existe antes de migrar
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='producto'")
-            if not cursor.fetchone():
-                logger.warning("⚠️  Saltando migración de categorías: tabla producto no existe")
-                return
-            
-            # Obtener categorías únicas de los productos
-            cursor.execute("SELECT DISTINCT categoria FROM producto WHERE categoria IS NOT NULL AND categoria != '' ORDER BY categoria")
-            categorias_existentes = [row['categoria'] for row in cursor.fetchall()]
-            
-            # Insertar categorías en la tabla de categorías si no existen
-            for categoria in categorias_existentes:
-                cursor.execute("INSERT OR IGNORE INTO categoria (nombre) VALUES (?)", (categoria,))
-            
-            conn.commit()
-            logger.info(f"Migradas {len(categorias_existentes)} categorías existentes")
-    except Exception as e:
-        logger.error(f"Error al migrar categorías existentes: {e}")
+def _sql_recalcular_cliente(clave):
+    """Sentencias que recalculan el cliente de una clave (expresión SQL, ej. NEW.cliente_telefono_clave)"""
+    return f"""
+        DELETE FROM cliente WHERE clave = {clave};
+        {_sql_insertar_clientes(f"SELECT {clave} AS clave")}
+    """
 
 
-# Inicializar base de datos al arrancar la app
-init_database()
-migrar_categorias_existentes()
+def crear_triggers_cliente(cursor):
+    """
+    Triggers que mantienen la tabla cliente: cada cambio en un pedido
+    recalcula solo el cliente (o los dos, si cambió el teléfono) afectado,
+    desde sus pedidos concretados (por idx_pedido_cliente_telefono_clave).
+    El costo crece con los pedidos de ese cliente, no con los de la tabla.
+    Los estados concretados quedan fijos en los triggers: si cambia
+    ESTADOS_PEDIDO_REALIZADO hace falta una migración que los recree.
+    """
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pedido_insert_cliente
+        AFTER INSERT ON pedido
+        WHEN NEW.cliente_telefono_clave IS NOT NULL
+        BEGIN
+            {_sql_recalcular_cliente('NEW.cliente_telefono_clave')}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pedido_delete_cliente
+        AFTER DELETE ON pedido
+        WHEN OLD.cliente_telefono_clave IS NOT NULL
+        BEGIN
+            {_sql_recalcular_cliente('OLD.cliente_telefono_clave')}
+        END
+    """)
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_pedido_update_cliente
+        AFTER UPDATE OF fecha, cliente_nombre, cliente_telefono, cliente_email,
+                        total, estado, cliente_telefono_clave ON pedido
+        WHEN OLD.cliente_telefono_clave IS NOT NULL OR NEW.cliente_telefono_clave IS NOT NULL
+        BEGIN
+            {_sql_recalcular_cliente('OLD.cliente_telefono_clave')}
+            {_sql_recalcular_cliente('NEW.cliente_telefono_clave')}
+        END
+    """)
+
+
+def datos_conocidos(pedidos, columna):
+    """
+    Valores distintos (sin espacios de más ni vacíos) de una columna en los
+    pedidos, en orden de aparición. pedidos tiene que venir ordenado por fecha.
+    """
+    valores = {}
+    for pedido in pedidos:
+        valor = (pedido[columna] or '').strip()
+        if valor:
+            valores.setdefault(valor, None)
+    return list(valores)
+
+
+def reconstruir_clientes(cursor):
+    """Recalcula la tabla cliente desde cero a partir de todos los pedidos"""
+    cursor.execute("DELETE FROM cliente")
+    cursor.execute(_sql_insertar_clientes("SELECT DISTINCT cliente_telefono_clave AS clave FROM pedido"))
+
 
 # =============================================================================
 # PANEL DE ADMINISTRACIÓN
@@ -624,98 +2556,122 @@ def admin_logout():
     return redirect(url_for('admin_login'))
 
 
+# Estadísticas del dashboard: se recalculan cuando cambian productos o pedidos
+# (versiones que incrementan los triggers) o, como máximo, cada TTL segundos
+_estadisticas_cache = None
+_estadisticas_lock = threading.Lock()
+
+
+def calcular_estadisticas_dashboard(cursor):
+    """
+    Calcula todas las cifras del dashboard: una pasada por producto y el
+    resto desde los resúmenes (ventas_diarias y pedido_item), así el costo
+    no crece con el historial de pedidos.
+    """
+    cursor.execute("""
+        SELECT COUNT(*),
+               COALESCE(SUM(stock > 0), 0),
+               COALESCE(SUM(stock = 0), 0),
+               COALESCE(SUM(stock), 0)
+        FROM producto
+    """)
+    total_productos, productos_con_stock, productos_sin_stock, stock_total = cursor.fetchone()
+
+    cursor.execute("""
+        SELECT COALESCE(SUM(cantidad), 0), COALESCE(SUM(monto), 0),
+               COALESCE(SUM(facturado), 0), COALESCE(SUM(por_facturar), 0)
+        FROM ventas_diarias
+    """)
+    total_pedidos, total_ventas, ventas_facturadas, ventas_por_facturar = cursor.fetchone()
+
+    # Ventas por día (últimos 30 días)
+    cursor.execute("""
+        SELECT dia, cantidad, monto
+        FROM ventas_diarias
+        WHERE dia >= date('now', '-30 days')
+        ORDER BY dia DESC
+    """)
+    ventas_por_dia = [list(row) for row in cursor.fetchall()]
+
+    return {
+        'total_productos': total_productos,
+        'productos_con_stock': productos_con_stock,
+        'productos_sin_stock': productos_sin_stock,
+        'stock_total': stock_total,
+        'total_pedidos': total_pedidos,
+        'total_ventas': total_ventas,
+        'ventas_facturadas': ventas_facturadas,
+        'ventas_por_facturar': ventas_por_facturar,
+        'ventas_por_dia': ventas_por_dia,
+        'productos_mas_vendidos': productos_mas_vendidos(cursor, limite=10),
+        'calculado_en': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+
+def obtener_estadisticas_dashboard():
+    """Devuelve las estadísticas del dashboard desde la caché si siguen vigentes"""
+    global _estadisticas_cache
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT version FROM pedidos_version WHERE id = 1")
+        fila = cursor.fetchone()
+        clave = (obtener_version_catalogo(cursor), fila[0] if fila else None)
+
+        cache = _estadisticas_cache
+        if cache and cache[0] == clave and time.monotonic() - cache[1] < Config.DASHBOARD_CACHE_SEGUNDOS:
+            return cache[2]
+
+        with _estadisticas_lock:
+            cache = _estadisticas_cache
+            if cache and cache[0] == clave and time.monotonic() - cache[1] < Config.DASHBOARD_CACHE_SEGUNDOS:
+                return cache[2]
+
+            estadisticas = calcular_estadisticas_dashboard(cursor)
+            _estadisticas_cache = (clave, time.monotonic(), estadisticas)
+            return estadisticas
+
+
 @app.route("/admin")
 @login_required
 def admin_dashboard():
     """Dashboard principal del admin"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Estadísticas de productos
-            cursor.execute("SELECT COUNT(*) FROM producto")
-            total_productos = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM producto WHERE stock > 0")
-            productos_con_stock = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT COUNT(*) FROM producto WHERE stock = 0")
-            productos_sin_stock = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT SUM(stock) FROM producto")
-            stock_total = cursor.fetchone()[0] or 0
-            
-            # Estadísticas de pedidos
-            cursor.execute("SELECT COUNT(*) FROM pedido")
-            total_pedidos = cursor.fetchone()[0]
-            
-            cursor.execute("SELECT SUM(total) FROM pedido")
-            total_ventas = cursor.fetchone()[0] or 0
-            
-            # Ventas facturadas vs por facturar
-            cursor.execute("""
-                SELECT SUM(total) FROM pedido 
-                WHERE estado IN ('pagado', 'completado', 'impreso', 'preparado')
-            """)
-            ventas_facturadas = cursor.fetchone()[0] or 0
-            
-            cursor.execute("""
-                SELECT SUM(total) FROM pedido 
-                WHERE estado NOT IN ('pagado', 'completado', 'impreso', 'preparado', 'cancelado')
-            """)
-            ventas_por_facturar = cursor.fetchone()[0] or 0
-            
-            # Ventas por día (últimos 30 días)
-            cursor.execute("""
-                SELECT DATE(fecha) as dia, COUNT(*) as cantidad, SUM(total) as monto
-                FROM pedido
-                WHERE fecha >= date('now', '-30 days')
-                GROUP BY DATE(fecha)
-                ORDER BY dia DESC
-            """)
-            ventas_por_dia_raw = cursor.fetchall()
-            ventas_por_dia = [list(row) for row in ventas_por_dia_raw] if ventas_por_dia_raw else []
-            
-            # Productos más vendidos
-            cursor.execute("""
-                SELECT p.productos, COUNT(*) as veces_pedido
-                FROM pedido p
-                WHERE p.productos IS NOT NULL AND p.productos != ''
-                GROUP BY p.productos
-                ORDER BY veces_pedido DESC
-                LIMIT 10
-            """)
-            productos_vendidos_raw = cursor.fetchall()
-            
-            # Procesar productos más vendidos
-            from collections import Counter
-            productos_counter = Counter()
-            
-            for row in productos_vendidos_raw:
-                try:
-                    productos_json = json.loads(row[0])
-                    for prod in productos_json:
-                        titulo = prod.get('titulo', 'Sin nombre')
-                        cantidad = prod.get('cantidad', 0)
-                        productos_counter[titulo] += cantidad
-                except Exception as e:
-                    logger.error(f"Error procesando producto: {e}")
-                    pass
-            
-            productos_mas_vendidos = list(productos_counter.most_common(10)) if productos_counter else []
-            
-            return render_template("admin/dashboard.html",
-                                 total_productos=total_productos,
-                                 productos_con_stock=productos_con_stock,
-                                 productos_sin_stock=productos_sin_stock,
-                                 stock_total=stock_total,
-                                 total_pedidos=total_pedidos)
+        estadisticas = obtener_estadisticas_dashboard()
+        return render_template("admin/dashboard.html",
+                             total_productos=estadisticas['total_productos'],
+                             productos_con_stock=estadisticas['productos_con_stock'],
+                             productos_sin_stock=estadisticas['productos_sin_stock'],
+                             stock_total=estadisticas['stock_total'],
+                             total_pedidos=estadisticas['total_pedidos'])
     except Exception as e:
         logger.error(f"Error en dashboard: {e}")
         flash('Error al cargar el dashboard', 'error')
         return redirect(url_for('admin_login'))
 
 
+@app.route("/admin/api/estadisticas")
+@login_required
+def admin_api_estadisticas():
+    """API con todas las estadísticas del dashboard"""
+    try:
+        return jsonify(obtener_estadisticas_dashboard())
+    except Exception as e:
+        logger.error(f"Error en API estadísticas: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+def dias_de_periodo(periodo):
+    """
+    Convierte el parámetro periodo (días hacia atrás) a int. Lanza
+    ValueError si no es un entero entre 1 y Config.VENTAS_PERIODO_MAX_DIAS.
+    """
+    dias = int(periodo)
+    if not 0 < dias <= Config.VENTAS_PERIODO_MAX_DIAS:
+        raise ValueError(f"Período fuera de rango: {periodo}")
+    return dias
+
+
 @app.route("/admin/api/ventas-por-dia")
 @login_required
 def admin_api_ventas_por_dia():
@@ -723,30 +2679,22 @@ def admin_api_ventas_por_dia():
     try:
         periodo = request.args.get('periodo', '30')
         
+        # El día '' (pedidos sin fecha válida) solo cuenta en los totales
+        query = "SELECT dia, cantidad, monto FROM ventas_diarias WHERE dia <> ''"
+        params = []
+        if periodo != 'all':
+            try:
+                dias = dias_de_periodo(periodo)
+            except ValueError:
+                return jsonify([]), 400
+            query += " AND dia >= date('now', ?)"
+            params.append(f"-{dias} days")
+        query += " ORDER BY dia ASC"
+        
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            
-            # Construir query según período
-            if periodo == 'all':
-                query = """
-                    SELECT DATE(fecha) as dia, COUNT(*) as cantidad, SUM(total) as monto
-                    FROM pedido
-                    GROUP BY DATE(fecha)
-                    ORDER BY dia ASC
-                """
-            else:
-                dias = int(periodo)
-                query = f"""
-                    SELECT DATE(fecha) as dia, COUNT(*) as cantidad, SUM(total) as monto
-                    FROM pedido
-                    WHERE fecha >= date('now', '-{dias} days')
-                    GROUP BY DATE(fecha)
-                    ORDER BY dia ASC
-                """
-            
-            cursor.execute(query)
-            ventas_raw = cursor.fetchall()
-            ventas = [list(row) for row in ventas_raw] if ventas_raw else []
+            cursor.execute(query, params)
+            ventas = [list(row) for row in cursor.fetchall()]
             
             return jsonify(ventas)
     except Exception as e:
@@ -757,41 +2705,31 @@ def admin_api_ventas_por_dia():
 @app.route("/admin/api/productos-mas-vendidos")
 @login_required
 def admin_api_productos_mas_vendidos():
-    """API para obtener productos más vendidos con filtro opcional"""
+    """
+    API para obtener productos más vendidos con filtro opcional. Acepta
+    periodo (días hacia atrás) o desde/hasta (YYYY-MM-DD) y limite.
+    """
     try:
         filtro = request.args.get('filtro', '').lower()
+        limite = min(max(1, request.args.get('limite', 10, type=int) or 10), 100)
+        desde = request.args.get('desde') or None
+        hasta = request.args.get('hasta') or None
+        periodo = request.args.get('periodo', 'all')
+        
+        try:
+            for fecha in (desde, hasta):
+                if fecha:
+                    datetime.strptime(fecha, '%Y-%m-%d')
+            if periodo != 'all' and not desde:
+                desde = (datetime.now() - timedelta(days=dias_de_periodo(periodo))).strftime('%Y-%m-%d')
+        except ValueError:
+            return jsonify([]), 400
         
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            # Obtener todos los pedidos
-            cursor.execute("""
-                SELECT p.productos
-                FROM pedido p
-                WHERE p.productos IS NOT NULL AND p.productos != ''
-            """)
-            productos_vendidos_raw = cursor.fetchall()
-            
-            # Procesar productos más vendidos con filtro
-            from collections import Counter
-            productos_counter = Counter()
-            
-            for row in productos_vendidos_raw:
-                try:
-                    productos_json = json.loads(row[0])
-                    for prod in productos_json:
-                        titulo = prod.get('titulo', 'Sin nombre')
-                        # Aplicar filtro si existe
-                        if not filtro or filtro in titulo.lower():
-                            cantidad = prod.get('cantidad', 0)
-                            productos_counter[titulo] += cantidad
-                except Exception as e:
-                    logger.error(f"Error procesando producto: {e}")
-                    pass
-            
-            productos_mas_vendidos = list(productos_counter.most_common(10)) if productos_counter else []
-            
-            return jsonify(productos_mas_vendidos)
+            return jsonify(productos_mas_vendidos(cursor, filtro=filtro, limite=limite,
+                                                  desde=desde, hasta=hasta))
     except Exception as e:
         logger.error(f"Error en API productos más vendidos: {e}")
         return jsonify([]), 500
@@ -852,7 +2790,7 @@ def admin_exportar_todo():
         with get_db_connection() as conn:
             cursor = conn.cursor()
 
-            cursor.execute("SELECT * FROM producto ORDER BY codigo DESC")
+            cursor.execute("SELECT * FROM vista_producto ORDER BY codigo DESC")
             productos = [dict(row) for row in cursor.fetchall()]
 
             cursor.execute("SELECT * FROM pedido ORDER BY id")
@@ -959,38 +2897,19 @@ def admin_importar_todo():
         with get_db_connection() as conn:
             cursor = conn.cursor()
 
-            # Asegurar columnas actuales (migración defensiva)
-            try:
-                cursor.execute("SELECT activo FROM producto LIMIT 1")
-            except sqlite3.OperationalError:
-                cursor.execute("ALTER TABLE producto ADD COLUMN activo INTEGER NOT NULL DEFAULT 1")
-
-            columnas_pedido = [
-                ('envio_direccion', 'TEXT'),
-                ('envio_localidad', 'TEXT'),
-                ('envio_provincia', 'TEXT'),
-                ('envio_cp', 'TEXT'),
-                ('envio_nombre_destinatario', 'TEXT'),
-                ('envio_dni_destinatario', 'TEXT'),
-                ('envio_referencias', 'TEXT')
-            ]
-            for columna, tipo in columnas_pedido:
-                try:
-                    cursor.execute(f"SELECT {columna} FROM pedido LIMIT 1")
-                except sqlite3.OperationalError:
-                    cursor.execute(f"ALTER TABLE pedido ADD COLUMN {columna} {tipo}")
-
             # Reemplazo total de datos
             cursor.execute("DELETE FROM producto_nuevo")
             cursor.execute("DELETE FROM pedido")
             cursor.execute("DELETE FROM producto")
 
+            # Las categorías del backup se resuelven por nombre (sus ids pueden no coincidir)
+            categorias = ids_categorias(cursor, [p.get('categoria') for p in productos])
             for p in productos:
                 cursor.execute("""
                     INSERT INTO producto (
                         id, codigo, titulo, descripcion, precio, minimo,
-                        multiplo, stock, imagen, categoria, activo
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        multiplo, stock, imagen, imagen_version, categoria_id, activo
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     p.get('id'),
                     p.get('codigo', ''),
@@ -1001,7 +2920,8 @@ def admin_importar_todo():
                     p.get('multiplo', 1),
                     p.get('stock', 0),
                     p.get('imagen', ''),
-                    p.get('categoria', ''),
+                    p.get('imagen_version'),
+                    categorias.get(str(p.get('categoria') or '')),
                     p.get('activo', 1)
                 ))
 
@@ -1012,8 +2932,8 @@ def admin_importar_todo():
                         cliente_email, cliente_direccion, metodo_entrega,
                         envio_direccion, envio_localidad, envio_provincia, envio_cp,
                         envio_nombre_destinatario, envio_dni_destinatario, envio_referencias,
-                        productos, total, estado
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        productos, total, estado, cliente_telefono_clave
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     ped.get('id'),
                     ped.get('fecha'),
@@ -1032,8 +2952,10 @@ def admin_importar_todo():
                     ped.get('envio_referencias', ''),
                     ped.get('productos', '[]'),
                     ped.get('total', 0),
-                    ped.get('estado', 'pendiente')
+                    normalizar_estado(ped.get('estado'), por_defecto='pendiente'),
+                    normalizar_telefono(ped.get('cliente_telefono'))
                 ))
+                guardar_items_pedido(cursor, cursor.lastrowid, ped.get('productos', '[]'))
 
             for pn in productos_nuevos:
                 cursor.execute("""
@@ -1057,6 +2979,7 @@ def admin_importar_todo():
 
         # Importar imágenes de productos nuevos (sin borrar imágenes existentes)
         imagenes_importadas = 0
+        imagenes_escritas = []
         for ruta, contenido in archivos_map.items():
             ruta_norm = _normalizar_ruta_backup(ruta).lower()
             if '/imagenes_nuevos/' not in ruta_norm and not ruta_norm.startswith('imagenes_nuevos/'):
@@ -1069,8 +2992,26 @@ def admin_importar_todo():
             destino = os.path.join(app.config['UPLOAD_FOLDER'], nombre_archivo)
             with open(destino, 'wb') as f:
                 f.write(contenido)
+            # Las miniaturas se generan al pedirlas (o con flask generar-miniaturas):
+            # hacerlo acá con todas las imágenes del backup hace que la restauración tarde demasiado
+            eliminar_miniaturas(nombre_archivo)
+            imagenes_escritas.append(nombre_archivo)
             imagenes_importadas += 1
 
+        # Las imágenes pudieron reemplazar archivos existentes: recalcular sus versiones
+        if imagenes_escritas:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                for nombre_archivo in imagenes_escritas:
+                    cursor.execute(
+                        "UPDATE producto SET imagen_version = ? WHERE imagen = ?",
+                        (hash_imagen(nombre_archivo), nombre_archivo)
+                    )
+                conn.commit()
+
+        # La importación reescribe todas las tablas: achicar el WAL que dejó
+        checkpoint_wal('TRUNCATE')
+
         return jsonify({
             'success': True,
             'productos': len(productos),
@@ -1093,7 +3034,7 @@ def admin_productos():
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM producto ORDER BY codigo DESC")
+            cursor.execute("SELECT * FROM vista_producto ORDER BY codigo DESC")
             productos = [dict(row) for row in cursor.fetchall()]
             
             # Obtener categorías de la tabla de categorías
@@ -1107,191 +3048,708 @@ def admin_productos():
         return redirect(url_for('admin_dashboard'))
 
 
+# Las exportaciones se escriben en modo solo escritura (openpyxl va volcando
+# las filas a disco) sobre un archivo temporal que pasa a disco al superar
+# este tamaño, así la memoria no crece con la cantidad de filas
+EXPORTACION_MEMORIA_MAX = 4 * 1024 * 1024
+
+
+def hoja_exportacion(wb, titulo, encabezados, anchos):
+    """Crea una hoja de un Workbook(write_only=True) con los encabezados con estilo"""
+    ws = wb.create_sheet(titulo)
+    for i, ancho in enumerate(anchos, 1):
+        ws.column_dimensions[get_column_letter(i)].width = ancho
+
+    header_fill = PatternFill(start_color="6a1b9a", end_color="6a1b9a", fill_type="solid")
+    header_font = Font(bold=True, color="FFFFFF", size=12)
+    header_alignment = Alignment(horizontal="center", vertical="center")
+    fila = []
+    for encabezado in encabezados:
+        cell = WriteOnlyCell(ws, value=encabezado)
+        cell.fill = header_fill
+        cell.font = header_font
+        cell.alignment = header_alignment
+        fila.append(cell)
+    ws.append(fila)
+    return ws
+
+
+def enviar_exportacion(escribir, mimetype, filename):
+    """
+    Llama a escribir(archivo) sobre un archivo temporal y lo envía como
+    descarga. send_file lo manda por partes y lo cierra (y borra) al terminar.
+    """
+    archivo = tempfile.SpooledTemporaryFile(max_size=EXPORTACION_MEMORIA_MAX)
+    try:
+        escribir(archivo)
+        archivo.seek(0)
+    except Exception:
+        archivo.close()
+        raise
+    return send_file(archivo, mimetype=mimetype, as_attachment=True, download_name=filename)
+
+
+# Formatos de importación/exportación masiva. Todos usan las mismas columnas
+# que el Excel; CSV y Parquet son para sincronizar con otros sistemas sin
+# el costo de armar y leer un XLSX
+FORMATOS_TABLA = {
+    'xlsx': {'nombre': 'Excel', 'extensiones': ('.xlsx', '.xls'),
+             'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'},
+    'csv': {'nombre': 'CSV', 'extensiones': ('.csv',), 'mimetype': 'text/csv'},
+    'parquet': {'nombre': 'Parquet', 'extensiones': ('.parquet',), 'mimetype': 'application/vnd.apache.parquet'},
+}
+
+# Tipo de cada columna en el esquema Parquet
+TIPOS_PARQUET = {int: 'int64', float: 'float64', str: 'string'}
+
+# Filas por grupo al escribir Parquet (se escribe un grupo por vez)
+PARQUET_FILAS_POR_GRUPO = 10000
+
+
+def formato_tabla(formato=None, nombre_archivo=''):
+    """
+    Devuelve el formato pedido o, si no viene, el que indica la extensión
+    del archivo (por defecto xlsx). Lanza ValueError si el formato no
+    existe, no coincide con el archivo o es Parquet y falta pyarrow.
+    """
+    formato = (formato or '').strip().lower()
+    nombre = (nombre_archivo or '').lower()
+    if not formato:
+        formato = next((f for f, datos in FORMATOS_TABLA.items() if nombre.endswith(datos['extensiones'])), 'xlsx')
+    if formato not in FORMATOS_TABLA:
+        raise ValueError(f'Formato no soportado: {formato}. Opciones: {", ".join(FORMATOS_TABLA)}')
+    datos = FORMATOS_TABLA[formato]
+    if nombre and not nombre.endswith(datos['extensiones']):
+        raise ValueError(f'El archivo debe ser {datos["nombre"]} ({" o ".join(datos["extensiones"])})')
+    if formato == 'parquet' and pq is None:
+        raise ValueError('El formato Parquet necesita pyarrow instalado')
+    return formato
+
+
+def _valor_parquet(valor, tipo):
+    """Convierte un valor de la base al tipo de su columna Parquet"""
+    if valor is None or valor == '':
+        return None
+    return int(float(valor)) if tipo is int else tipo(valor)
+
+
+def escribir_tabla(archivo, formato, titulo, columnas, filas, anchos, tipos):
+    """
+    Escribe filas (listas en el orden de columnas) a medida que llegan.
+    anchos se usa en el Excel y tipos (int/float/str) en el esquema Parquet.
+    """
+    if formato == 'csv':
+        texto = TextIOWrapper(archivo, encoding='utf-8', newline='')
+        writer = csv.writer(texto)
+        writer.writerow(columnas)
+        writer.writerows(filas)
+        texto.flush()
+        texto.detach()  # archivo sigue abierto para quien lo envía
+    elif formato == 'parquet':
+        esquema = pa.schema([(columna, pa.type_for_alias(TIPOS_PARQUET[tipo])) for columna, tipo in zip(columnas, tipos)])
+        filas = iter(filas)
+        with pq.ParquetWriter(archivo, esquema) as writer:
+            while True:
+                lote = list(islice(filas, PARQUET_FILAS_POR_GRUPO))
+                if not lote:
+                    break
+                writer.write_table(pa.Table.from_arrays([
+                    pa.array([_valor_parquet(valor, tipo) for valor in valores], type=campo.type)
+                    for valores, tipo, campo in zip(zip(*lote), tipos, esquema)
+                ], schema=esquema))
+    else:
+        wb = Workbook(write_only=True)
+        ws = hoja_exportacion(wb, titulo, columnas, anchos)
+        for fila in filas:
+            ws.append(fila)
+        wb.save(archivo)
+
+
 @app.route("/admin/descargar-excel")
 @login_required
 def admin_descargar_excel():
-    """Descargar lista de productos como Excel"""
+    """Descargar lista de productos como Excel (o CSV/Parquet con ?formato=)"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM producto ORDER BY codigo DESC")
-            productos = [dict(row) for row in cursor.fetchall()]
+        formato = formato_tabla(request.args.get('formato'))
         
-        # Crear workbook
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Productos"
-        
-        # Estilos
-        header_fill = PatternFill(start_color="6a1b9a", end_color="6a1b9a", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF", size=12)
-        header_alignment = Alignment(horizontal="center", vertical="center")
-        
-        # Encabezados
-        headers = ["ID", "Código", "Título", "Descripción", "Precio", "Mínimo", "Múltiplo", "Stock", "Categoría", "Activo"]
-        ws.append(headers)
-        
-        # Aplicar estilos a encabezados
-        for cell in ws[1]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = header_alignment
-        
-        # Agregar datos
-        for producto in productos:
-            ws.append([
-                producto.get('id', ''),
-                producto.get('codigo', ''),
-                producto.get('titulo', ''),
-                producto.get('descripcion', ''),
-                producto.get('precio', 0),
-                producto.get('minimo', 1),
-                producto.get('multiplo', 1),
-                producto.get('stock', 0),
-                producto.get('categoria', ''),
-                'Sí' if producto.get('activo', 1) == 1 else 'No'
-            ])
-        
-        # Ajustar ancho de columnas
-        column_widths = [8, 15, 40, 50, 12, 10, 10, 10, 20, 10]
-        for i, width in enumerate(column_widths, 1):
-            ws.column_dimensions[chr(64 + i)].width = width
-        
-        # Guardar en memoria
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
+        def escribir(archivo):
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT * FROM vista_producto ORDER BY codigo DESC")
+                filas = ([
+                    producto['id'],
+                    producto['codigo'],
+                    producto['titulo'],
+                    producto['descripcion'],
+                    producto['precio'],
+                    producto['minimo'],
+                    producto['multiplo'],
+                    producto['stock'],
+                    producto['categoria'],
+                    'Sí' if producto['activo'] == 1 else 'No'
+                ] for producto in cursor)
+                escribir_tabla(
+                    archivo, formato, "Productos", COLUMNAS_PRODUCTOS, filas,
+                    [8, 15, 40, 50, 12, 10, 10, 10, 20, 10], TIPOS_PRODUCTOS
+                )
         
         # Generar nombre de archivo con fecha
-        filename = f"productos_rmkits_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+        filename = f"productos_rmkits_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{formato}"
         
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name=filename
-        )
+        return enviar_exportacion(escribir, FORMATOS_TABLA[formato]['mimetype'], filename)
     
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('admin_productos'))
     except Exception as e:
         logger.error(f"Error al generar Excel: {e}")
         flash('Error al generar archivo Excel', 'error')
         return redirect(url_for('admin_productos'))
 
 
+# Columnas de la lista de productos (exportación e importación)
+COLUMNAS_PRODUCTOS = ["ID", "Código", "Título", "Descripción", "Precio", "Mínimo", "Múltiplo", "Stock", "Categoría", "Activo"]
+TIPOS_PRODUCTOS = [int, str, str, str, float, int, int, int, str, str]
+
+VALORES_ACTIVO = ('Sí', 'Si', 'SI', 'SÍ', 1, '1', True)
+
+# Errores de importación que se muestran en pantalla (el resto va al log)
+IMPORTACION_ERRORES_VISIBLES = 20
+
+# Upserts de la importación. Si el producto existe solo se escribe cuando
+# algo cambió: una lista de precios con pocos cambios casi no escribe
+_CAMBIOS_PRODUCTO = """
+    titulo = excluded.titulo, descripcion = excluded.descripcion, precio = excluded.precio,
+    minimo = excluded.minimo, multiplo = excluded.multiplo, stock = excluded.stock,
+    categoria_id = excluded.categoria_id, activo = excluded.activo
+"""
+_HAY_CAMBIOS_PRODUCTO = """
+    titulo IS NOT excluded.titulo OR descripcion IS NOT excluded.descripcion
+    OR precio IS NOT excluded.precio OR minimo IS NOT excluded.minimo
+    OR multiplo IS NOT excluded.multiplo OR stock IS NOT excluded.stock
+    OR categoria_id IS NOT excluded.categoria_id OR activo IS NOT excluded.activo
+"""
+SQL_IMPORTAR_POR_ID = f"""
+    INSERT INTO producto (id, codigo, titulo, descripcion, precio, minimo, multiplo, stock, imagen, imagen_version, categoria_id, activo)
+    VALUES (:id, :codigo, :titulo, :descripcion, :precio, :minimo, :multiplo, :stock, :imagen, :imagen_version, :categoria_id, :activo)
+    ON CONFLICT(id) DO UPDATE SET codigo = COALESCE(excluded.codigo, codigo), {_CAMBIOS_PRODUCTO}
+    WHERE codigo IS NOT COALESCE(excluded.codigo, codigo) OR {_HAY_CAMBIOS_PRODUCTO}
+"""
+SQL_IMPORTAR_POR_CODIGO = f"""
+    INSERT INTO producto (codigo, titulo, descripcion, precio, minimo, multiplo, stock, imagen, imagen_version, categoria_id, activo)
+    VALUES (:codigo, :titulo, :descripcion, :precio, :minimo, :multiplo, :stock, :imagen, :imagen_version, :categoria_id, :activo)
+    ON CONFLICT(codigo) DO UPDATE SET {_CAMBIOS_PRODUCTO}
+    WHERE {_HAY_CAMBIOS_PRODUCTO}
+"""
+
+
+def _valor_numerico(valor, tipo, columna, por_defecto):
+    """Convierte un valor de la planilla a int/float; vacío es por_defecto"""
+    if valor is None or valor == '':
+        return por_defecto
+    try:
+        return tipo(float(valor)) if tipo is int else tipo(valor)
+    except (TypeError, ValueError):
+        raise ValueError(f"{columna} inválido: {valor!r}")
+
+
+def validar_fila_producto(row):
+    """
+    Convierte una fila (en el orden de COLUMNAS_PRODUCTOS) en el dict del
+    producto. Lanza ValueError si algún valor no es válido.
+    """
+    row = tuple(row) + (None,) * (len(COLUMNAS_PRODUCTOS) - len(row))
+    codigo = str(row[1]).strip() if row[1] is not None else ''
+    return {
+        'id': _valor_numerico(row[0], int, 'ID', None),
+        'codigo': codigo or None,
+        'titulo': row[2],
+        'descripcion': row[3] or '',
+        'precio': _valor_numerico(row[4], float, 'Precio', 0),
+        'minimo': _valor_numerico(row[5], int, 'Mínimo', 1) or 1,
+        'multiplo': _valor_numerico(row[6], int, 'Múltiplo', 1) or 1,
+        'stock': _valor_numerico(row[7], int, 'Stock', 0),
+        'categoria': str(row[8]) if row[8] not in (None, '') else '',
+        'activo': 1 if row[9] in VALORES_ACTIVO else 0
+    }
+
+
+def _validar_encabezados(encabezados, columnas):
+    """Lanza ValueError si los encabezados no son columnas"""
+    if list(encabezados)[:len(columnas)] != columnas:
+        raise ValueError(f'El formato del archivo no es correcto. Se esperan las columnas: {", ".join(columnas)}')
+
+
+def leer_filas_excel(archivo, columnas):
+    """
+    Lee un Excel en modo solo lectura (sin cargarlo entero en memoria) y
+    devuelve (número de fila, valores) de las filas con datos.
+    Lanza ValueError si los encabezados no son columnas.
+    """
+    wb = load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        filas = wb.active.iter_rows(values_only=True)
+        _validar_encabezados(next(filas, ()), columnas)
+        for numero, row in enumerate(filas, start=2):
+            if any(valor not in (None, '') for valor in row):
+                yield numero, row
+    finally:
+        wb.close()
+
+
+def leer_filas_csv(archivo, columnas):
+    """
+    Lee un CSV (UTF-8, con o sin BOM) línea por línea, igual que
+    leer_filas_excel. Las celdas vacías se devuelven como None.
+    """
+    lector = csv.reader(codecs.iterdecode(archivo, 'utf-8-sig'))
+    _validar_encabezados(next(lector, []), columnas)
+    for row in lector:
+        row = [valor if valor != '' else None for valor in row]
+        row += [None] * (len(columnas) - len(row))
+        if any(valor is not None for valor in row):
+            yield lector.line_num, row
+
+
+def leer_filas_parquet(archivo, columnas):
+    """
+    Lee un Parquet de a un grupo de filas por vez. Las columnas se buscan
+    por nombre; las filas se numeran desde 1 (no hay fila de encabezados).
+    """
+    parquet = pq.ParquetFile(archivo)
+    faltantes = [columna for columna in columnas if columna not in parquet.schema_arrow.names]
+    if faltantes:
+        raise ValueError(f'Al archivo le faltan las columnas: {", ".join(faltantes)}')
+    numero = 0
+    for lote in parquet.iter_batches(columns=columnas):
+        datos = lote.to_pydict()
+        for row in zip(*(datos[columna] for columna in columnas)):
+            numero += 1
+            if any(valor not in (None, '') for valor in row):
+                yield numero, row
+
+
+def leer_filas(archivo, formato, columnas):
+    """Lee las filas de un archivo de importación según su formato"""
+    lectores = {'xlsx': leer_filas_excel, 'csv': leer_filas_csv, 'parquet': leer_filas_parquet}
+    return lectores[formato](archivo, columnas)
+
+
+def planificar_importacion_productos(cursor, filas, imagenes):
+    """
+    Valida las filas y decide qué hace cada una, sin tomar el lock de
+    escritura: con ID se actualiza o crea ese ID; sin ID se busca por código.
+    Los productos nuevos sin código reciben uno automático al aplicar.
+    imagenes es el índice de indice_imagenes().
+    Retorna (plan, errores); cada fila del plan lleva su número y su acción.
+    Lanza ValueError si hay códigos repetidos (los upserts por código
+    necesitan el índice único).
+    """
+    if not hay_codigo_unico(cursor):
+        duplicados = codigos_repetidos(cursor)
+        if duplicados:
+            raise ValueError(f"Hay códigos de producto repetidos, corregirlos antes de importar: {', '.join(map(str, duplicados))}")
+        raise ValueError('Falta el índice único por código: ejecutar flask migrar-db o reiniciar la app')
+
+    cursor.execute("SELECT id, codigo FROM producto")
+    codigo_de_id = {}
+    id_de_codigo = {}
+    for row in cursor.fetchall():
+        codigo_de_id[row['id']] = row['codigo']
+        if row['codigo'] is not None:
+            id_de_codigo[row['codigo']] = row['id']
+
+    plan = []
+    errores = []
+    for numero, row in filas:
+        try:
+            producto = validar_fila_producto(row)
+            id_producto, codigo = producto['id'], producto['codigo']
+
+            if id_producto is not None:
+                existe = id_producto in codigo_de_id
+                if codigo and id_de_codigo.get(codigo, id_producto) != id_producto:
+                    raise ValueError(f"el código {codigo} ya es de otro producto")
+            else:
+                existe = codigo in id_de_codigo
+
+            if not existe and not producto['titulo']:
+                raise ValueError("falta el título del producto nuevo")
+
+            if not existe:
+                # Buscar imagen automáticamente si no está en el Excel
+                producto['imagen'] = buscar_imagen_para_codigo(codigo, imagenes) if codigo else ''
+                producto['imagen_version'] = hash_imagen(producto['imagen'])
+            else:
+                producto['imagen'] = ''
+                producto['imagen_version'] = None
+
+            producto['fila'] = numero
+            producto['accion'] = 'actualizado' if existe else 'creado'
+            plan.append(producto)
+
+            # Las filas siguientes ya ven este producto (códigos repetidos en la planilla).
+            # Un código nuevo sin ID queda registrado con id None
+            if id_producto is not None:
+                if codigo:
+                    id_de_codigo.pop(codigo_de_id.get(id_producto), None)
+                    id_de_codigo[codigo] = id_producto
+                codigo_de_id[id_producto] = codigo or codigo_de_id.get(id_producto)
+            elif codigo:
+                id_de_codigo.setdefault(codigo, None)
+        except ValueError as e:
+            errores.append(f"Fila {numero}: {e}")
+    return plan, errores
+
+
+def _ejecutar_filas_importacion(cursor, sql, filas, errores):
+    """
+    Aplica las filas con executemany. Si alguna viola una restricción (por
+    ejemplo, otro admin creó el mismo código recién), repite el lote fila por
+    fila para informar cuál falló. Retorna las filas aplicadas.
+    """
+    if not filas:
+        return []
+    cursor.execute("SAVEPOINT importacion")
+    try:
+        cursor.executemany(sql, filas)
+        cursor.execute("RELEASE importacion")
+        return filas
+    except sqlite3.IntegrityError:
+        cursor.execute("ROLLBACK TO importacion")
+        cursor.execute("RELEASE importacion")
+
+    aplicadas = []
+    for fila in filas:
+        try:
+            cursor.execute(sql, fila)
+            aplicadas.append(fila)
+        except sqlite3.IntegrityError as e:
+            errores.append(f"Fila {fila['fila']}: {e}")
+    return aplicadas
+
+
+@con_reintentos
+def aplicar_importacion_productos(plan, errores, imagenes):
+    """
+    Escribe el plan en una sola transacción corta con upserts en lote.
+    Retorna (creados, actualizados).
+    """
+    errores_aplicacion = []
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Códigos automáticos para los nuevos sin código, reservados juntos
+            # (si se reintenta, se vuelven a reservar)
+            sin_codigo = [
+                fila for fila in plan
+                if fila['accion'] == 'creado' and (not fila['codigo'] or fila.get('codigo_automatico'))
+            ]
+            for fila, codigo in zip(sin_codigo, reservar_codigos_producto(cursor, len(sin_codigo))):
+                fila['codigo'] = codigo
+                fila['codigo_automatico'] = True
+                fila['imagen'] = buscar_imagen_para_codigo(codigo, imagenes)
+                fila['imagen_version'] = hash_imagen(fila['imagen'])
+
+            # Las filas traen el nombre de la categoría; producto guarda su id
+            categorias = ids_categorias(cursor, [fila['categoria'] for fila in plan])
+            for fila in plan:
+                fila['categoria_id'] = categorias.get(fila['categoria'])
+
+            aplicadas = _ejecutar_filas_importacion(
+                cursor, SQL_IMPORTAR_POR_ID, [fila for fila in plan if fila['id'] is not None], errores_aplicacion
+            ) + _ejecutar_filas_importacion(
+                cursor, SQL_IMPORTAR_POR_CODIGO, [fila for fila in plan if fila['id'] is None], errores_aplicacion
+            )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    errores.extend(errores_aplicacion)
+    creados = sum(1 for fila in aplicadas if fila['accion'] == 'creado')
+    return creados, len(aplicadas) - creados
+
+
+def informar_errores_importacion(errores):
+    """Muestra los primeros errores por fila y deja la lista completa en el log"""
+    if not errores:
+        return
+    logger.warning(f"Errores al importar productos: {errores}")
+    for error in errores[:IMPORTACION_ERRORES_VISIBLES]:
+        flash(error, 'warning')
+    if len(errores) > IMPORTACION_ERRORES_VISIBLES:
+        flash(f'... y {len(errores) - IMPORTACION_ERRORES_VISIBLES} errores más (ver el log)', 'warning')
+
+
+# Columnas que se comparan en la vista previa (además de precio y stock)
+COLUMNAS_COMPARADAS = ['codigo', 'titulo', 'descripcion', 'minimo', 'multiplo', 'categoria', 'activo']
+
+# Filas de cada tipo de cambio que se listan en la vista previa
+VISTA_PREVIA_FILAS = 200
+
+
+def diferencias_importacion(conn, plan):
+    """
+    Compara el plan con la tabla producto usando DataFrames: un join por ID
+    para las filas que lo traen y otro por código para el resto. Retorna
+    (resumen, cambios): el resumen para mostrar y el número de fila de las
+    filas del plan que crean o modifican algo.
+    """
+    columnas = ['id', 'codigo', 'titulo', 'descripcion', 'precio', 'minimo', 'multiplo', 'stock', 'categoria', 'activo']
+    actuales = pd.read_sql_query(f"SELECT {', '.join(columnas)} FROM vista_producto", conn)
+    nuevos = pd.DataFrame(plan, columns=['fila', 'accion'] + columnas)
+    # Mismo tipo de ID en los dos lados (vacíos, pandas los lee como object)
+    nuevos['id'] = pd.to_numeric(nuevos['id']).astype('float64')
+
+    por_id = nuevos[nuevos['id'].notna()].merge(
+        actuales.astype({'id': 'float64'}), on='id', how='left', suffixes=('', '_actual')
+    )
+    por_id['id_actual'] = por_id['id'].where(por_id['accion'] == 'actualizado')
+    # Sin ID se cruza por código (los nuevos sin código no tienen con qué cruzar)
+    por_codigo = nuevos[nuevos['id'].isna()].merge(
+        actuales[actuales['codigo'].notna()], on='codigo', how='left', suffixes=('', '_actual')
+    )
+    por_codigo['codigo_actual'] = por_codigo['codigo']
+    comparado = pd.concat([por_id, por_codigo], ignore_index=True)
+
+    existentes = comparado[comparado['accion'] == 'actualizado'].copy()
+    # Sin código en la planilla se conserva el actual
+    existentes['codigo'] = existentes['codigo'].fillna(existentes['codigo_actual'])
+
+    def distinto(columna):
+        nuevo = existentes[columna]
+        actual = existentes[f'{columna}_actual']
+        return ~((nuevo == actual) | (nuevo.isna() & actual.isna()))
+
+    cambia_precio = distinto('precio')
+    cambia_stock = distinto('stock')
+    cambia_otros = pd.Series(False, index=existentes.index)
+    for columna in COLUMNAS_COMPARADAS:
+        cambia_otros |= distinto(columna)
+
+    creados = comparado[comparado['accion'] == 'creado']
+    modificados = existentes[cambia_precio | cambia_stock | cambia_otros]
+    eliminados = actuales[~actuales['id'].isin(existentes['id_actual'])]
+
+    precios = existentes[cambia_precio].assign(
+        diferencia=lambda df: df['precio'] - df['precio_actual'],
+        porcentaje=lambda df: (df['precio'] / df['precio_actual'].where(df['precio_actual'] != 0) - 1) * 100
+    ).sort_values('porcentaje', key=lambda serie: serie.abs(), ascending=False)
+    stock = existentes[cambia_stock].assign(diferencia=lambda df: df['stock'] - df['stock_actual'])
+
+    def filas(df, columnas):
+        df = df[columnas].head(VISTA_PREVIA_FILAS)
+        return df.astype(object).where(df.notna(), None).to_dict('records')
+
+    resumen = {
+        'creados': len(creados),
+        'modificados': len(modificados),
+        'sin_cambios': len(existentes) - len(modificados),
+        'eliminados': len(eliminados),
+        'precios': len(precios),
+        'stock': len(stock),
+        'otros': int(cambia_otros.sum()),
+        'lista_creados': filas(creados, ['fila', 'codigo', 'titulo', 'precio', 'stock']),
+        'lista_precios': filas(precios, ['fila', 'codigo', 'titulo', 'precio_actual', 'precio', 'diferencia', 'porcentaje']),
+        'lista_stock': filas(stock, ['fila', 'codigo', 'titulo', 'stock_actual', 'stock', 'diferencia']),
+        'lista_eliminados': filas(eliminados, ['id', 'codigo', 'titulo', 'precio', 'stock']),
+        'limite': VISTA_PREVIA_FILAS
+    }
+    cambios = set(creados['fila']) | set(modificados['fila'])
+    return resumen, cambios
+
+
+def carpeta_importaciones_pendientes():
+    """Carpeta de las vistas previas de importación sin confirmar"""
+    carpeta = os.path.join(Config.PERSISTENT_DATA_PATH, 'importaciones')
+    os.makedirs(carpeta, exist_ok=True)
+    return carpeta
+
+
+def ruta_importacion_pendiente(token):
+    """Archivo donde queda el cambio calculado en la vista previa hasta confirmarlo"""
+    return os.path.join(carpeta_importaciones_pendientes(), f"{secure_filename(token)}.json")
+
+
+def importacion_vencida(ruta, ahora=None):
+    """True si la vista previa tiene más de Config.IMPORTACION_PENDIENTE_MINUTOS"""
+    ahora = time.time() if ahora is None else ahora
+    return ahora - os.path.getmtime(ruta) > Config.IMPORTACION_PENDIENTE_MINUTOS * 60
+
+
+def limpiar_importaciones_pendientes():
+    """
+    Borra las vistas previas vencidas (las que nadie confirmó ni canceló).
+    Retorna la cantidad de archivos borrados.
+    """
+    carpeta = carpeta_importaciones_pendientes()
+    ahora = time.time()
+    borrados = 0
+    with os.scandir(carpeta) as entradas:
+        for entrada in entradas:
+            try:
+                if entrada.is_file() and entrada.name.endswith('.json') and importacion_vencida(entrada.path, ahora):
+                    os.remove(entrada.path)
+                    borrados += 1
+            except FileNotFoundError:
+                # Otro worker lo borró al mismo tiempo
+                pass
+            except OSError as e:
+                logger.warning(f"No se pudo borrar la importación pendiente {entrada.name}: {e}")
+    return borrados
+
+
+def descartar_importacion_pendiente():
+    """Borra la importación pendiente de la sesión, si hay una"""
+    token = session.pop('importacion_productos', None)
+    if token:
+        try:
+            os.remove(ruta_importacion_pendiente(token))
+        except OSError:
+            pass
+
+
 @app.route("/admin/subir-excel", methods=["POST"])
 @login_required
 def admin_subir_excel():
-    """Subir archivo Excel para actualizar productos"""
+    """Subir archivo Excel (o CSV/Parquet) para actualizar productos"""
     try:
         if 'archivo' not in request.files:
             flash('No se seleccionó ningún archivo', 'error')
             return redirect(url_for('admin_productos'))
         
-        file = request.files['archivo']
-        
-        if file.filename == '':
+        file = request.files['archivo']
+        
+        if file.filename == '':
+            flash('No se seleccionó ningún archivo', 'error')
+            return redirect(url_for('admin_productos'))
+        
+        try:
+            formato = formato_tabla(request.form.get('formato'), file.filename)
+        except ValueError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('admin_productos'))
+        
+        # Leer y validar todo antes de tomar el lock de escritura. La carpeta
+        # de imágenes se lee una vez para todo el import
+        imagenes = indice_imagenes()
+        try:
+            with get_db_connection() as conn:
+                plan, errores = planificar_importacion_productos(
+                    conn.cursor(), leer_filas(file, formato, COLUMNAS_PRODUCTOS), imagenes
+                )
+        except ValueError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('admin_productos'))
+        
+        productos_creados, productos_actualizados = aplicar_importacion_productos(plan, errores, imagenes)
+        
+        checkpoint_wal('TRUNCATE')
+        
+        # Mensaje de resultado
+        mensaje = f'✅ Procesamiento completado: {productos_actualizados} actualizados, {productos_creados} creados'
+        if errores:
+            mensaje += f'. ⚠️ {len(errores)} errores encontrados'
+        
+        flash(mensaje, 'success' if not errores else 'warning')
+        informar_errores_importacion(errores)
+        return redirect(url_for('admin_productos'))
+    
+    except Exception as e:
+        logger.error(f"Error al procesar Excel: {e}")
+        flash(f'Error al procesar archivo: {str(e)}', 'error')
+        return redirect(url_for('admin_productos'))
+
+
+@app.route("/admin/subir-excel/vista-previa", methods=["POST"])
+@login_required
+def admin_subir_excel_vista_previa():
+    """Muestra qué cambiaría la importación del Excel sin aplicar nada"""
+    try:
+        if pd is None:
+            flash('La vista previa necesita pandas instalado', 'error')
+            return redirect(url_for('admin_productos'))
+        
+        file = request.files.get('archivo')
+        if not file or file.filename == '':
             flash('No se seleccionó ningún archivo', 'error')
             return redirect(url_for('admin_productos'))
         
-        if not file.filename.endswith(('.xlsx', '.xls')):
-            flash('El archivo debe ser un Excel (.xlsx o .xls)', 'error')
+        try:
+            formato = formato_tabla(request.form.get('formato'), file.filename)
+        except ValueError as e:
+            flash(str(e), 'error')
             return redirect(url_for('admin_productos'))
         
-        # Leer el archivo Excel
-        wb = load_workbook(file)
-        ws = wb.active
+        imagenes = indice_imagenes()
+        try:
+            with get_db_connection() as conn:
+                plan, errores = planificar_importacion_productos(
+                    conn.cursor(), leer_filas(file, formato, COLUMNAS_PRODUCTOS), imagenes
+                )
+                resumen, cambios = diferencias_importacion(conn, plan)
+        except ValueError as e:
+            flash(str(e), 'error')
+            return redirect(url_for('admin_productos'))
         
-        # Verificar encabezados
-        headers = [cell.value for cell in ws[1]]
-        expected_headers = ["ID", "Código", "Título", "Descripción", "Precio", "Mínimo", "Múltiplo", "Stock", "Categoría", "Activo"]
+        # Solo se guardan las filas que cambian algo; se aplican al confirmar
+        descartar_importacion_pendiente()
+        limpiar_importaciones_pendientes()
+        token = uuid.uuid4().hex
+        with open(ruta_importacion_pendiente(token), 'w', encoding='utf-8') as f:
+            json.dump([fila for fila in plan if fila['fila'] in cambios], f)
+        session['importacion_productos'] = token
         
-        if headers != expected_headers:
-            flash(f'El formato del archivo no es correcto. Se esperan las columnas: {", ".join(expected_headers)}', 'error')
+        return render_template(
+            "admin/importar_vista_previa.html",
+            resumen=resumen,
+            errores=errores[:IMPORTACION_ERRORES_VISIBLES],
+            total_errores=len(errores),
+            archivo=file.filename
+        )
+    
+    except Exception as e:
+        logger.error(f"Error en vista previa de Excel: {e}")
+        flash(f'Error al procesar archivo: {str(e)}', 'error')
+        return redirect(url_for('admin_productos'))
+
+
+@app.route("/admin/subir-excel/confirmar", methods=["POST"])
+@login_required
+def admin_subir_excel_confirmar():
+    """Aplica los cambios calculados en la vista previa"""
+    try:
+        token = session.get('importacion_productos')
+        try:
+            ruta = ruta_importacion_pendiente(token or '')
+            if importacion_vencida(ruta):
+                descartar_importacion_pendiente()
+                raise ValueError('vista previa vencida')
+            with open(ruta, encoding='utf-8') as f:
+                plan = json.load(f)
+        except (OSError, ValueError):
+            flash('No hay una importación pendiente: volvé a subir el archivo', 'error')
             return redirect(url_for('admin_productos'))
         
-        # Procesar filas
-        productos_actualizados = 0
-        productos_creados = 0
         errores = []
+        productos_creados, productos_actualizados = aplicar_importacion_productos(plan, errores, indice_imagenes())
+        descartar_importacion_pendiente()
         
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            for row_idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-                try:
-                    id_producto = row[0]
-                    codigo = row[1]
-                    titulo = row[2]
-                    descripcion = row[3] or ''
-                    precio = float(row[4]) if row[4] else 0
-                    minimo = int(row[5]) if row[5] else 1
-                    multiplo = int(row[6]) if row[6] else 1
-                    stock = int(row[7]) if row[7] else 0
-                    categoria = row[8] or ''
-                    activo = 1 if row[9] in ['Sí', 'Si', 'SI', 'SÍ', 1, '1', True] else 0
-                    
-                    # Verificar si el producto existe por ID o código
-                    if id_producto:
-                        cursor.execute("SELECT id FROM producto WHERE id = ?", (id_producto,))
-                        existe = cursor.fetchone()
-                        
-                        if existe:
-                            # Actualizar producto existente
-                            cursor.execute("""
-                                UPDATE producto 
-                                SET codigo=?, titulo=?, descripcion=?, precio=?, minimo=?, multiplo=?, stock=?, categoria=?, activo=?
-                                WHERE id=?
-                            """, (codigo, titulo, descripcion, precio, minimo, multiplo, stock, categoria, activo, id_producto))
-                            productos_actualizados += 1
-                        else:
-                            # Crear nuevo producto con ID específico
-                            # Buscar imagen automáticamente si no está en el Excel
-                            imagen_auto = buscar_imagen_para_codigo(codigo)
-                            cursor.execute("""
-                                INSERT INTO producto (id, codigo, titulo, descripcion, precio, minimo, multiplo, stock, imagen, categoria, activo)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            """, (id_producto, codigo, titulo, descripcion, precio, minimo, multiplo, stock, imagen_auto, categoria, activo))
-                            productos_creados += 1
-                    else:
-                        # Buscar por código si no hay ID
-                        cursor.execute("SELECT id FROM producto WHERE codigo = ?", (codigo,))
-                        existe = cursor.fetchone()
-                        
-                        if existe:
-                            # Actualizar producto existente
-                            cursor.execute("""
-                                UPDATE producto 
-                                SET titulo=?, descripcion=?, precio=?, minimo=?, multiplo=?, stock=?, categoria=?, activo=?
-                                WHERE codigo=?
-                            """, (titulo, descripcion, precio, minimo, multiplo, stock, categoria, activo, codigo))
-                            productos_actualizados += 1
-                        else:
-                            # Crear nuevo producto
-                            # Buscar imagen automáticamente si no está en el Excel
-                            imagen_auto = buscar_imagen_para_codigo(codigo)
-                            cursor.execute("""
-                                INSERT INTO producto (codigo, titulo, descripcion, precio, minimo, multiplo, stock, imagen, categoria, activo)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                            """, (codigo, titulo, descripcion, precio, minimo, multiplo, stock, imagen_auto, categoria, activo))
-                            productos_creados += 1
-                
-                except Exception as e:
-                    errores.append(f"Fila {row_idx}: {str(e)}")
-            
-            conn.commit()
+        checkpoint_wal('TRUNCATE')
         
-        # Mensaje de resultado
-        mensaje = f'✅ Procesamiento completado: {productos_actualizados} actualizados, {productos_creados} creados'
+        mensaje = f'✅ Importación confirmada: {productos_actualizados} actualizados, {productos_creados} creados'
         if errores:
             mensaje += f'. ⚠️ {len(errores)} errores encontrados'
-            logger.warning(f"Errores al importar Excel: {errores}")
         
         flash(mensaje, 'success' if not errores else 'warning')
+        informar_errores_importacion(errores)
         return redirect(url_for('admin_productos'))
     
     except Exception as e:
-        logger.error(f"Error al procesar Excel: {e}")
-        flash(f'Error al procesar archivo: {str(e)}', 'error')
+        logger.error(f"Error al confirmar importación: {e}")
+        flash(f'Error al aplicar la importación: {str(e)}', 'error')
         return redirect(url_for('admin_productos'))
 
 
@@ -1310,9 +3768,8 @@ def admin_pedidos():
             # Solo se marcan los pedidos que están en alguno de esos estados.
             conteos = contar_pedidos_concretados_por_cliente(cursor)
             for pedido in pedidos:
-                estado = (pedido.get('estado') or '').strip().lower()
-                clave = normalizar_telefono(pedido.get('cliente_telefono'))
-                if estado in ESTADOS_PEDIDO_REALIZADO and clave:
+                clave = pedido.get('cliente_telefono_clave')
+                if pedido.get('estado') in ESTADOS_PEDIDO_REALIZADO and clave:
                     pedido['pedidos_cliente'] = conteos.get(clave, 0)
                 else:
                     pedido['pedidos_cliente'] = 0
@@ -1324,6 +3781,43 @@ def admin_pedidos():
         return redirect(url_for('admin_dashboard'))
 
 
+@con_reintentos
+def insertar_pedido_manual(data, estado):
+    """Inserta un pedido cargado desde el panel y retorna su id"""
+    # Preparar productos para JSON
+    productos_json = json.dumps(data['productos'])
+    
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        
+        cursor.execute("""
+            INSERT INTO pedido (cliente_nombre, cliente_telefono, cliente_email,
+                               metodo_entrega, envio_direccion, envio_localidad,
+                               envio_provincia, envio_cp, envio_nombre_destinatario,
+                               productos, total, estado, cliente_telefono_clave)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            data['cliente_nombre'],
+            data['cliente_telefono'],
+            data.get('cliente_email', ''),
+            data['metodo_entrega'],
+            data.get('envio_direccion', ''),
+            data.get('envio_localidad', ''),
+            data.get('envio_provincia', ''),
+            data.get('envio_cp', ''),
+            data.get('envio_nombre_destinatario', ''),
+            productos_json,
+            data['total'],
+            estado,
+            normalizar_telefono(data['cliente_telefono'])
+        ))
+        
+        pedido_id = cursor.lastrowid
+        guardar_items_pedido(cursor, pedido_id, data['productos'])
+        conn.commit()
+    return pedido_id
+
+
 @app.route("/admin/cargar-pedido-manual", methods=['POST'])
 @login_required
 def admin_cargar_pedido_manual():
@@ -1331,35 +3825,12 @@ def admin_cargar_pedido_manual():
     try:
         data = request.json
         
-        # Preparar productos para JSON
-        productos_json = json.dumps(data['productos'])
+        # Sin estado el pedido manual queda pendiente, como antes
+        estado = normalizar_estado(data.get('estado') or 'pendiente')
+        if not estado:
+            return jsonify({'success': False, 'error': 'Estado inválido'}), 400
         
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            cursor.execute("""
-                INSERT INTO pedido (cliente_nombre, cliente_telefono, cliente_email,
-                                   metodo_entrega, envio_direccion, envio_localidad,
-                                   envio_provincia, envio_cp, envio_nombre_destinatario,
-                                   productos, total, estado)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                data['cliente_nombre'],
-                data['cliente_telefono'],
-                data.get('cliente_email', ''),
-                data['metodo_entrega'],
-                data.get('envio_direccion', ''),
-                data.get('envio_localidad', ''),
-                data.get('envio_provincia', ''),
-                data.get('envio_cp', ''),
-                data.get('envio_nombre_destinatario', ''),
-                productos_json,
-                data['total'],
-                data.get('estado', 'pendiente')
-            ))
-            
-            pedido_id = cursor.lastrowid
-            conn.commit()
+        pedido_id = insertar_pedido_manual(data, estado)
         
         return jsonify({'success': True, 'pedido_id': pedido_id}), 200
     
@@ -1371,150 +3842,90 @@ def admin_cargar_pedido_manual():
         return redirect(url_for('admin_dashboard'))
 
 
+# Columnas de los dos archivos de pedidos (exportación e importación)
+COLUMNAS_PEDIDOS = [
+    "ID", "Fecha", "Cliente", "CUIT", "Teléfono", "Email",
+    "Método Entrega", "Dirección Envío", "Localidad", "Provincia",
+    "CP", "Destinatario", "Referencias", "Total", "Estado"
+]
+TIPOS_PEDIDOS = [int, str, str, str, str, str, str, str, str, str, str, str, str, float, str]
+COLUMNAS_ITEMS_PEDIDO = ["Pedido ID", "Código", "Cantidad"]
+TIPOS_ITEMS_PEDIDO = [int, str, int]
+
+
 @app.route("/admin/pedidos/exportar")
 @login_required
 def admin_exportar_pedidos():
-    """Exportar pedidos a Excel - Genera 2 archivos en un ZIP"""
+    """Exportar pedidos a Excel (o CSV/Parquet con ?formato=) - Genera 2 archivos en un ZIP"""
     try:
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM pedido ORDER BY fecha DESC")
-            pedidos = [dict(row) for row in cursor.fetchall()]
-        
-        # Estilos comunes
-        header_fill = PatternFill(start_color="6a1b9a", end_color="6a1b9a", fill_type="solid")
-        header_font = Font(color="FFFFFF", bold=True, size=12)
-        header_alignment = Alignment(horizontal="center", vertical="center")
-        
-        # ===== ARCHIVO 1: DATOS DEL PEDIDO =====
-        wb_datos = Workbook()
-        ws_datos = wb_datos.active
-        ws_datos.title = "Datos Pedidos"
-        
-        # Encabezados para datos
-        headers = [
-            "ID", "Fecha", "Cliente", "CUIT", "Teléfono", "Email", 
-            "Método Entrega", "Dirección Envío", "Localidad", "Provincia", 
-            "CP", "Destinatario", "Referencias", "Total", "Estado"
-        ]
-        
-        for col_num, header in enumerate(headers, 1):
-            cell = ws_datos.cell(row=1, column=col_num)
-            cell.value = header
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = header_alignment
-        
-        # Datos de pedidos
-        for row_num, pedido in enumerate(pedidos, 2):
-            ws_datos.cell(row=row_num, column=1, value=pedido.get('id', ''))
-            
-            # Formatear fecha
-            fecha = pedido.get('fecha', '')
-            if fecha:
-                try:
-                    fecha_obj = datetime.strptime(fecha, '%Y-%m-%d %H:%M:%S')
-                    fecha = fecha_obj.strftime('%d/%m/%Y %H:%M')
-                except:
-                    pass
-            ws_datos.cell(row=row_num, column=2, value=fecha)
-            
-            ws_datos.cell(row=row_num, column=3, value=pedido.get('cliente_nombre', ''))
-            ws_datos.cell(row=row_num, column=4, value=pedido.get('cliente_cuit', ''))
-            ws_datos.cell(row=row_num, column=5, value=pedido.get('cliente_telefono', ''))
-            ws_datos.cell(row=row_num, column=6, value=pedido.get('cliente_email', ''))
-            ws_datos.cell(row=row_num, column=7, value=pedido.get('metodo_entrega', ''))
-            ws_datos.cell(row=row_num, column=8, value=pedido.get('envio_direccion', ''))
-            ws_datos.cell(row=row_num, column=9, value=pedido.get('envio_localidad', ''))
-            ws_datos.cell(row=row_num, column=10, value=pedido.get('envio_provincia', ''))
-            ws_datos.cell(row=row_num, column=11, value=pedido.get('envio_cp', ''))
-            ws_datos.cell(row=row_num, column=12, value=pedido.get('envio_nombre_destinatario', ''))
-            ws_datos.cell(row=row_num, column=13, value=pedido.get('envio_referencias', ''))
-            
-            # Total como número
-            total = pedido.get('total', 0)
-            ws_datos.cell(row=row_num, column=14, value=total)
-            
-            ws_datos.cell(row=row_num, column=15, value=pedido.get('estado', 'pendiente'))
-        
-        # Ajustar ancho de columnas datos
-        ws_datos.column_dimensions['A'].width = 8
-        ws_datos.column_dimensions['B'].width = 18
-        ws_datos.column_dimensions['C'].width = 25
-        ws_datos.column_dimensions['D'].width = 15
-        ws_datos.column_dimensions['E'].width = 15
-        ws_datos.column_dimensions['F'].width = 30
-        ws_datos.column_dimensions['G'].width = 15
-        ws_datos.column_dimensions['H'].width = 35
-        ws_datos.column_dimensions['I'].width = 20
-        ws_datos.column_dimensions['J'].width = 15
-        ws_datos.column_dimensions['K'].width = 10
-        ws_datos.column_dimensions['L'].width = 25
-        ws_datos.column_dimensions['M'].width = 30
-        ws_datos.column_dimensions['N'].width = 12
-        ws_datos.column_dimensions['O'].width = 12
-        
-        # ===== ARCHIVO 2: PRODUCTOS DEL PEDIDO =====
-        wb_productos = Workbook()
-        ws_productos = wb_productos.active
-        ws_productos.title = "Productos Pedidos"
-        
-        # Encabezados para productos
-        prod_headers = ["Pedido ID", "Código", "Cantidad"]
-        for col_num, header in enumerate(prod_headers, 1):
-            cell = ws_productos.cell(row=1, column=col_num)
-            cell.value = header
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = header_alignment
-        
-        # Agregar productos
-        prod_row = 2
-        for pedido in pedidos:
-            try:
-                productos = json.loads(pedido.get('productos', '[]'))
-                for prod in productos:
-                    ws_productos.cell(row=prod_row, column=1, value=pedido.get('id', ''))
-                    ws_productos.cell(row=prod_row, column=2, value=prod.get('codigo', ''))
-                    ws_productos.cell(row=prod_row, column=3, value=prod.get('cantidad', 1))
-                    prod_row += 1
-            except:
-                pass
-        
-        # Ajustar ancho de columnas productos
-        ws_productos.column_dimensions['A'].width = 10
-        ws_productos.column_dimensions['B'].width = 15
-        ws_productos.column_dimensions['C'].width = 10
-        
-        # Guardar ambos archivos en memoria
-        output_datos = BytesIO()
-        wb_datos.save(output_datos)
-        output_datos.seek(0)
+        fecha_actual = datetime.now().strftime('%Y%m%d_%H%M%S')
+        formato = formato_tabla(request.args.get('formato'))
         
-        output_productos = BytesIO()
-        wb_productos.save(output_productos)
-        output_productos.seek(0)
+        def filas_datos(cursor):
+            """Archivo 1: datos de los pedidos"""
+            cursor.execute("SELECT * FROM pedido ORDER BY fecha DESC")
+            for pedido in cursor:
+                # Formatear fecha
+                fecha = pedido['fecha'] or ''
+                if fecha:
+                    try:
+                        fecha_obj = datetime.strptime(fecha, '%Y-%m-%d %H:%M:%S')
+                        fecha = fecha_obj.strftime('%d/%m/%Y %H:%M')
+                    except:
+                        pass
+                
+                yield [
+                    pedido['id'],
+                    fecha,
+                    pedido['cliente_nombre'],
+                    pedido['cliente_cuit'],
+                    pedido['cliente_telefono'],
+                    pedido['cliente_email'],
+                    pedido['metodo_entrega'],
+                    pedido['envio_direccion'],
+                    pedido['envio_localidad'],
+                    pedido['envio_provincia'],
+                    pedido['envio_cp'],
+                    pedido['envio_nombre_destinatario'],
+                    pedido['envio_referencias'],
+                    pedido['total'],  # Total como número
+                    pedido['estado'] or 'pendiente'
+                ]
         
-        # Crear ZIP con ambos archivos
-        zip_buffer = BytesIO()
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            fecha_actual = datetime.now().strftime('%Y%m%d_%H%M%S')
-            zip_file.writestr(f'pedidos_datos_{fecha_actual}.xlsx', output_datos.getvalue())
-            zip_file.writestr(f'pedidos_productos_{fecha_actual}.xlsx', output_productos.getvalue())
+        def filas_productos(cursor):
+            """Archivo 2: productos de los pedidos"""
+            cursor.execute("""
+                SELECT pi.pedido_id, pi.codigo, pi.cantidad
+                FROM pedido_item pi
+                JOIN pedido p ON p.id = pi.pedido_id
+                ORDER BY p.fecha DESC, pi.id
+            """)
+            for item in cursor:
+                yield [item['pedido_id'], item['codigo'], item['cantidad']]
         
-        zip_buffer.seek(0)
+        def escribir(archivo):
+            # Cada archivo se escribe directo dentro de su entrada del ZIP
+            with get_db_connection() as conn, zipfile.ZipFile(archivo, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+                cursor = conn.cursor()
+                with zip_file.open(f'pedidos_datos_{fecha_actual}.{formato}', 'w') as entrada:
+                    escribir_tabla(
+                        entrada, formato, "Datos Pedidos", COLUMNAS_PEDIDOS, filas_datos(cursor),
+                        [8, 18, 25, 15, 15, 30, 15, 35, 20, 15, 10, 25, 30, 12, 12], TIPOS_PEDIDOS
+                    )
+                with zip_file.open(f'pedidos_productos_{fecha_actual}.{formato}', 'w') as entrada:
+                    escribir_tabla(
+                        entrada, formato, "Productos Pedidos", COLUMNAS_ITEMS_PEDIDO, filas_productos(cursor),
+                        [10, 15, 10], TIPOS_ITEMS_PEDIDO
+                    )
         
         # Generar nombre de archivo con fecha
-        fecha_actual = datetime.now().strftime('%Y%m%d_%H%M%S')
         filename = f"pedidos_rmkits_{fecha_actual}.zip"
         
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name=filename
-        )
+        return enviar_exportacion(escribir, 'application/zip', filename)
         
+    except ValueError as e:
+        flash(str(e), 'error')
+        return redirect(url_for('admin_pedidos'))
     except Exception as e:
         logger.error(f"Error al exportar pedidos: {e}")
         flash('Error al exportar pedidos', 'error')
@@ -1540,10 +3951,106 @@ def admin_eliminar_pedido(id):
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@con_reintentos
+def guardar_pedidos_importados(filas, productos_por_pedido):
+    """
+    Inserta (o reemplaza por ID) los pedidos importados en una sola
+    transacción. Las filas vienen en el orden de COLUMNAS_PEDIDOS.
+    Retorna la cantidad de pedidos importados.
+    """
+    pedidos_importados = 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        
+        for row in filas:
+            # Verificar que la fila tenga datos
+            if not row[0]:  # Si no hay ID, saltar
+                continue
+            
+            # Extraer datos de la fila
+            # [ID, Fecha, Cliente, CUIT, Teléfono, Email, Método Entrega, Dirección Envío, 
+            #  Localidad, Provincia, CP, Destinatario, Referencias, Total, Estado]
+            
+            pedido_id = _valor_numerico(row[0], int, 'ID', None)
+            
+            fecha_str = row[1] if row[1] else datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            if isinstance(fecha_str, datetime):
+                fecha_str = fecha_str.strftime('%Y-%m-%d %H:%M:%S')
+            elif isinstance(fecha_str, str):
+                # Intentar parsear si es string en formato dd/mm/yyyy
+                try:
+                    fecha_obj = datetime.strptime(fecha_str, '%d/%m/%Y %H:%M')
+                    fecha_str = fecha_obj.strftime('%Y-%m-%d %H:%M:%S')
+                except:
+                    try:
+                        fecha_obj = datetime.strptime(fecha_str, '%d/%m/%Y')
+                        fecha_str = fecha_obj.strftime('%Y-%m-%d %H:%M:%S')
+                    except:
+                        fecha_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            
+            # Obtener productos para este pedido y buscar sus datos en la BD
+            productos_json = '[]'
+            if pedido_id in productos_por_pedido:
+                productos_data = productos_por_pedido[pedido_id]
+                productos = []
+                
+                for prod_data in productos_data:
+                    codigo = prod_data['codigo']
+                    cantidad = prod_data['cantidad']
+                    # Buscar el producto en la base de datos
+                    cursor.execute("SELECT codigo, titulo, precio FROM producto WHERE codigo = ?", (codigo,))
+                    prod_row = cursor.fetchone()
+                    if prod_row:
+                        productos.append({
+                            'codigo': prod_row[0],
+                            'titulo': prod_row[1],
+                            'cantidad': cantidad,  # Cantidad del Excel
+                            'precio': prod_row[2]
+                        })
+                
+                productos_json = json.dumps(productos)
+            
+            # Insertar o reemplazar el pedido respetando el ID del Excel
+            # Si el ID ya existe, se actualizará; si no existe, se insertará.
+            # El borrado explícito dispara los triggers (ítems y ventas diarias),
+            # que el REPLACE de SQLite no dispara.
+            cursor.execute("DELETE FROM pedido WHERE id = ?", (pedido_id,))
+            cursor.execute("""
+                INSERT OR REPLACE INTO pedido (id, fecha, cliente_nombre, cliente_cuit, cliente_telefono, 
+                                   cliente_email, metodo_entrega, envio_direccion, envio_localidad,
+                                   envio_provincia, envio_cp, envio_nombre_destinatario, 
+                                   envio_referencias, productos, total, estado, cliente_telefono_clave)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (
+                pedido_id,  # ID del Excel (número de pedido)
+                fecha_str,
+                row[2] if row[2] else '',  # cliente_nombre
+                row[3] if row[3] else '',  # cliente_cuit
+                row[4] if row[4] else '',  # cliente_telefono
+                row[5] if row[5] else '',  # cliente_email
+                row[6] if row[6] else 'retiro',  # metodo_entrega
+                row[7] if row[7] else '',  # envio_direccion
+                row[8] if row[8] else '',  # envio_localidad
+                row[9] if row[9] else '',  # envio_provincia
+                row[10] if row[10] else '',  # envio_cp
+                row[11] if row[11] else '',  # envio_nombre_destinatario
+                row[12] if row[12] else '',  # envio_referencias
+                productos_json,  # productos desde el segundo Excel
+                _valor_numerico(row[13], float, 'Total', 0),  # total
+                normalizar_estado(row[14], por_defecto='pendiente'),  # estado
+                normalizar_telefono(str(row[4])) if row[4] else None  # clave del cliente
+            ))
+            guardar_items_pedido(cursor, pedido_id or cursor.lastrowid, productos_json)
+            pedidos_importados += 1
+        
+        conn.commit()
+    return pedidos_importados
+
+
 @app.route("/admin/pedidos/importar", methods=["POST"])
 @login_required
 def admin_importar_pedidos():
-    """Importar pedidos desde dos archivos Excel (datos y productos)"""
+    """Importar pedidos desde dos archivos Excel, CSV o Parquet (datos y productos)"""
     try:
         # Validar que se recibieron ambos archivos
         if 'archivo_datos' not in request.files or 'archivo_productos' not in request.files:
@@ -1557,27 +4064,22 @@ def admin_importar_pedidos():
             flash('Debes seleccionar ambos archivos', 'error')
             return redirect(url_for('admin_pedidos'))
         
-        if not file_datos.filename.endswith(('.xlsx', '.xls')) or not file_productos.filename.endswith(('.xlsx', '.xls')):
-            flash('Ambos archivos deben ser Excel (.xlsx o .xls)', 'error')
+        try:
+            formato_datos = formato_tabla(request.form.get('formato'), file_datos.filename)
+            formato_productos = formato_tabla(request.form.get('formato'), file_productos.filename)
+        except ValueError as e:
+            flash(str(e), 'error')
             return redirect(url_for('admin_pedidos'))
         
-        # Leer archivo de datos
-        wb_datos = load_workbook(file_datos)
-        ws_datos = wb_datos.active
-        
-        # Leer archivo de productos
-        wb_productos = load_workbook(file_productos)
-        ws_productos = wb_productos.active
-        
         # Primero, construir un diccionario de productos por pedido
         productos_por_pedido = {}
-        for row in ws_productos.iter_rows(min_row=2, values_only=True):
+        for _, row in leer_filas(file_productos, formato_productos, COLUMNAS_ITEMS_PEDIDO):
             if not row[0]:  # Si no hay Pedido ID, saltar
                 continue
             
-            pedido_id = int(row[0])
-            codigo = row[1] if row[1] else ''
-            cantidad = int(row[2]) if row[2] else 1
+            pedido_id = _valor_numerico(row[0], int, 'Pedido ID', None)
+            codigo = str(row[1]) if row[1] else ''
+            cantidad = _valor_numerico(row[2], int, 'Cantidad', 1) or 1
             
             if pedido_id not in productos_por_pedido:
                 productos_por_pedido[pedido_id] = []
@@ -1585,90 +4087,12 @@ def admin_importar_pedidos():
             if codigo:
                 productos_por_pedido[pedido_id].append({'codigo': codigo, 'cantidad': cantidad})
         
-        # Ahora importar los datos de los pedidos
-        pedidos_importados = 0
+        # Ahora importar los datos de los pedidos (se leen antes, así un reintento
+        # por base bloqueada vuelve a escribir las mismas filas)
+        filas_pedidos = [row for _, row in leer_filas(file_datos, formato_datos, COLUMNAS_PEDIDOS)]
+        pedidos_importados = guardar_pedidos_importados(filas_pedidos, productos_por_pedido)
         
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Leer desde la fila 2 (la 1 son encabezados)
-            for row in ws_datos.iter_rows(min_row=2, values_only=True):
-                # Verificar que la fila tenga datos
-                if not row[0]:  # Si no hay ID, saltar
-                    continue
-                
-                # Extraer datos de la fila
-                # [ID, Fecha, Cliente, CUIT, Teléfono, Email, Método Entrega, Dirección Envío, 
-                #  Localidad, Provincia, CP, Destinatario, Referencias, Total, Estado]
-                
-                pedido_id = int(row[0]) if row[0] else None
-                
-                fecha_str = row[1] if row[1] else datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                if isinstance(fecha_str, datetime):
-                    fecha_str = fecha_str.strftime('%Y-%m-%d %H:%M:%S')
-                elif isinstance(fecha_str, str):
-                    # Intentar parsear si es string en formato dd/mm/yyyy
-                    try:
-                        fecha_obj = datetime.strptime(fecha_str, '%d/%m/%Y %H:%M')
-                        fecha_str = fecha_obj.strftime('%Y-%m-%d %H:%M:%S')
-                    except:
-                        try:
-                            fecha_obj = datetime.strptime(fecha_str, '%d/%m/%Y')
-                            fecha_str = fecha_obj.strftime('%Y-%m-%d %H:%M:%S')
-                        except:
-                            fecha_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                
-                # Obtener productos para este pedido y buscar sus datos en la BD
-                productos_json = '[]'
-                if pedido_id in productos_por_pedido:
-                    productos_data = productos_por_pedido[pedido_id]
-                    productos = []
-                    
-                    for prod_data in productos_data:
-                        codigo = prod_data['codigo']
-                        cantidad = prod_data['cantidad']
-                        # Buscar el producto en la base de datos
-                        cursor.execute("SELECT codigo, titulo, precio FROM producto WHERE codigo = ?", (codigo,))
-                        prod_row = cursor.fetchone()
-                        if prod_row:
-                            productos.append({
-                                'codigo': prod_row[0],
-                                'titulo': prod_row[1],
-                                'cantidad': cantidad,  # Cantidad del Excel
-                                'precio': prod_row[2]
-                            })
-                    
-                    productos_json = json.dumps(productos)
-                
-                # Insertar o reemplazar el pedido respetando el ID del Excel
-                # Si el ID ya existe, se actualizará; si no existe, se insertará
-                cursor.execute("""
-                    INSERT OR REPLACE INTO pedido (id, fecha, cliente_nombre, cliente_cuit, cliente_telefono, 
-                                       cliente_email, metodo_entrega, envio_direccion, envio_localidad,
-                                       envio_provincia, envio_cp, envio_nombre_destinatario, 
-                                       envio_referencias, productos, total, estado)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    pedido_id,  # ID del Excel (número de pedido)
-                    fecha_str,
-                    row[2] if row[2] else '',  # cliente_nombre
-                    row[3] if row[3] else '',  # cliente_cuit
-                    row[4] if row[4] else '',  # cliente_telefono
-                    row[5] if row[5] else '',  # cliente_email
-                    row[6] if row[6] else 'retiro',  # metodo_entrega
-                    row[7] if row[7] else '',  # envio_direccion
-                    row[8] if row[8] else '',  # envio_localidad
-                    row[9] if row[9] else '',  # envio_provincia
-                    row[10] if row[10] else '',  # envio_cp
-                    row[11] if row[11] else '',  # envio_nombre_destinatario
-                    row[12] if row[12] else '',  # envio_referencias
-                    productos_json,  # productos desde el segundo Excel
-                    row[13] if row[13] else 0,  # total
-                    row[14] if row[14] else 'pendiente'  # estado
-                ))
-                pedidos_importados += 1
-            
-            conn.commit()
+        checkpoint_wal('TRUNCATE')
         
         flash(f'✅ {pedidos_importados} pedido(s) importado(s) correctamente', 'success')
         return redirect(url_for('admin_pedidos'))
@@ -1679,25 +4103,56 @@ def admin_importar_pedidos():
         return redirect(url_for('admin_pedidos'))
 
 
+# Estados posibles de un pedido, tal como se guardan en la base
+ESTADOS_PEDIDO = (
+    'pendiente', 'recibido', 'confirmado', 'preparando', 'pagado',
+    'completado', 'cancelado', 'impreso', 'señado', 'preparado'
+)
+
+# Estados que cuentan como venta facturada en el dashboard
+ESTADOS_PEDIDO_FACTURADO = ('pagado', 'completado', 'impreso', 'preparado')
+
+
+def normalizar_estado(estado, por_defecto=None):
+    """
+    Devuelve el estado canónico (minúsculas, sin espacios) aceptando
+    variantes como ' Pagado ' o 'senado'. Si está vacío o no es un estado
+    conocido retorna por_defecto.
+    """
+    texto = normalizar_texto(estado)
+    if not texto:
+        return por_defecto
+    for valido in ESTADOS_PEDIDO:
+        if normalizar_texto(valido) == texto:
+            return valido
+    return por_defecto
+
+
+@con_reintentos
+def cambiar_estado_pedido(id, estado):
+    """Guarda el estado del pedido; retorna False si el pedido no existe"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE pedido SET estado = ? WHERE id = ?", (estado, id))
+        conn.commit()
+        return cursor.rowcount > 0
+
+
 @app.route("/admin/pedido/<int:id>/estado", methods=["POST"])
 @login_required
 def admin_pedido_estado(id):
     """Cambiar estado de un pedido"""
     try:
-        data = request.get_json()
-        nuevo_estado = data.get('estado')
+        data = request.get_json(silent=True) or {}
+        if not normalizar_texto(data.get('estado')):
+            return jsonify({'success': False, 'error': 'Falta el estado'}), 400
         
-        estados_validos = ['pendiente', 'recibido', 'confirmado', 'preparando', 'pagado', 'completado', 'cancelado', 'impreso', 'señado', 'preparado']
-        if nuevo_estado not in estados_validos:
+        nuevo_estado = normalizar_estado(data.get('estado'))
+        if not nuevo_estado:
             return jsonify({'success': False, 'error': 'Estado inválido'}), 400
         
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE pedido SET estado = ? WHERE id = ?", (nuevo_estado, id))
-            conn.commit()
-            
-            if cursor.rowcount == 0:
-                return jsonify({'success': False, 'error': 'Pedido no encontrado'}), 404
+        if not cambiar_estado_pedido(id, nuevo_estado):
+            return jsonify({'success': False, 'error': 'Pedido no encontrado'}), 404
         
         return jsonify({'success': True})
     
@@ -1727,6 +4182,44 @@ def admin_limpiar_pedidos():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@con_reintentos
+def insertar_pedido(data):
+    """Inserta el pedido de la tienda y retorna su id"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        
+        # Insertar pedido
+        cursor.execute("""
+            INSERT INTO pedido (cliente_nombre, cliente_cuit, cliente_telefono, cliente_email, 
+                               cliente_direccion, metodo_entrega, envio_direccion, envio_localidad,
+                               envio_provincia, envio_cp, envio_nombre_destinatario, envio_dni_destinatario,
+                               envio_referencias, productos, total, cliente_telefono_clave)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (
+            data.get('nombre'),
+            data.get('cuit'),
+            data.get('telefono'),
+            data.get('email'),
+            data.get('direccion'),
+            data.get('metodo_entrega'),
+            data.get('envio_direccion'),
+            data.get('envio_localidad'),
+            data.get('envio_provincia'),
+            data.get('envio_cp'),
+            data.get('envio_nombre_destinatario'),
+            data.get('envio_dni_destinatario') or data.get('envio_cuit_destinatario'),
+            data.get('envio_referencias'),
+            data.get('productos'),  # JSON string con los productos
+            data.get('total'),
+            normalizar_telefono(data.get('telefono'))
+        ))
+        
+        pedido_id = cursor.lastrowid
+        guardar_items_pedido(cursor, pedido_id, data.get('productos'))
+        conn.commit()
+        return pedido_id
+
+
 @app.route("/guardar-pedido", methods=["POST"])
 def guardar_pedido():
     """Guardar pedido en la base de datos"""
@@ -1739,75 +4232,7 @@ def guardar_pedido():
             if not dni_destinatario:
                 return jsonify({'success': False, 'error': 'El DNI del destinatario es obligatorio para envíos'}), 400
         
-        with get_db_connection() as conn:
-            cursor = conn.cursor()
-            
-            # Verificar si la tabla existe y tiene todas las columnas necesarias
-            try:
-                cursor.execute("SELECT envio_direccion FROM pedido LIMIT 1")
-            except sqlite3.OperationalError:
-                # La tabla no existe o no tiene las columnas nuevas, recrearla
-                logger.info("Recreando tabla de pedidos con nuevas columnas")
-                cursor.execute("DROP TABLE IF EXISTS pedido")
-                cursor.execute("""
-                    CREATE TABLE pedido (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        fecha TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                        cliente_nombre TEXT NOT NULL,
-                        cliente_cuit TEXT,
-                        cliente_telefono TEXT,
-                        cliente_email TEXT,
-                        cliente_direccion TEXT,
-                        metodo_entrega TEXT,
-                        envio_direccion TEXT,
-                        envio_localidad TEXT,
-                        envio_provincia TEXT,
-                        envio_cp TEXT,
-                        envio_nombre_destinatario TEXT,
-                        envio_dni_destinatario TEXT,
-                        envio_referencias TEXT,
-                        productos TEXT NOT NULL,
-                        total REAL NOT NULL,
-                        estado TEXT DEFAULT 'pendiente'
-                    )
-                """)
-                # Configurar el AUTOINCREMENT para que empiece en 1200
-                cursor.execute("UPDATE sqlite_sequence SET seq = 1199 WHERE name = 'pedido'")
-                # Si no existe entrada en sqlite_sequence, insertarla
-                cursor.execute("INSERT OR IGNORE INTO sqlite_sequence (name, seq) VALUES ('pedido', 1199)")
-
-            try:
-                cursor.execute("SELECT envio_dni_destinatario FROM pedido LIMIT 1")
-            except sqlite3.OperationalError:
-                cursor.execute("ALTER TABLE pedido ADD COLUMN envio_dni_destinatario TEXT")
-            
-            # Insertar pedido
-            cursor.execute("""
-                INSERT INTO pedido (cliente_nombre, cliente_cuit, cliente_telefono, cliente_email, 
-                                   cliente_direccion, metodo_entrega, envio_direccion, envio_localidad,
-                                   envio_provincia, envio_cp, envio_nombre_destinatario, envio_dni_destinatario,
-                                   envio_referencias, productos, total)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                data.get('nombre'),
-                data.get('cuit'),
-                data.get('telefono'),
-                data.get('email'),
-                data.get('direccion'),
-                data.get('metodo_entrega'),
-                data.get('envio_direccion'),
-                data.get('envio_localidad'),
-                data.get('envio_provincia'),
-                data.get('envio_cp'),
-                data.get('envio_nombre_destinatario'),
-                data.get('envio_dni_destinatario') or data.get('envio_cuit_destinatario'),
-                data.get('envio_referencias'),
-                data.get('productos'),  # JSON string con los productos
-                data.get('total')
-            ))
-            
-            pedido_id = cursor.lastrowid
-            conn.commit()
+        pedido_id = insertar_pedido(data)
         
         # Enviar email de confirmación al cliente
         if data.get('email'):
@@ -1854,12 +4279,16 @@ def admin_lista_precios():
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM producto WHERE stock > 0 ORDER BY codigo DESC")
+            cursor.execute("SELECT * FROM vista_producto WHERE stock > 0 ORDER BY codigo DESC")
             productos = [dict(row) for row in cursor.fetchall()]
             
-            # Obtener categorías únicas
-            cursor.execute("SELECT DISTINCT categoria FROM producto WHERE categoria IS NOT NULL AND categoria != '' ORDER BY categoria")
-            categorias = [row['categoria'] for row in cursor.fetchall()]
+            # Categorías que tienen productos
+            cursor.execute("""
+                SELECT nombre FROM categoria c
+                WHERE EXISTS (SELECT 1 FROM producto p WHERE p.categoria_id = c.id)
+                ORDER BY nombre
+            """)
+            categorias = [row['nombre'] for row in cursor.fetchall()]
             
             return render_template("admin/lista_precios.html", productos=productos, categorias=categorias, now=datetime.now())
     except Exception as e:
@@ -1875,26 +4304,13 @@ def admin_producto_nuevo():
     """Crear nuevo producto"""
     if request.method == "POST":
         try:
-            # Generar código automáticamente primero
-            codigo_automatico = generar_codigo_producto()
-            
-            # Manejar imagen
-            imagen_filename = ""
-            if 'imagen' in request.files:
-                file = request.files['imagen']
-                if file and file.filename and allowed_file(file.filename):
-                    # Obtener la extensión del archivo original
-                    extension = os.path.splitext(file.filename)[1].lower()
-                    # Renombrar con el código del producto
-                    imagen_filename = f"{codigo_automatico}{extension}"
-                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], imagen_filename)
-                    file.save(filepath)
-            
             with get_db_connection() as conn:
                 cursor = conn.cursor()
+                # El código se reserva en la misma transacción que el insert
+                codigo_automatico = reservar_codigos_producto(cursor)[0]
                 cursor.execute("""
-                    INSERT INTO producto (codigo, titulo, descripcion, precio, minimo, multiplo, stock, imagen, categoria, activo)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    INSERT INTO producto (codigo, titulo, descripcion, precio, minimo, multiplo, stock, imagen, imagen_version, categoria_id, activo)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     codigo_automatico,  # Usar código generado automáticamente
                     request.form.get('titulo'),
@@ -1903,8 +4319,9 @@ def admin_producto_nuevo():
                     int(request.form.get('minimo', 1)),
                     int(request.form.get('multiplo', 1)),
                     int(request.form.get('stock', 0)),
-                    imagen_filename,
-                    request.form.get('categoria', ''),
+                    "",
+                    None,
+                    id_categoria(cursor, request.form.get('categoria', '')),
                     1  # Por defecto activo
                 ))
                 
@@ -1919,6 +4336,24 @@ def admin_producto_nuevo():
                 
                 conn.commit()
             
+            # Manejar imagen (fuera de la transacción, ya con el código asignado)
+            if 'imagen' in request.files:
+                file = request.files['imagen']
+                if file and file.filename and allowed_file(file.filename):
+                    # Obtener la extensión del archivo original
+                    extension = os.path.splitext(file.filename)[1].lower()
+                    # Renombrar con el código del producto
+                    imagen_filename = f"{codigo_automatico}{extension}"
+                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], imagen_filename)
+                    file.save(filepath)
+                    imagen_version = hash_imagen(imagen_filename)
+                    generar_miniaturas(imagen_filename, forzar=True)
+                    
+                    with get_db_connection() as conn:
+                        conn.execute("UPDATE producto SET imagen = ?, imagen_version = ? WHERE id = ?",
+                                     (imagen_filename, imagen_version, producto_id))
+                        conn.commit()
+            
             flash(f'Producto creado exitosamente con código {codigo_automatico}', 'success')
             return redirect(url_for('admin_productos'))
         except Exception as e:
@@ -1955,6 +4390,7 @@ def admin_producto_editar(id):
                 
                 # Manejar imagen
                 imagen_filename = request.form.get('imagen_actual', '')
+                imagen_version = None  # None = conservar la versión actual
                 if 'imagen' in request.files:
                     file = request.files['imagen']
                     if file and file.filename and allowed_file(file.filename):
@@ -1964,6 +4400,8 @@ def admin_producto_editar(id):
                         imagen_filename = f"{codigo_producto}{extension}"
                         filepath = os.path.join(app.config['UPLOAD_FOLDER'], imagen_filename)
                         file.save(filepath)
+                        imagen_version = hash_imagen(imagen_filename)
+                        generar_miniaturas(imagen_filename, forzar=True)
                         
                         # Eliminar imagen anterior si existe y es diferente
                         imagen_anterior = request.form.get('imagen_actual', '')
@@ -1974,10 +4412,14 @@ def admin_producto_editar(id):
                                     os.remove(ruta_anterior)
                                 except Exception as e:
                                     logger.warning(f"No se pudo eliminar la imagen anterior: {e}")
+                            # Si cambió el código, las miniaturas viejas quedan huérfanas
+                            if os.path.splitext(imagen_anterior)[0] != os.path.splitext(imagen_filename)[0]:
+                                eliminar_miniaturas(imagen_anterior)
                 
                 cursor.execute("""
                     UPDATE producto 
-                    SET codigo=?, titulo=?, descripcion=?, precio=?, minimo=?, multiplo=?, stock=?, imagen=?, categoria=?
+                    SET codigo=?, titulo=?, descripcion=?, precio=?, minimo=?, multiplo=?, stock=?, imagen=?,
+                        imagen_version=COALESCE(?, imagen_version), categoria_id=?
                     WHERE id=?
                 """, (
                     request.form.get('codigo'),
@@ -1988,7 +4430,8 @@ def admin_producto_editar(id):
                     int(request.form.get('multiplo', 1)),
                     int(request.form.get('stock', 0)),
                     imagen_filename,
-                    request.form.get('categoria', ''),
+                    imagen_version,
+                    id_categoria(cursor, request.form.get('categoria', '')),
                     id
                 ))
                 conn.commit()
@@ -1997,7 +4440,7 @@ def admin_producto_editar(id):
                 return redirect(url_for('admin_productos'))
             
             # GET - mostrar formulario
-            cursor.execute("SELECT * FROM producto WHERE id=?", (id,))
+            cursor.execute("SELECT * FROM vista_producto WHERE id=?", (id,))
             producto = dict(cursor.fetchone())
             
             # Obtener categorías de la base de datos
@@ -2094,7 +4537,7 @@ def admin_api_productos():
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM producto ORDER BY codigo DESC")
+            cursor.execute("SELECT * FROM vista_producto ORDER BY codigo DESC")
             productos = [dict(row) for row in cursor.fetchall()]
             return jsonify(productos)
     except Exception as e:
@@ -2102,10 +4545,44 @@ def admin_api_productos():
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/admin/api/buscar-productos")
+@login_required
+def admin_api_buscar_productos():
+    """Búsqueda de productos para la edición rápida (incluye inactivos y sin stock)"""
+    try:
+        texto = (request.args.get('q') or '').strip()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            return jsonify(buscar_productos(cursor, texto, limite_busqueda(), solo_tienda=False))
+    except Exception as e:
+        logger.error(f"Error en búsqueda de productos: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
 # =============================================================================
 # GESTIÓN DE CATEGORÍAS
 # =============================================================================
 
+def ids_categorias(cursor, nombres):
+    """
+    Devuelve {nombre: id} de las categorías nombradas, creando las que no
+    existen. El nombre vacío no es una categoría (su id es None). (No usa
+    INSERT OR IGNORE porque cada inserción ignorada avanza el AUTOINCREMENT.)
+    """
+    nombres = {str(nombre) for nombre in nombres if nombre not in (None, '')}
+    cursor.executemany("""
+        INSERT INTO categoria (nombre)
+        SELECT ? WHERE NOT EXISTS (SELECT 1 FROM categoria WHERE nombre = ?)
+    """, [(nombre, nombre) for nombre in nombres])
+    cursor.execute("SELECT id, nombre FROM categoria")
+    return {row['nombre']: row['id'] for row in cursor.fetchall() if row['nombre'] in nombres}
+
+
+def id_categoria(cursor, nombre):
+    """Id de la categoría con ese nombre (la crea si no existe); None si el nombre está vacío"""
+    return ids_categorias(cursor, [nombre]).get(str(nombre))
+
+
 @app.route("/admin/categorias")
 @login_required
 def admin_categorias():
@@ -2113,14 +4590,16 @@ def admin_categorias():
     try:
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM categoria ORDER BY nombre")
+            # Categorías con la cantidad de productos de cada una
+            cursor.execute("""
+                SELECT c.*, COUNT(p.id) AS num_productos
+                FROM categoria c
+                LEFT JOIN producto p ON p.categoria_id = c.id
+                GROUP BY c.id
+                ORDER BY c.nombre
+            """)
             categorias = [dict(row) for row in cursor.fetchall()]
             
-            # Contar productos por categoría
-            for categoria in categorias:
-                cursor.execute("SELECT COUNT(*) as count FROM producto WHERE categoria = ?", (categoria['nombre'],))
-                categoria['num_productos'] = cursor.fetchone()['count']
-            
             return render_template("admin/categorias.html", categorias=categorias)
     except Exception as e:
         logger.error(f"Error al obtener categorías: {e}")
@@ -2168,21 +4647,12 @@ def admin_categoria_editar(id):
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            # Obtener el nombre anterior
-            cursor.execute("SELECT nombre FROM categoria WHERE id = ?", (id,))
-            resultado = cursor.fetchone()
-            if not resultado:
+            # Los productos la referencian por id y leen el nombre de acá: no se tocan
+            cursor.execute("UPDATE categoria SET nombre = ? WHERE id = ?", (nuevo_nombre, id))
+            if cursor.rowcount == 0:
                 flash('Categoría no encontrada', 'error')
                 return redirect(url_for('admin_categorias'))
             
-            nombre_anterior = resultado['nombre']
-            
-            # Actualizar el nombre de la categoría
-            cursor.execute("UPDATE categoria SET nombre = ? WHERE id = ?", (nuevo_nombre, id))
-            
-            # Actualizar todos los productos que tenían la categoría anterior
-            cursor.execute("UPDATE producto SET categoria = ? WHERE categoria = ?", (nuevo_nombre, nombre_anterior))
-            
             conn.commit()
         
         flash('Categoría actualizada exitosamente', 'success')
@@ -2205,17 +4675,14 @@ def admin_categoria_eliminar(id):
         with get_db_connection() as conn:
             cursor = conn.cursor()
             
-            # Obtener el nombre de la categoría a eliminar
+            # Verificar que la categoría exista
             cursor.execute("SELECT nombre FROM categoria WHERE id = ?", (id,))
-            resultado = cursor.fetchone()
-            if not resultado:
+            if not cursor.fetchone():
                 flash('Categoría no encontrada', 'error')
                 return redirect(url_for('admin_categorias'))
             
-            nombre_categoria = resultado['nombre']
-            
             # Verificar si hay productos con esta categoría
-            cursor.execute("SELECT COUNT(*) as count FROM producto WHERE categoria = ?", (nombre_categoria,))
+            cursor.execute("SELECT COUNT(*) as count FROM producto WHERE categoria_id = ?", (id,))
             num_productos = cursor.fetchone()['count']
             
             if num_productos > 0:
@@ -2224,7 +4691,8 @@ def admin_categoria_eliminar(id):
                     return redirect(url_for('admin_categorias'))
                 
                 # Reasignar productos a la categoría destino
-                cursor.execute("UPDATE producto SET categoria = ? WHERE categoria = ?", (categoria_destino, nombre_categoria))
+                cursor.execute("UPDATE producto SET categoria_id = ? WHERE categoria_id = ?",
+                               (id_categoria(cursor, categoria_destino), id))
             
             # Eliminar la categoría
             cursor.execute("DELETE FROM categoria WHERE id = ?", (id,))
@@ -2247,7 +4715,7 @@ def admin_productos_nuevos():
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT p.*, pn.fecha_agregado 
-                FROM producto p
+                FROM vista_producto p
                 INNER JOIN producto_nuevo pn ON p.id = pn.producto_id
                 ORDER BY pn.fecha_agregado DESC
             """)
@@ -2394,19 +4862,17 @@ def contar_pedidos_concretados_por_cliente(cursor):
     Devuelve {clave_telefono: cantidad de pedidos concretados}, usando el mismo
     criterio que Clientes Destacados (estados concretados + últimos dígitos del teléfono).
     """
-    placeholders = ', '.join('?' for _ in ESTADOS_PEDIDO_REALIZADO)
-    cursor.execute(f"""
-        SELECT cliente_telefono
-        FROM pedido
-        WHERE LOWER(TRIM(COALESCE(estado, ''))) IN ({placeholders})
-    """, ESTADOS_PEDIDO_REALIZADO)
+    cursor.execute("SELECT clave, pedidos FROM cliente")
+    return {row[0]: row[1] for row in cursor.fetchall()}
 
-    conteos = {}
-    for row in cursor.fetchall():
-        clave = normalizar_telefono(row['cliente_telefono'])
-        if clave:
-            conteos[clave] = conteos.get(clave, 0) + 1
-    return conteos
+
+# Ordenamientos permitidos en Clientes Destacados
+ORDENES_CLIENTES = {
+    'pedidos': 'pedidos DESC, total_gastado DESC',
+    'total': 'total_gastado DESC',
+    'ultimo': 'ultimo_pedido DESC',
+    'nombre': 'nombre COLLATE NOCASE ASC'
+}
 
 
 @app.route("/admin/clientes-destacados")
@@ -2414,82 +4880,78 @@ def contar_pedidos_concretados_por_cliente(cursor):
 def admin_clientes_destacados():
     """Clientes que hicieron 2 o más pedidos concretados, agrupados por teléfono"""
     try:
-        placeholders = ', '.join('?' for _ in ESTADOS_PEDIDO_REALIZADO)
+        pagina = max(1, request.args.get('pagina', 1, type=int) or 1)
+        orden = request.args.get('orden', 'pedidos')
+        if orden not in ORDENES_CLIENTES:
+            orden = 'pedidos'
+
         with get_db_connection() as conn:
             cursor = conn.cursor()
-            cursor.execute(f"""
-                SELECT id, fecha, cliente_nombre, cliente_telefono, cliente_email,
-                       metodo_entrega, total, estado
-                FROM pedido
-                WHERE LOWER(TRIM(COALESCE(estado, ''))) IN ({placeholders})
-                ORDER BY fecha ASC, id ASC
-            """, ESTADOS_PEDIDO_REALIZADO)
-            pedidos = [dict(row) for row in cursor.fetchall()]
-
-        clientes = {}
-        pedidos_sin_telefono = 0
 
-        for pedido in pedidos:
-            clave = normalizar_telefono(pedido.get('cliente_telefono'))
-            if not clave:
-                pedidos_sin_telefono += 1
-                continue
-
-            cliente = clientes.setdefault(clave, {
-                'clave': clave,
-                'nombres': [],
-                'telefonos': [],
-                'emails': [],
-                'pedidos': [],
-                'total_gastado': 0
-            })
-
-            nombre = (pedido.get('cliente_nombre') or '').strip()
-            if nombre and nombre not in cliente['nombres']:
-                cliente['nombres'].append(nombre)
-
-            telefono = (pedido.get('cliente_telefono') or '').strip()
-            if telefono and telefono not in cliente['telefonos']:
-                cliente['telefonos'].append(telefono)
-
-            email = (pedido.get('cliente_email') or '').strip()
-            if email and email not in cliente['emails']:
-                cliente['emails'].append(email)
+            cursor.execute("""
+                SELECT COUNT(*), COALESCE(SUM(pedidos), 0), COALESCE(SUM(total_gastado), 0)
+                FROM cliente WHERE pedidos >= 2
+            """)
+            total_clientes, total_pedidos, total_facturado = cursor.fetchone()
+            total_paginas = max(1, -(-total_clientes // Config.CLIENTES_POR_PAGINA))
+            pagina = min(pagina, total_paginas)
 
-            cliente['pedidos'].append(pedido)
-            cliente['total_gastado'] += pedido.get('total') or 0
+            cursor.execute(f"""
+                SELECT * FROM cliente
+                WHERE pedidos >= 2
+                ORDER BY {ORDENES_CLIENTES[orden]}, clave
+                LIMIT ? OFFSET ?
+            """, (Config.CLIENTES_POR_PAGINA, (pagina - 1) * Config.CLIENTES_POR_PAGINA))
+            destacados = [dict(row) for row in cursor.fetchall()]
+
+            # Pedidos concretados solo de los clientes de esta página
+            pedidos_por_cliente = {}
+            if destacados:
+                claves = [cliente['clave'] for cliente in destacados]
+                cursor.execute(f"""
+                    SELECT id, fecha, cliente_nombre, cliente_telefono, cliente_email,
+                           metodo_entrega, total, estado, cliente_telefono_clave
+                    FROM pedido
+                    WHERE cliente_telefono_clave IN ({', '.join('?' for _ in claves)})
+                      AND estado IN ({', '.join('?' for _ in ESTADOS_PEDIDO_REALIZADO)})
+                    ORDER BY fecha ASC, id ASC
+                """, claves + list(ESTADOS_PEDIDO_REALIZADO))
+                for row in cursor.fetchall():
+                    pedidos_por_cliente.setdefault(row['cliente_telefono_clave'], []).append(dict(row))
 
-        # Solo los que tienen 2 o más pedidos concretados
-        destacados = [c for c in clientes.values() if len(c['pedidos']) >= 2]
+            placeholders = ', '.join('?' for _ in ESTADOS_PEDIDO_REALIZADO)
+            cursor.execute(f"""
+                SELECT COUNT(*) FROM pedido
+                WHERE cliente_telefono_clave IS NULL AND estado IN ({placeholders})
+            """, ESTADOS_PEDIDO_REALIZADO)
+            pedidos_sin_telefono = cursor.fetchone()[0]
 
         for cliente in destacados:
-            # Los pedidos vienen ordenados por fecha ascendente desde la query
-            cliente['cantidad_pedidos'] = len(cliente['pedidos'])
-            cliente['primer_pedido'] = cliente['pedidos'][0].get('fecha') or ''
-            cliente['ultimo_pedido'] = cliente['pedidos'][-1].get('fecha') or ''
+            cliente['cantidad_pedidos'] = cliente['pedidos']
+            cliente['pedidos'] = pedidos_por_cliente.get(cliente['clave'], [])
+            cliente['nombres'] = datos_conocidos(cliente['pedidos'], 'cliente_nombre')
+            cliente['telefonos'] = datos_conocidos(cliente['pedidos'], 'cliente_telefono')
+            cliente['emails'] = datos_conocidos(cliente['pedidos'], 'cliente_email')
+            cliente['primer_pedido'] = cliente['primer_pedido'] or ''
+            cliente['ultimo_pedido'] = cliente['ultimo_pedido'] or ''
             cliente['ticket_promedio'] = cliente['total_gastado'] / cliente['cantidad_pedidos']
-            # El nombre más reciente es el que mostramos como principal
-            cliente['nombre_principal'] = (
-                (cliente['pedidos'][-1].get('cliente_nombre') or '').strip()
-                or 'Sin nombre'
-            )
+            # El nombre y el número del pedido más reciente son los principales
+            cliente['nombre_principal'] = cliente['nombre'] or 'Sin nombre'
             cliente['otros_nombres'] = [
                 n for n in cliente['nombres'] if n != cliente['nombre_principal']
             ]
-            # El último número que usó es el del pedido más reciente
-            cliente['telefono_principal'] = (
-                (cliente['pedidos'][-1].get('cliente_telefono') or '').strip()
-            )
+            cliente['telefono_principal'] = cliente['telefono'] or ''
             cliente['whatsapp'] = telefono_whatsapp(cliente['telefono_principal'])
 
-        destacados.sort(
-            key=lambda c: (c['cantidad_pedidos'], c['total_gastado']),
-            reverse=True
-        )
-
         return render_template(
             "admin/clientes_destacados.html",
             clientes=destacados,
+            total_clientes=total_clientes,
+            total_pedidos=total_pedidos,
+            total_facturado=total_facturado,
+            pagina=pagina,
+            total_paginas=total_paginas,
+            orden=orden,
             pedidos_sin_telefono=pedidos_sin_telefono,
             digitos_clave=DIGITOS_CLAVE_TELEFONO
         )
@@ -2499,11 +4961,52 @@ def admin_clientes_destacados():
         return redirect(url_for('admin_dashboard'))
 
 
+# Ruta para servir miniaturas; si todavía no existe se genera en el momento
+@app.route('/uploads/miniaturas/<int:ancho>/<nombre>')
+def uploaded_miniatura(ancho, nombre):
+    """Sirve una miniatura, generándola desde la imagen original si falta o quedó vieja"""
+    base, extension = os.path.splitext(nombre)
+    extension = extension.lstrip('.').lower()
+    if ancho not in Config.MINIATURAS_ANCHOS or extension not in FORMATOS_MINIATURA:
+        abort(404)
+
+    carpeta = carpeta_miniaturas(ancho)
+    miniatura = os.path.join(carpeta, nombre)
+    original = imagen_de_miniatura(base)
+    # Se genera si falta o si la original es más nueva (reemplazada por SFTP)
+    if not os.path.exists(miniatura) or (
+        original and os.path.getmtime(miniatura) < os.path.getmtime(os.path.join(Config.UPLOAD_FOLDER, original))
+    ):
+        if not original:
+            abort(404)
+        if not generar_miniaturas(original):
+            # Sin Pillow (o imagen ilegible): servir la original
+            return send_from_directory(Config.UPLOAD_FOLDER, original)
+
+    return respuesta_imagen(send_from_directory(carpeta, nombre))
+
+
+def respuesta_imagen(response):
+    """
+    Si la URL trae la versión del contenido (?v=hash) la imagen no puede
+    cambiar, así que se cachea por un año sin revalidar.
+    """
+    if request.args.get('v'):
+        response.headers['Cache-Control'] = CACHE_CONTROL_INMUTABLE
+    return response
+
+
 # Ruta para servir imágenes desde almacenamiento persistente
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
     """Sirve imágenes desde la carpeta de almacenamiento persistente"""
-    return send_from_directory(Config.UPLOAD_FOLDER, filename)
+    return respuesta_imagen(send_from_directory(Config.UPLOAD_FOLDER, filename))
+
+
+# Inicializar base de datos al arrancar la app (al final del módulo, porque
+# las migraciones usan funciones de todas las secciones)
+configurar_wal()
+init_database()
 
 
 if __name__ == "__main__":
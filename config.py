@@ -20,6 +20,21 @@ class Config:
     # Uploads
     UPLOAD_FOLDER = os.path.join(PERSISTENT_DATA_PATH, "img")
     
+    # SQLite (PRAGMA de cada conexión)
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or -16000)  # negativo = KiB (16 MB)
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 64 * 1024 * 1024)  # bytes, 0 = desactivado
+    SQLITE_TEMP_STORE = os.environ.get('SQLITE_TEMP_STORE') or 'MEMORY'  # DEFAULT, FILE o MEMORY
+    SQLITE_WAL = os.environ.get('SQLITE_WAL', 'true').lower() == 'true'
+    # Con WAL, NORMAL no puede corromper la base (a lo sumo pierde el último commit ante un corte de luz)
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS') or ('NORMAL' if SQLITE_WAL else 'FULL')  # OFF, NORMAL, FULL o EXTRA
+    SQLITE_WAL_AUTOCHECKPOINT = int(os.environ.get('SQLITE_WAL_AUTOCHECKPOINT') or 1000)  # páginas
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT') or 5000)  # ms de espera si la base está ocupada
+    SQLITE_REINTENTOS = int(os.environ.get('SQLITE_REINTENTOS') or 4)  # reintentos de escritura tras el busy_timeout
+    SQLITE_REINTENTO_ESPERA = 0.1  # segundos, se duplica en cada reintento
+    
+    # Aplicar migraciones pendientes al arrancar (si es false, correr `flask --app app migrar-db` en el deploy)
+    MIGRAR_AL_INICIAR = os.environ.get('MIGRAR_AL_INICIAR', 'true').lower() == 'true'
+    
     # WhatsApp
     WHATSAPP_NUMBER = "5491158573906"
     
@@ -32,6 +47,30 @@ class Config:
     
     # Productos por página
     PRODUCTOS_POR_PAGINA = 24
+    PRODUCTOS_POR_PAGINA_MAX = 96
+    
+    # Búsqueda de productos (cantidad de resultados)
+    BUSQUEDA_LIMITE = 20
+    BUSQUEDA_LIMITE_MAX = 50
+    
+    # Catálogo paginado desde el servidor (/api/productos) en lugar de embebido en la página
+    CATALOGO_API = os.environ.get('CATALOGO_API', 'false').lower() == 'true'
+
+    # Compresión de las páginas de la tienda al renderizarlas (se hace en el request que no la encuentra en caché)
+    PAGINAS_GZIP_NIVEL = int(os.environ.get('PAGINAS_GZIP_NIVEL') or 6)  # 1 a 9
+    PAGINAS_BROTLI_CALIDAD = int(os.environ.get('PAGINAS_BROTLI_CALIDAD') or 5)  # 0 a 11
+
+    # Máximo de días hacia atrás que aceptan los gráficos de ventas (?periodo=)
+    VENTAS_PERIODO_MAX_DIAS = 3650
+
+    # Clientes por página en Clientes Destacados
+    CLIENTES_POR_PAGINA = 50
+    
+    # Segundos que se reutilizan las estadísticas del dashboard (se recalculan antes si cambian productos o pedidos)
+    DASHBOARD_CACHE_SEGUNDOS = int(os.environ.get('DASHBOARD_CACHE_SEGUNDOS') or 60)
+    
+    # Minutos que se guarda la vista previa de una importación sin confirmar (después se borra)
+    IMPORTACION_PENDIENTE_MINUTOS = int(os.environ.get('IMPORTACION_PENDIENTE_MINUTOS') or 60)
     
     # Dirección del local
     LOCAL_DIRECCION = "Av. Rivadavia 2768, CABA"
@@ -56,6 +95,9 @@ class Config:
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
     MAX_CONTENT_LENGTH = 5 * 1024 * 1024  # 5MB máximo
     
+    # Anchos (px) de las miniaturas que se generan al subir una imagen
+    MINIATURAS_ANCHOS = (80, 160, 320)
+    
     # Email
     MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'smtp.gmail.com'
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 587)
@@ -10,8 +10,8 @@ const WHATSAPP_NUMERO = "5491132864633";
 // Estado
 let carrito = JSON.parse(localStorage.getItem(STORAGE_KEY) || "[]");
 
-// Precios actualizados desde el servidor (se inicializa desde el template)
-window.productosActualizados = window.productosActualizados || {};
+// Precios actualizados desde el servidor (solo de los productos del carrito)
+window.productosActualizados = {};
 
 // =============================================================================
 // UTILIDADES
@@ -169,22 +169,47 @@ function updateResumen() {
   document.getElementById("alerta").style.display = calcularTotal() < 200000 ? "block" : "none";
 }
 
+/**
+ * Pide al servidor los datos actuales de los productos del carrito
+ * (por código, que no cambia al reimportar el Excel)
+ */
+async function obtenerPreciosActualizados() {
+  const codigos = [...new Set(carrito.map(p => p.codigo).filter(Boolean))];
+  if (codigos.length === 0) return null;
+
+  try {
+    const response = await fetch("/api/carrito/precios", {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json"
+      },
+      body: JSON.stringify({ codigos })
+    });
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    return await response.json();
+  } catch (err) {
+    console.warn("⚠️ No se pudieron obtener los precios actualizados:", err);
+    return null;
+  }
+}
+
 /**
  * Sincroniza precios del carrito con los precios actuales de la BD
  */
-function sincronizarPrecios() {
+async function sincronizarPrecios() {
   let huboActualizacion = false;
   let productosEliminados = 0;
-  const productosActualizados = window.productosActualizados || {};
   
   console.log("🔄 Sincronizando precios...");
   console.log("Productos en carrito:", carrito.length);
-  console.log("Productos actualizados desde BD:", Object.keys(productosActualizados).length);
-  
-  if (Object.keys(productosActualizados).length === 0) {
-    console.warn("⚠️ No hay productos actualizados desde la BD");
-    return;
+
+  const productosActualizados = await obtenerPreciosActualizados();
+  if (!productosActualizados) {
+    // Sin respuesta del servidor: dejar el carrito como está
+    return false;
   }
+  window.productosActualizados = productosActualizados;
+  console.log("Productos actualizados desde BD:", Object.keys(productosActualizados).length);
   
   // Filtrar productos desactivados y actualizar los activos
   carrito = carrito.filter(item => {
@@ -202,7 +227,8 @@ function sincronizarPrecios() {
         stock: actualizado.stock,
         minimo: actualizado.minimo,
         multiplo: actualizado.multiplo,
-        imagen: actualizado.imagen
+        imagen: actualizado.imagen,
+        imagen_version: actualizado.imagen_version
       });
       
       // Detectar cambios
@@ -236,6 +262,7 @@ function sincronizarPrecios() {
   }
   
   console.log("✅ Sincronización completada");
+  return true;
 }
 
 /**
@@ -277,7 +304,7 @@ function renderCarrito() {
     
     fila.innerHTML = `
       <div class="cart-item-imagen">
-        ${p.imagen ? `<img src="/uploads/${p.imagen}" alt="${p.titulo}" onerror="this.parentElement.innerHTML='<div class=\'sin-imagen\'>Sin imagen</div>'">` : '<div class="sin-imagen">Sin imagen</div>'}
+        ${p.imagen ? `<img src="/uploads/${p.imagen}${p.imagen_version ? `?v=${p.imagen_version}` : ''}" alt="${p.titulo}" onerror="this.parentElement.innerHTML='<div class=\'sin-imagen\'>Sin imagen</div>'">` : '<div class="sin-imagen">Sin imagen</div>'}
       </div>
       <div class="cart-item-info">
         <h3 class="cart-item-titulo">${p.titulo}</h3>
@@ -614,11 +641,12 @@ document.addEventListener("DOMContentLoaded", () => {
   carrito = carrito.map(normalizarItem);
   guardar();
 
-  // Sincronizar precios con la base de datos
-  sincronizarPrecios();
-
-  // Renderizar carrito
+  // Renderizar carrito con lo guardado y volver a renderizar al sincronizar
+  // precios con la base de datos
   renderCarrito();
+  sincronizarPrecios().then(sincronizado => {
+    if (sincronizado) renderCarrito();
+  });
 
   // Configurar toggle de entrega
   document.querySelectorAll('input[name="entrega"]').forEach(r => {
@@ -18,6 +18,12 @@ let ordenActual = "";
 // Elementos del DOM
 const cont = document.getElementById("productos");
 
+// Modo API: el servidor pagina y filtra (/api/productos) en lugar de embeber el catálogo
+const API_PRODUCTOS = cont.dataset.api || "";
+let totalPaginasApi = 1;
+let consultaApi = null;
+let busquedaTimer = null;
+
 // =============================================================================
 // UTILIDADES
 // =============================================================================
@@ -140,6 +146,12 @@ function leerCategoriaDeURL() {
  * Aplica los filtros de búsqueda y categoría
  */
 function aplicarFiltro() {
+  if (API_PRODUCTOS) {
+    paginaActual = 1;
+    cargarPaginaApi();
+    return;
+  }
+
   const q = textoBusqueda.trim().toLowerCase();
   const catFiltro = normalizarCategoriaValor(filtroCategoria);
   
@@ -161,10 +173,81 @@ function aplicarFiltro() {
   renderProductos();
 }
 
+/**
+ * Nombre de la categoría del botón activo (el servidor la normaliza)
+ */
+function categoriaSeleccionada() {
+  const activo = document.querySelector(".filtro-btn.active");
+  return activo ? (activo.dataset.cat || "") : "";
+}
+
+/**
+ * Pide al servidor la página actual con los filtros vigentes
+ */
+async function cargarPaginaApi() {
+  // Cancelar la consulta anterior si el usuario siguió escribiendo
+  if (consultaApi) consultaApi.abort();
+  consultaApi = new AbortController();
+
+  const params = new URLSearchParams({
+    pagina: paginaActual,
+    por_pagina: PRODUCTOS_POR_PAGINA
+  });
+  const cat = categoriaSeleccionada();
+  if (cat) params.set("cat", cat);
+  if (textoBusqueda.trim()) params.set("q", textoBusqueda.trim());
+  if (ordenActual) params.set("orden", ordenActual);
+
+  try {
+    const response = await fetch(`${API_PRODUCTOS}?${params}`, { signal: consultaApi.signal });
+    if (!response.ok) throw new Error(`HTTP ${response.status}`);
+    const data = await response.json();
+    productosFiltrados = data.productos || [];
+    paginaActual = data.pagina || 1;
+    totalPaginasApi = data.total_paginas || 1;
+  } catch (e) {
+    if (e.name === "AbortError") return;
+    console.error("Error cargando productos:", e);
+    productosFiltrados = [];
+    totalPaginasApi = 1;
+  }
+
+  renderProductos();
+}
+
+/**
+ * Total de páginas según el modo (API o catálogo embebido)
+ */
+function totalPaginas() {
+  if (API_PRODUCTOS) return totalPaginasApi;
+  return Math.ceil(productosFiltrados.length / PRODUCTOS_POR_PAGINA) || 1;
+}
+
 // =============================================================================
 // RENDERIZADO DE PRODUCTOS
 // =============================================================================
 
+/**
+ * Arma el srcset de las miniaturas de una imagen en el formato pedido
+ * (las miniaturas se llaman como la imagen original, sin su extensión)
+ */
+function srcsetMiniaturas(producto, formato, anchos) {
+  const base = producto.imagen.replace(/\.[^.]+$/, "");
+  const version = producto.imagen_version ? `?v=${producto.imagen_version}` : "";
+  return anchos
+    .map(ancho => `/uploads/miniaturas/${ancho}/${encodeURIComponent(base)}.${formato}${version} ${ancho}w`)
+    .join(", ");
+}
+
+/**
+ * URL de la imagen original; con la versión del contenido el navegador
+ * la cachea para siempre
+ */
+function urlImagen(producto) {
+  const version = producto.imagen_version ? `?v=${producto.imagen_version}` : "";
+  return `/uploads/${producto.imagen}${version}`;
+}
+
 /**
  * Calcula el máximo válido por stock
  */
@@ -199,8 +282,12 @@ function snapCantidad(n, producto) {
 function renderProductos() {
   cont.innerHTML = "";
   const inicio = (paginaActual - 1) * PRODUCTOS_POR_PAGINA;
-  const slice = productosFiltrados.slice(inicio, inicio + PRODUCTOS_POR_PAGINA);
+  // En modo API productosFiltrados ya es la página pedida
+  const slice = API_PRODUCTOS
+    ? productosFiltrados
+    : productosFiltrados.slice(inicio, inicio + PRODUCTOS_POR_PAGINA);
   const tpl = document.getElementById("producto-template");
+  const anchos = (tpl.dataset.miniaturas || "").split(",").filter(Boolean);
 
   if (slice.length === 0) {
     cont.innerHTML = `<p style="padding:8px;">No se encontraron productos.</p>`;
@@ -214,7 +301,11 @@ function renderProductos() {
     
     // Configurar elementos básicos
     card.dataset.categoria = normalizarCategoriaValor(p.categoria);
-    node.querySelector(".img").src = `/uploads/${p.imagen}`;
+    node.querySelector(".img").src = urlImagen(p);
+    if (p.imagen && anchos.length) {
+      node.querySelector(".img-webp").srcset = srcsetMiniaturas(p, "webp", anchos);
+      node.querySelector(".img").srcset = srcsetMiniaturas(p, "jpg", anchos);
+    }
     node.querySelector(".img").alt = p.titulo;
     node.querySelector(".titulo").textContent = p.titulo;
     node.querySelector(".titulo").title = p.titulo;
@@ -292,7 +383,7 @@ function renderProductos() {
  * Actualiza los controles de paginación
  */
 function actualizarPaginacion() {
-  const totalPags = Math.ceil(productosFiltrados.length / PRODUCTOS_POR_PAGINA) || 1;
+  const totalPags = totalPaginas();
   document.getElementById("pagina-info").textContent = `Página ${paginaActual} de ${totalPags}`;
   document.getElementById("prev-btn").disabled = paginaActual === 1;
   document.getElementById("next-btn").disabled = paginaActual >= totalPags;
@@ -310,12 +401,14 @@ function irCarrito() {
 // =============================================================================
 
 document.addEventListener("DOMContentLoaded", () => {
-  // Cargar productos del dataset
-  try {
-    productosRaw = JSON.parse(cont.dataset.productos);
-  } catch (e) {
-    console.error("Error parseando productos:", e);
-    productosRaw = [];
+  // Cargar productos del dataset (en modo API se piden al servidor)
+  if (!API_PRODUCTOS) {
+    try {
+      productosRaw = JSON.parse(cont.dataset.productos);
+    } catch (e) {
+      console.error("Error parseando productos:", e);
+      productosRaw = [];
+    }
   }
 
   // Leer categoría de la URL
@@ -336,7 +429,13 @@ document.addEventListener("DOMContentLoaded", () => {
   // Event listeners
   document.getElementById("filtro").addEventListener("input", e => {
     textoBusqueda = e.target.value;
-    aplicarFiltro();
+    if (API_PRODUCTOS) {
+      // Esperar a que termine de escribir antes de consultar al servidor
+      clearTimeout(busquedaTimer);
+      busquedaTimer = setTimeout(aplicarFiltro, 250);
+    } else {
+      aplicarFiltro();
+    }
   });
 
   document.getElementById("ordenar").addEventListener("change", e => {
@@ -365,15 +464,16 @@ document.addEventListener("DOMContentLoaded", () => {
   document.getElementById("prev-btn").addEventListener("click", () => {
     if (paginaActual > 1) {
       paginaActual--;
-      renderProductos();
+      if (API_PRODUCTOS) cargarPaginaApi();
+      else renderProductos();
     }
   });
 
   document.getElementById("next-btn").addEventListener("click", () => {
-    const totalPags = Math.ceil(productosFiltrados.length / PRODUCTOS_POR_PAGINA);
-    if (paginaActual < totalPags) {
+    if (paginaActual < totalPaginas()) {
       paginaActual++;
-      renderProductos();
+      if (API_PRODUCTOS) cargarPaginaApi();
+      else renderProductos();
     }
   });
 
@@ -0,0 +1,48 @@
+"""
+Fixtures de los tests: cada test usa una base de datos nueva en una
+carpeta temporal, con todas las migraciones aplicadas
+"""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as aplicacion  # noqa: E402
+from config import Config  # noqa: E402
+
+
+@pytest.fixture
+def base_datos(tmp_path, monkeypatch):
+    """Base vacía (solo la tabla producto original) migrada en tmp_path"""
+    monkeypatch.setattr(Config, 'PERSISTENT_DATA_PATH', str(tmp_path))
+    monkeypatch.setattr(Config, 'DATABASE_PATH', str(tmp_path / 'productos.db'))
+    monkeypatch.setattr(Config, 'UPLOAD_FOLDER', str(tmp_path / 'img'))
+    os.makedirs(Config.UPLOAD_FOLDER)
+
+    conn = sqlite3.connect(Config.DATABASE_PATH)
+    conn.execute("""
+        CREATE TABLE producto (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, codigo TEXT, titulo TEXT, descripcion TEXT,
+            precio REAL, minimo INTEGER, multiplo INTEGER, stock INTEGER, imagen TEXT, categoria TEXT
+        )
+    """)
+    conn.commit()
+    conn.close()
+
+    aplicacion.cerrar_conexion_del_hilo()
+    aplicacion.aplicar_migraciones()
+    yield tmp_path
+    aplicacion.cerrar_conexion_del_hilo()
+
+
+@pytest.fixture
+def admin(base_datos):
+    """Cliente de prueba con la sesión de administrador iniciada"""
+    aplicacion.app.config['TESTING'] = True
+    cliente = aplicacion.app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['admin_logged_in'] = True
+    return cliente
@@ -0,0 +1,20 @@
+"""
+Tests de la búsqueda de productos sin el índice FTS (búsqueda con LIKE)
+"""
+import app as aplicacion
+
+
+def test_like_busca_comodines_literales(base_datos, monkeypatch):
+    monkeypatch.setattr(aplicacion, 'hay_indice_busqueda', lambda cursor: False)
+    with aplicacion.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO producto (codigo, titulo, precio, stock) VALUES (?, ?, 10, 5)",
+            [('A0001', 'Globo 50% off'), ('A0002', 'Globo 500 unidades'), ('A0003', 'Vela_azul'), ('A0004', 'Vela azul')]
+        )
+        conn.commit()
+
+        assert [p['codigo'] for p in aplicacion.buscar_productos(cursor, '50%', 10)] == ['A0001']
+        assert [p['codigo'] for p in aplicacion.buscar_productos(cursor, 'vela_', 10)] == ['A0003']
+        pagina = aplicacion.buscar_pagina_catalogo(cursor, 1, 10, texto='50%')
+        assert [p['codigo'] for p in pagina['productos']] == ['A0001']
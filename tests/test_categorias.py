@@ -0,0 +1,53 @@
+"""
+Tests de las categorías: los productos las referencian por id y leen el
+nombre de la tabla categoria
+"""
+import app as aplicacion
+
+
+def buscar(cursor, texto):
+    return [p['codigo'] for p in aplicacion.buscar_productos(cursor, texto, 10, solo_tienda=False)]
+
+
+def test_renombrar_no_escribe_en_producto(admin):
+    with aplicacion.get_db_connection() as conn:
+        cursor = conn.cursor()
+        id_globos = aplicacion.id_categoria(cursor, 'Globos')
+        cursor.executemany(
+            "INSERT INTO producto (codigo, titulo, precio, stock, categoria_id) VALUES (?, ?, 10, 5, ?)",
+            [('A0001', 'Rojo', id_globos), ('A0002', 'Azul', id_globos), ('A0003', 'Vela', None)]
+        )
+        conn.commit()
+        assert buscar(cursor, 'globos') == ['A0001', 'A0002']
+        version = aplicacion.obtener_version_catalogo(cursor)
+
+    admin.post(f'/admin/categoria/{id_globos}/editar', data={'nombre': 'Globos látex'})
+
+    with aplicacion.get_db_connection() as conn:
+        cursor = conn.cursor()
+        # Solo se escribió la fila de categoria (y su versión del catálogo)
+        assert aplicacion.obtener_version_catalogo(cursor) == version + 1
+        assert [tuple(row) for row in cursor.execute(
+            "SELECT codigo, categoria FROM vista_producto ORDER BY codigo"
+        )] == [('A0001', 'Globos látex'), ('A0002', 'Globos látex'), ('A0003', '')]
+        assert sorted(buscar(cursor, 'latex')) == ['A0001', 'A0002']
+        assert buscar(cursor, 'globos rojo') == ['A0001']
+        cursor.execute("INSERT INTO producto_fts (producto_fts) VALUES ('integrity-check')")
+
+
+def test_producto_nuevo_y_borrar_categoria(admin):
+    admin.post('/admin/producto/nuevo', data={'titulo': 'Piñata', 'precio': '10', 'stock': '1', 'categoria': 'Cotillón'})
+    with aplicacion.get_db_connection() as conn:
+        cursor = conn.cursor()
+        producto = cursor.execute("SELECT id, categoria_id, categoria FROM vista_producto").fetchone()
+        assert producto['categoria'] == 'Cotillón'
+        assert buscar(cursor, 'cotillon')
+
+    admin.post(f"/admin/categoria/{producto['categoria_id']}/eliminar", data={'categoria_destino': 'Fiestas'})
+
+    with aplicacion.get_db_connection() as conn:
+        cursor = conn.cursor()
+        assert cursor.execute("SELECT categoria FROM vista_producto").fetchone()[0] == 'Fiestas'
+        assert not buscar(cursor, 'cotillon')
+        assert buscar(cursor, 'fiestas')
+        cursor.execute("INSERT INTO producto_fts (producto_fts) VALUES ('integrity-check')")
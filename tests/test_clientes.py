@@ -0,0 +1,36 @@
+"""
+Tests de la tabla cliente (clientes destacados)
+"""
+import app as aplicacion
+
+
+def test_datos_conocidos_en_orden_de_aparicion(admin):
+    estado = aplicacion.ESTADOS_PEDIDO_REALIZADO[0]
+    pedidos = [
+        ('2026-01-03 10:00:00', 'Zoe', '11 6655-4400', 'z@x.com'),
+        ('2026-01-01 10:00:00', 'Mara', '1166554400', 'm@x.com'),
+        ('2026-01-02 10:00:00', ' Zoe ', '+54 11 6655-4400', 'm@x.com'),
+        ('2026-01-04 10:00:00', 'Ana', '1166554400', ''),
+    ]
+    with aplicacion.get_db_connection() as conn:
+        cursor = conn.cursor()
+        for fecha, nombre, telefono, email in pedidos:
+            cursor.execute("""
+                INSERT INTO pedido (fecha, cliente_nombre, cliente_telefono, cliente_email, productos, total, estado,
+                                    cliente_telefono_clave)
+                VALUES (?, ?, ?, ?, '[]', 100, ?, ?)
+            """, (fecha, nombre, telefono, email, estado, aplicacion.normalizar_telefono(telefono)))
+        conn.commit()
+        cliente = cursor.execute("SELECT * FROM cliente").fetchone()
+        assert (cliente['pedidos'], cliente['nombre'], cliente['telefono']) == (4, 'Ana', '1166554400')
+
+        pedidos_ordenados = cursor.execute("SELECT * FROM pedido ORDER BY fecha, id").fetchall()
+    assert aplicacion.datos_conocidos(pedidos_ordenados, 'cliente_nombre') == ['Mara', 'Zoe', 'Ana']
+    assert aplicacion.datos_conocidos(pedidos_ordenados, 'cliente_telefono') == [
+        '1166554400', '+54 11 6655-4400', '11 6655-4400'
+    ]
+    assert aplicacion.datos_conocidos(pedidos_ordenados, 'cliente_email') == ['m@x.com', 'z@x.com']
+
+    pagina = admin.get('/admin/clientes-destacados').get_data(as_text=True)
+    assert 'también: Mara, Zoe' in pagina
+    assert 'm@x.com, z@x.com' in pagina
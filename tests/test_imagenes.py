@@ -0,0 +1,76 @@
+"""
+Tests de versiones y miniaturas de imágenes reemplazadas fuera del panel
+"""
+import os
+
+import pytest
+
+import app as aplicacion
+from config import Config
+
+
+def guardar_imagen(nombre, color, mtime=None):
+    Image = pytest.importorskip('PIL.Image')
+    ruta = os.path.join(Config.UPLOAD_FOLDER, nombre)
+    Image.new('RGB', (400, 300), color).save(ruta, 'JPEG')
+    if mtime is not None:
+        os.utime(ruta, (mtime, mtime))
+    return ruta
+
+
+def crear_producto(imagen):
+    with aplicacion.get_db_connection() as conn:
+        conn.execute(
+            "INSERT INTO producto (codigo, titulo, precio, imagen, imagen_version) VALUES ('A0001', 'Producto', 10, ?, ?)",
+            (imagen, aplicacion.hash_imagen(imagen))
+        )
+        conn.commit()
+
+
+def version_de(codigo):
+    with aplicacion.get_db_connection() as conn:
+        return conn.execute("SELECT imagen_version FROM producto WHERE codigo = ?", (codigo,)).fetchone()['imagen_version']
+
+
+def test_versionar_imagenes_detecta_reemplazos(base_datos):
+    guardar_imagen('A0001.jpg', 'red')
+    crear_producto('A0001.jpg')
+    aplicacion.generar_miniaturas('A0001.jpg')
+    miniatura = os.path.join(aplicacion.carpeta_miniaturas(80), 'A0001.jpg')
+    antes = version_de('A0001')
+    contenido_antes = open(miniatura, 'rb').read()
+
+    # Reemplazo por SFTP conservando una fecha vieja (scp -p)
+    guardar_imagen('A0001.jpg', 'blue', mtime=1)
+
+    resultado = aplicacion.app.test_cli_runner().invoke(args=['versionar-imagenes'])
+    assert resultado.exit_code == 0
+    assert version_de('A0001') not in (None, antes)
+    assert version_de('A0001') == aplicacion.hash_imagen('A0001.jpg')
+    assert open(miniatura, 'rb').read() != contenido_antes
+
+
+def test_miniatura_vieja_se_regenera_al_pedirla(base_datos):
+    guardar_imagen('A0001.jpg', 'red')
+    aplicacion.generar_miniaturas('A0001.jpg')
+    miniatura = os.path.join(aplicacion.carpeta_miniaturas(80), 'A0001.webp')
+    os.utime(miniatura, (1, 1))
+    contenido_antes = open(miniatura, 'rb').read()
+
+    guardar_imagen('A0001.jpg', 'blue')
+    respuesta = aplicacion.app.test_client().get('/uploads/miniaturas/80/A0001.webp')
+    assert respuesta.status_code == 200
+    assert respuesta.data != contenido_antes
+    respuesta.close()
+
+
+@pytest.mark.parametrize('imagen', ['A0001.JPG', 'Globo rojo ñ.jpeg'])
+def test_miniatura_de_imagen_con_cualquier_nombre(base_datos, imagen):
+    guardar_imagen(imagen, 'red')
+    crear_producto(imagen)
+    base = os.path.splitext(imagen)[0]
+
+    respuesta = aplicacion.app.test_client().get(f'/uploads/miniaturas/80/{base}.webp')
+    assert respuesta.status_code == 200
+    assert respuesta.mimetype == 'image/webp'
+    respuesta.close()
@@ -0,0 +1,68 @@
+"""
+Tests de la vista previa de la importación de productos
+"""
+import io
+import os
+import time
+
+import pytest
+from openpyxl import Workbook
+
+import app as aplicacion
+from config import Config
+
+
+def planilla(*filas):
+    wb = Workbook()
+    wb.active.append(aplicacion.COLUMNAS_PRODUCTOS)
+    for fila in filas:
+        wb.active.append(list(fila))
+    archivo = io.BytesIO()
+    wb.save(archivo)
+    archivo.seek(0)
+    return archivo
+
+
+def vista_previa(admin, archivo):
+    return admin.post(
+        '/admin/subir-excel/vista-previa',
+        data={'archivo': (archivo, 'productos.xlsx')},
+        content_type='multipart/form-data'
+    )
+
+
+def pendientes():
+    return sorted(os.listdir(aplicacion.carpeta_importaciones_pendientes()))
+
+
+def test_vista_previa_borra_las_pendientes_vencidas(admin):
+    pytest.importorskip('pandas')
+    vieja = aplicacion.ruta_importacion_pendiente('abandonada')
+    reciente = aplicacion.ruta_importacion_pendiente('de-otro-admin')
+    for ruta in (vieja, reciente):
+        with open(ruta, 'w', encoding='utf-8') as f:
+            f.write('[]')
+    vencida = time.time() - Config.IMPORTACION_PENDIENTE_MINUTOS * 60 - 1
+    os.utime(vieja, (vencida, vencida))
+
+    respuesta = vista_previa(admin, planilla([None, 'A0001', 'Producto', '', 10, 1, 1, 5, 'Varios', 'Sí']))
+    assert respuesta.status_code == 200
+
+    with admin.session_transaction() as sesion:
+        token = sesion['importacion_productos']
+    assert pendientes() == sorted(['de-otro-admin.json', f'{token}.json'])
+
+
+def test_confirmar_rechaza_una_vista_previa_vencida(admin):
+    pytest.importorskip('pandas')
+    vista_previa(admin, planilla([None, 'A0001', 'Producto', '', 10, 1, 1, 5, 'Varios', 'Sí']))
+    with admin.session_transaction() as sesion:
+        ruta = aplicacion.ruta_importacion_pendiente(sesion['importacion_productos'])
+    vencida = time.time() - Config.IMPORTACION_PENDIENTE_MINUTOS * 60 - 1
+    os.utime(ruta, (vencida, vencida))
+
+    admin.post('/admin/subir-excel/confirmar')
+
+    assert not os.path.exists(ruta)
+    with aplicacion.get_db_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM producto").fetchone()[0] == 0
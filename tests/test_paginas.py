@@ -0,0 +1,32 @@
+"""
+Tests de la caché de páginas pre-renderizadas de la tienda
+"""
+import threading
+
+import app as aplicacion
+
+
+def test_render_lento_no_bloquea_otras_paginas(monkeypatch):
+    monkeypatch.setattr(aplicacion, '_paginas_cache', {})
+    liberar = threading.Event()
+    renders = []
+
+    def lenta():
+        renders.append('a')
+        liberar.wait(5)
+        return '<p>a</p>'
+
+    hilos = [threading.Thread(target=aplicacion.get_pagina_renderizada, args=('a', 1, lenta)) for _ in range(3)]
+    for hilo in hilos:
+        hilo.start()
+
+    # Mientras 'a' se renderiza, otra página se sirve sin esperarla
+    assert aplicacion.get_pagina_renderizada('b', 1, lambda: '<p>b</p>').cuerpo == b'<p>b</p>'
+    assert not liberar.is_set()
+
+    liberar.set()
+    for hilo in hilos:
+        hilo.join(5)
+    assert renders == ['a']
+    assert aplicacion.get_pagina_renderizada('a', 1, lambda: 'otra').cuerpo == b'<p>a</p>'
+    assert aplicacion._paginas_en_curso == {}
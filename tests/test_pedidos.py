@@ -0,0 +1,72 @@
+"""
+Tests del cambio de estado de pedidos
+"""
+import app as aplicacion
+
+
+def crear_pedido(estado='pagado'):
+    with aplicacion.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO pedido (cliente_nombre, productos, total, estado) VALUES ('Cliente', '[]', 100, ?)",
+            (estado,)
+        )
+        conn.commit()
+        return cursor.lastrowid
+
+
+def estado_de(pedido_id):
+    with aplicacion.get_db_connection() as conn:
+        return conn.execute("SELECT estado FROM pedido WHERE id = ?", (pedido_id,)).fetchone()['estado']
+
+
+def test_cambiar_estado_acepta_variantes(admin):
+    pedido_id = crear_pedido()
+    respuesta = admin.post(f'/admin/pedido/{pedido_id}/estado', json={'estado': ' Señado '})
+    assert respuesta.status_code == 200
+    assert estado_de(pedido_id) == 'señado'
+
+
+def test_cambiar_estado_vacio_o_faltante_devuelve_400(admin):
+    pedido_id = crear_pedido()
+    for datos in ({}, {'estado': ''}, {'estado': '   '}, {'estado': None}):
+        respuesta = admin.post(f'/admin/pedido/{pedido_id}/estado', json=datos)
+        assert respuesta.status_code == 400
+        assert estado_de(pedido_id) == 'pagado'
+
+
+def test_cambiar_estado_desconocido_devuelve_400(admin):
+    pedido_id = crear_pedido()
+    respuesta = admin.post(f'/admin/pedido/{pedido_id}/estado', json={'estado': 'perdido'})
+    assert respuesta.status_code == 400
+    assert estado_de(pedido_id) == 'pagado'
+
+
+def test_normalizar_estado_solo_usa_el_defecto_explicito():
+    assert aplicacion.normalizar_estado(None) is None
+    assert aplicacion.normalizar_estado('') is None
+    assert aplicacion.normalizar_estado('', por_defecto='pendiente') == 'pendiente'
+    assert aplicacion.normalizar_estado('PAGADO') == 'pagado'
+
+
+def test_pedido_manual_reintenta_si_la_base_esta_bloqueada(admin, monkeypatch):
+    monkeypatch.setattr(aplicacion.Config, 'SQLITE_REINTENTO_ESPERA', 0)
+    guardar_items = aplicacion.guardar_items_pedido
+    intentos = []
+
+    def bloqueada_una_vez(*args):
+        intentos.append(1)
+        if len(intentos) == 1:
+            raise aplicacion.sqlite3.OperationalError('database is locked')
+        return guardar_items(*args)
+
+    monkeypatch.setattr(aplicacion, 'guardar_items_pedido', bloqueada_una_vez)
+    respuesta = admin.post('/admin/cargar-pedido-manual', json={
+        'cliente_nombre': 'Cliente', 'cliente_telefono': '1166554400', 'metodo_entrega': 'retiro',
+        'productos': [], 'total': 100
+    })
+    assert respuesta.status_code == 200
+    assert len(intentos) == 2
+    # El primer intento se deshizo: queda un solo pedido
+    with aplicacion.get_db_connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM pedido").fetchone()[0] == 1
@@ -0,0 +1,106 @@
+"""
+Tests del resumen de ventas por producto: los triggers tienen que dejar lo
+mismo que reconstruir_ventas_producto
+"""
+import json
+import random
+
+import app as aplicacion
+
+
+def ventas(cursor):
+    return (
+        cursor.execute("SELECT * FROM ventas_producto ORDER BY codigo").fetchall(),
+        cursor.execute("SELECT * FROM ventas_producto_diarias ORDER BY codigo, dia").fetchall(),
+    )
+
+
+def filas(resultado):
+    return [[tuple(row) for row in tabla] for tabla in resultado]
+
+
+def test_triggers_y_reconstruccion_coinciden(base_datos):
+    azar = random.Random(7)
+    with aplicacion.get_db_connection() as conn:
+        cursor = conn.cursor()
+        pedidos = []
+        for n in range(60):
+            accion = azar.random()
+            if accion < 0.6 or not pedidos:
+                productos = [
+                    {'codigo': azar.choice(['A0001', 'A0002', '']), 'titulo': f'Título {azar.randint(1, 5)}',
+                     'precio': 10, 'cantidad': azar.randint(1, 3)}
+                    for _ in range(azar.randint(1, 3))
+                ]
+                cursor.execute(
+                    "INSERT INTO pedido (fecha, cliente_nombre, productos, total, estado) VALUES (?, 'C', ?, 0, 'pendiente')",
+                    (f"2026-01-0{azar.randint(1, 3)} 10:00:00", json.dumps(productos))
+                )
+                pedidos.append(cursor.lastrowid)
+                aplicacion.guardar_items_pedido(cursor, cursor.lastrowid, productos)
+            elif accion < 0.75:
+                cursor.execute("UPDATE pedido SET estado = ? WHERE id = ?",
+                               (azar.choice(['cancelado', 'pagado']), azar.choice(pedidos)))
+            elif accion < 0.85:
+                cursor.execute("UPDATE pedido SET fecha = ? WHERE id = ?",
+                               (f"2026-01-0{azar.randint(1, 3)} 12:00:00", azar.choice(pedidos)))
+            elif accion < 0.93:
+                cursor.execute("DELETE FROM pedido_item WHERE id = (SELECT MAX(id) FROM pedido_item WHERE pedido_id = ?)",
+                               (azar.choice(pedidos),))
+            else:
+                pedido_id = azar.choice(pedidos)
+                pedidos.remove(pedido_id)
+                cursor.execute("DELETE FROM pedido WHERE id = ?", (pedido_id,))
+
+        incrementales = filas(ventas(cursor))
+        aplicacion.reconstruir_ventas_producto(cursor)
+        assert filas(ventas(cursor)) == incrementales
+        conn.rollback()
+
+
+def test_titulo_es_el_del_ultimo_item(base_datos):
+    with aplicacion.get_db_connection() as conn:
+        cursor = conn.cursor()
+        ids = []
+        for titulo in ('Viejo', 'Nuevo'):
+            cursor.execute("INSERT INTO pedido (cliente_nombre, productos, total) VALUES ('C', '[]', 0)")
+            ids.append(cursor.lastrowid)
+            aplicacion.guardar_items_pedido(cursor, cursor.lastrowid, [{'codigo': 'A0001', 'titulo': titulo, 'precio': 1, 'cantidad': 1}])
+
+        titulo = "SELECT titulo FROM ventas_producto WHERE codigo = 'A0001'"
+        assert cursor.execute(titulo).fetchone()[0] == 'Nuevo'
+        # Volver a contar un pedido viejo no cambia el título
+        cursor.execute("UPDATE pedido SET estado = 'cancelado' WHERE id = ?", (ids[0],))
+        cursor.execute("UPDATE pedido SET estado = 'pagado' WHERE id = ?", (ids[0],))
+        assert cursor.execute(titulo).fetchone()[0] == 'Nuevo'
+        # Si se cancela el último, queda el título del anterior
+        cursor.execute("UPDATE pedido SET estado = 'cancelado' WHERE id = ?", (ids[1],))
+        assert cursor.execute(titulo).fetchone()[0] == 'Viejo'
+        conn.rollback()
+
+
+def test_pedidos_sin_fecha_valida_cuentan_en_los_totales(admin):
+    with aplicacion.get_db_connection() as conn:
+        cursor = conn.cursor()
+        for fecha, total in (('2026-01-02 10:00:00', 100), ('02/01/2026', 50), (None, 25)):
+            cursor.execute(
+                "INSERT INTO pedido (fecha, cliente_nombre, productos, total, estado) VALUES (?, 'C', '[]', ?, 'pagado')",
+                (fecha, total)
+            )
+        conn.commit()
+        incrementales = [tuple(row) for row in cursor.execute("SELECT * FROM ventas_diarias ORDER BY dia")]
+        aplicacion.reconstruir_ventas_diarias(cursor)
+        assert [tuple(row) for row in cursor.execute("SELECT * FROM ventas_diarias ORDER BY dia")] == incrementales
+        conn.rollback()
+
+        estadisticas = aplicacion.calcular_estadisticas_dashboard(cursor)
+    assert (estadisticas['total_pedidos'], estadisticas['total_ventas']) == (3, 175)
+    assert admin.get('/admin/api/ventas-por-dia?periodo=all').get_json() == [['2026-01-02', 1, 100]]
+
+
+def test_periodo_fuera_de_rango_devuelve_400(admin):
+    for ruta in ('/admin/api/ventas-por-dia', '/admin/api/productos-mas-vendidos'):
+        for periodo in ('-5', '0', 'abc', '3651', '99999999999'):
+            assert admin.get(f'{ruta}?periodo={periodo}').status_code == 400
+        for periodo in ('1', '3650', 'all'):
+            assert admin.get(f'{ruta}?periodo={periodo}').status_code == 200